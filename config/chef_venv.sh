@@ -0,0 +1,132 @@
+#!/bin/bash
+# Setup the virtualenv of a chef using the shared wheelhouse and base venvs.
+# Uploaded and run by `setup_chef` and `update_chef` as the chef user.
+#
+# Usage: chef_venv.sh CHEF_ROOT_DIR PYTHON [refresh]
+#        chef_venv.sh gc
+#
+# The base venv for the chef is VENVS_DIR/<hash> where <hash> is computed from
+# PYTHON and the contents of CHEF_ROOT_DIR/requirements.txt, so chefs with the
+# same requirements share the same venv and CHEF_ROOT_DIR/venv is a symlink to it.
+# Base venvs are installed from wheels in WHEELHOUSE_DIR without accessing PyPI
+# when all the wheels are there; otherwise missing wheels are built first.
+# With `refresh` the wheels are rebuilt from PyPI (to get the latest versions
+# of unpinned requirements) and the base venv is reinstalled.
+#
+# VENVS_DIR/<hash> is itself a symlink to a build VENVS_DIR/<hash>.<timestamp>.
+# A refresh installs a new build and then swaps the link atomically (rename),
+# so running chefs keep the build they were started with (its paths are in
+# their scripts and environment). With `gc`, the builds that are neither the
+# current build of a base venv used by a chef nor used by a running process
+# are deleted.
+# Prints a `RESULT {json}` line for the fab task to parse.
+set -e
+
+DATA_DIR=${DATA_DIR:-/data}
+WHEELHOUSE_DIR=$DATA_DIR/wheelhouse
+VENVS_DIR=$DATA_DIR/venvs
+START=$(date +%s)
+
+
+# GC
+################################################################################
+
+in_use() {
+    # the activate script of a build puts its bin dir in PATH of the chef processes
+    grep -qsF "$1/bin" /proc/[0-9]*/environ /proc/[0-9]*/cmdline
+}
+
+remove_build() {
+    if in_use "$1"; then
+        return
+    fi
+    freed_kb=$(( freed_kb + $(du -sk "$1" | cut -f1) ))
+    rm -rf "$1"
+    removed=$(( removed + 1 ))
+}
+
+if [ "$1" == "gc" ]; then
+    removed=0
+    freed_kb=0
+    used_venvs=$(find "$DATA_DIR" -mindepth 2 -maxdepth 3 -name venv -type l -exec readlink {} \; | sort -u)
+    shopt -s nullglob
+    for lock in "$VENVS_DIR"/*.lock; do
+        base_venv=${lock%.lock}
+        exec 9>"$lock"
+        if ! flock -n 9; then
+            continue    # being built or linked to a chef
+        fi
+        current_build=""
+        used=true
+        if ! grep -qxF "$base_venv" <<< "$used_venvs"; then
+            used=false
+            if in_use "$base_venv"; then
+                exec 9>&-
+                continue    # chef removed but still running
+            elif [ -L "$base_venv" ]; then
+                rm -f "$base_venv"
+            fi
+        elif [ -L "$base_venv" ]; then
+            current_build=$VENVS_DIR/$(readlink "$base_venv")
+        fi
+        for build in "$base_venv".[0-9]*; do
+            if [ -d "$build" ] && [ "$build" != "$current_build" ]; then
+                remove_build "$build"
+            fi
+        done
+        builds=("$base_venv".[0-9]*)
+        if [ "$used" == "false" ] && [ ${#builds[@]} -eq 0 ] && [ ! -e "$base_venv" ]; then
+            rm -f "$lock"
+        fi
+        exec 9>&-
+    done
+    echo "RESULT {\"removed\": $removed, \"freed_kb\": $freed_kb, \"seconds\": $(( $(date +%s) - START ))}"
+    exit 0
+fi
+
+
+
+# SETUP CHEF VENV
+################################################################################
+
+CHEF_ROOT_DIR=$1
+PYTHON=$2
+REFRESH=$3
+
+reqs_file=$CHEF_ROOT_DIR/requirements.txt
+reqs_hash=$( (echo "$PYTHON"; cat "$reqs_file") | sha256sum | cut -c1-16)
+base_venv=$VENVS_DIR/$reqs_hash
+chef_venv=$CHEF_ROOT_DIR/venv
+mkdir -p "$WHEELHOUSE_DIR" "$VENVS_DIR"
+
+# only one build per base venv at a time; other chefs with the same hash wait
+exec 9>"$base_venv.lock"
+flock 9
+
+action=unchanged
+if [ ! -f "$base_venv/.complete" ] || [ "$REFRESH" == "refresh" ]; then
+    build_venv=$base_venv.$(date +%Y%m%d%H%M%S)
+    rm -rf "$build_venv"
+    virtualenv --quiet -p "$PYTHON" "$build_venv"
+    pip="$build_venv/bin/pip"
+    if [ "$REFRESH" == "refresh" ] || \
+       ! "$pip" install --no-input --quiet --no-index --find-links "$WHEELHOUSE_DIR" -r "$reqs_file" 2>/dev/null; then
+        "$pip" wheel --no-input --quiet --find-links "$WHEELHOUSE_DIR" --wheel-dir "$WHEELHOUSE_DIR" -r "$reqs_file"
+        "$pip" install --no-input --quiet --no-index --find-links "$WHEELHOUSE_DIR" -r "$reqs_file"
+    fi
+    cp "$reqs_file" "$build_venv/requirements.txt"
+    touch "$build_venv/.complete"
+    ln -sfn "$(basename "$build_venv")" "$base_venv.new"
+    mv -T "$base_venv.new" "$base_venv"
+    action=built
+fi
+
+if [ "$(readlink "$chef_venv")" != "$base_venv" ]; then
+    rm -rf "$chef_venv"    # old per-chef venv or link to a base for other reqs
+    ln -s "$base_venv" "$chef_venv"
+    if [ "$action" == "unchanged" ]; then
+        action=linked
+    fi
+fi
+
+echo "RESULT {\"hash\": \"$reqs_hash\", \"action\": \"$action\", \"seconds\": $(( $(date +%s) - START ))}"
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Batch update of the chefs listed in a manifest, uploaded and run by the
+`batch_chefs` fab task (as root).
+
+For each chef the code is cloned (if missing) or fetched and reset to the branch,
+with at most `--git-workers` parallel git operations. As soon as the code of a
+chef is updated its venv is setup with the `--venv-script` (chef_venv.sh), with
+at most `--pip-workers` parallel installs.
+Prints one `RESULT {json}` line per chef for the fab task to parse.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+def run_cmd(cmd, cwd=None, user=None, env=None):
+    """
+    Run `cmd` (a list), as `user` if given, and return (returncode, output).
+    """
+    if user:
+        cmd = ['sudo', '-u', user, 'env', 'HOME=' + env['HOME'], 'DATA_DIR=' + env['DATA_DIR']] + cmd
+    process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode('utf-8', errors='replace')
+    return process.returncode, output
+
+
+def update_code(chef, args):
+    """
+    Clone the chef repo or fetch and reset it to `branch`. Returns (ok, message).
+    """
+    env = {'HOME': args.data_dir, 'DATA_DIR': args.data_dir}
+    repo_dir, branch = chef['repo_dir'], chef['branch']
+    if not os.path.exists(repo_dir):
+        rc, output = run_cmd(['git', 'clone', '--quiet', chef['github_url'], repo_dir])
+        if rc != 0:
+            return False, output
+        rc, output = run_cmd(['chown', '-R', '{}:{}'.format(args.chef_user, args.chef_user), repo_dir])
+        if rc != 0:
+            return False, output
+    else:
+        rc, output = run_cmd(['git', 'fetch', '--quiet', 'origin', branch],
+                             cwd=repo_dir, user=args.chef_user, env=env)
+        if rc != 0:
+            return False, output
+    for cmd in [['git', 'checkout', '--quiet', branch], ['git', 'reset', '--quiet', '--hard', 'origin/' + branch]]:
+        rc, output = run_cmd(cmd, cwd=repo_dir, user=args.chef_user, env=env)
+        if rc != 0:
+            return False, output
+    rc, output = run_cmd(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, user=args.chef_user, env=env)
+    return True, output.strip()
+
+
+def setup_venv(chef, args):
+    """
+    Run chef_venv.sh for the chef. Returns (ok, message).
+    """
+    env = {'HOME': args.data_dir, 'DATA_DIR': args.data_dir}
+    cmd = ['bash', args.venv_script, chef['chef_root_dir'], args.python]
+    if args.refresh:
+        cmd.append('refresh')
+    rc, output = run_cmd(cmd, cwd=chef['chef_root_dir'], user=args.chef_user, env=env)
+    if rc != 0:
+        return False, output
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            return True, json.loads(line[len('RESULT '):])['action']
+    return True, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--chef-user', required=True)
+    parser.add_argument('--venv-script', required=True)
+    parser.add_argument('--python', required=True)
+    parser.add_argument('--git-workers', type=int, default=8)
+    parser.add_argument('--pip-workers', type=int, default=3)
+    parser.add_argument('--refresh', action='store_true')
+    parser.add_argument('manifest', help='json list of chefs with repo_dir, chef_root_dir, github_url, branch')
+    args = parser.parse_args()
+
+    with open(args.manifest) as manifestf:
+        chefs = json.load(manifestf)
+    git_slots = threading.BoundedSemaphore(args.git_workers)
+    pip_slots = threading.BoundedSemaphore(args.pip_workers)
+
+    def update_chef(chef):
+        result = {'nickname': chef['nickname'], 'status': 'ok', 'commit': '', 'venv': '',
+                  'git_seconds': 0, 'venv_seconds': 0}
+        with git_slots:
+            start = time.time()
+            ok, message = update_code(chef, args)
+            result['git_seconds'] = time.time() - start
+        if not ok:
+            result.update({'status': 'failed git', 'error': message[-1000:]})
+            return result
+        result['commit'] = message
+        with pip_slots:
+            start = time.time()
+            ok, message = setup_venv(chef, args)
+            result['venv_seconds'] = time.time() - start
+        result['venv'] = message if ok else 'failed'
+        if not ok:
+            result.update({'status': 'failed venv', 'error': message[-1000:]})
+        return result
+
+    # one thread per chef, the slots limit the parallel git operations and installs
+    with ThreadPoolExecutor(max_workers=max(1, len(chefs))) as pool:
+        for result in pool.map(update_chef, chefs):
+            print('RESULT', json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Chef job queue for integration servers, uploaded and run by the `submit_chef`,
+`list_chef_jobs`, and `cancel_chef_job` fab tasks.
+
+Each job is a json file in QUEUE_DIR/jobs/. Submitted jobs wait in the queue
+until the scheduler admits them based on the CPU, memory, and disk budgets in
+QUEUE_DIR/config.json, and the resources requested by the job. Jobs are
+admitted in the order they were submitted. Each admitted job runs under an
+`exec` wrapper process that records its status, exit code, runtime, and the
+peak RSS of all the processes of the job.
+Prints one `RESULT {json}` line per job for the fab tasks to parse.
+"""
+import argparse
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+
+
+DEFAULT_MIN_FREE_DISK_GB = 20
+SCHEDULER_POLL_INTERVAL = 10   # sec between two admission checks
+RSS_POLL_INTERVAL = 5          # sec between two RSS samples of a running job
+STARTING_TIMEOUT = 120         # sec after which an admitted job that never started is lost
+FINAL_STATUSES = ['succeeded', 'failed', 'cancelled', 'lost']
+
+
+
+# JOB FILES
+################################################################################
+
+@contextmanager
+def queue_lock(queue_dir):
+    """
+    Lock held while reading and updating job files (and config.json).
+    """
+    with open(os.path.join(queue_dir, 'queue.lock'), 'a') as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def get_job_path(queue_dir, job_id):
+    return os.path.join(queue_dir, 'jobs', job_id + '.json')
+
+
+def read_job(queue_dir, job_id):
+    with open(get_job_path(queue_dir, job_id)) as jobf:
+        return json.load(jobf)
+
+
+def write_json(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # has tokens
+    with os.fdopen(fd, 'w') as tmpf:
+        json.dump(data, tmpf, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def update_job(queue_dir, job_id, **fields):
+    """
+    Update the `fields` of the job `job_id` and return the updated job.
+    """
+    with queue_lock(queue_dir):
+        job = read_job(queue_dir, job_id)
+        job.update(fields)
+        write_json(get_job_path(queue_dir, job_id), job)
+    return job
+
+
+def list_jobs(queue_dir):
+    jobs_dir = os.path.join(queue_dir, 'jobs')
+    jobs = []
+    for filename in sorted(os.listdir(jobs_dir)):
+        if filename.endswith('.json'):
+            try:
+                jobs.append(read_job(queue_dir, filename[:-len('.json')]))
+            except ValueError:
+                pass  # being written
+    return sorted(jobs, key=lambda job: job['submitted'])
+
+
+def read_config(queue_dir):
+    config_path = os.path.join(queue_dir, 'config.json')
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path) as configf:
+        return json.load(configf)
+
+
+def print_result(job):
+    print('RESULT', json.dumps(job))
+    sys.stdout.flush()
+
+
+
+# RESOURCE MEASUREMENTS
+################################################################################
+
+def get_meminfo_mb():
+    meminfo = {}
+    with open('/proc/meminfo') as meminfof:
+        for line in meminfof:
+            key, value = line.split(':', 1)
+            meminfo[key] = int(value.split()[0]) // 1024   # values are in kB
+    return meminfo
+
+
+def get_free_disk_gb(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize / 1024.0**3
+
+
+def get_budgets(queue_dir):
+    """
+    Budgets from config.json with defaults: all the CPUs, 80% of the RAM, and
+    DEFAULT_MIN_FREE_DISK_GB of free space left on the disk of the queue dir.
+    """
+    config = read_config(queue_dir)
+    return {
+        'cpus': config.get('max_cpus') or os.cpu_count(),
+        'mem_mb': config.get('max_mem_mb') or int(0.8 * get_meminfo_mb()['MemTotal']),
+        'min_free_disk_gb': config.get('min_free_disk_gb', DEFAULT_MIN_FREE_DISK_GB),
+    }
+
+
+def get_group_rss_kb(pgid):
+    """
+    Total RSS of all the processes in the process group `pgid`.
+    """
+    page_kb = resource.getpagesize() // 1024
+    total_kb = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid)) as statf:
+                stat = statf.read()
+            # fields after the `(comm)` field: state ppid pgrp ...
+            if int(stat.rsplit(')', 1)[1].split()[2]) != pgid:
+                continue
+            with open('/proc/{}/statm'.format(pid)) as statmf:
+                total_kb += int(statmf.read().split()[1]) * page_kb
+        except (IOError, OSError, IndexError, ValueError):
+            continue  # process exited while we were reading it
+    return total_kb
+
+
+def is_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+
+# COMMANDS
+################################################################################
+
+def submit(args):
+    with queue_lock(args.queue_dir):
+        config = read_config(args.queue_dir)
+        config.update({
+            'max_cpus': args.max_cpus,
+            'max_mem_mb': args.max_mem_mb,
+            'min_free_disk_gb': args.min_free_disk_gb,
+        })
+        write_json(os.path.join(args.queue_dir, 'config.json'), config)
+        # pid: jobs with the same name submitted in the same second get different ids
+        job_id = '{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), args.name, os.getpid())
+        job = {
+            'id': job_id,
+            'name': args.name,
+            'cwd': args.cwd,
+            'command': args.command,
+            'log': os.path.join(args.cwd, 'nohup.out'),
+            'cpus': args.cpus,
+            'mem_mb': args.mem_mb,
+            'disk_gb': args.disk_gb,
+            'status': 'queued',
+            'submitted': time.time(),
+            'admitted': None,
+            'started': None,
+            'ended': None,
+            'exit_code': None,
+            'pid': None,
+            'peak_rss_kb': 0,
+            'error': None,
+        }
+        write_json(get_job_path(args.queue_dir, job_id), job)
+    start_scheduler(args.queue_dir)
+    print_result(job)
+
+
+def start_scheduler(queue_dir):
+    # the new scheduler waits on scheduler.lock if another one is running
+    spawn(queue_dir, ['scheduler'], os.path.join(queue_dir, 'scheduler.log'))
+
+
+def spawn(queue_dir, cmd_args, log_path):
+    """
+    Start this script with `cmd_args` in a new session, so it keeps running
+    after the ssh session of the fab task that started it is closed.
+    """
+    with open(log_path, 'a') as logf:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--queue-dir', queue_dir] + cmd_args,
+            stdin=subprocess.DEVNULL, stdout=logf, stderr=subprocess.STDOUT,
+            start_new_session=True, close_fds=True,
+        )
+
+
+def scheduler(args):
+    """
+    Admit queued jobs while they fit in the budgets. Exits when the queue is empty.
+    """
+    with open(os.path.join(args.queue_dir, 'scheduler.lock'), 'a') as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        while True:
+            with queue_lock(args.queue_dir):
+                jobs = list_jobs(args.queue_dir)
+                for job in jobs:
+                    if job['status'] == 'running' and not is_alive(job['pid']) or \
+                            job['status'] == 'starting' and time.time() - job['admitted'] > STARTING_TIMEOUT:
+                        job.update({'status': 'lost', 'ended': time.time()})
+                        write_json(get_job_path(args.queue_dir, job['id']), job)
+                running = [job for job in jobs if job['status'] in ['starting', 'running']]
+                queued = [job for job in jobs if job['status'] == 'queued']
+                if not queued:
+                    return
+                job = queued[0]   # FIFO: jobs are never overtaken by later smaller jobs
+                reason = get_admission_blocker(args.queue_dir, job, running)
+                if reason is None:
+                    job.update({'status': 'starting', 'admitted': time.time()})
+                    write_json(get_job_path(args.queue_dir, job['id']), job)
+            if reason is None:
+                print(time.strftime('%c'), 'ADMIT', job['id'])
+                spawn(args.queue_dir, ['exec', job['id']], os.path.join(args.queue_dir, 'exec.log'))
+                time.sleep(1)
+            else:
+                print(time.strftime('%c'), 'WAIT', job['id'], reason)
+                time.sleep(SCHEDULER_POLL_INTERVAL)
+            sys.stdout.flush()
+
+
+def get_admission_blocker(queue_dir, job, running):
+    """
+    Returns the reason why `job` cannot start now, or None if it can start.
+    A job is always admitted when no other job is running, so jobs that request
+    more than the budgets still run eventually (alone).
+    """
+    budgets = get_budgets(queue_dir)
+    used_cpus = sum(rjob['cpus'] for rjob in running)
+    used_mem_mb = sum(rjob['mem_mb'] for rjob in running)
+    reserved_disk_gb = sum(rjob['disk_gb'] for rjob in running)
+    free_disk_gb = get_free_disk_gb(queue_dir) - reserved_disk_gb
+    if free_disk_gb - job['disk_gb'] < budgets['min_free_disk_gb']:
+        return 'disk: {:.1f}GB free after reservations'.format(free_disk_gb)
+    if not running:
+        return None
+    if used_cpus + job['cpus'] > budgets['cpus']:
+        return 'cpus: {} of {} in use'.format(used_cpus, budgets['cpus'])
+    if used_mem_mb + job['mem_mb'] > budgets['mem_mb']:
+        return 'mem: {}MB of {}MB reserved'.format(used_mem_mb, budgets['mem_mb'])
+    if get_meminfo_mb()['MemAvailable'] < job['mem_mb']:
+        return 'mem: only {}MB available'.format(get_meminfo_mb()['MemAvailable'])
+    return None
+
+
+def exec_job(args):
+    """
+    Run the job's command, sampling the RSS of its process group until it exits.
+    """
+    with queue_lock(args.queue_dir):
+        job = read_job(args.queue_dir, args.job_id)
+        if job['status'] != 'starting':
+            return   # cancelled after it was admitted
+        try:
+            with open(job['log'], 'a') as logf:
+                process = subprocess.Popen(
+                    ['bash', '-c', job['command']], cwd=job['cwd'],
+                    stdin=subprocess.DEVNULL, stdout=logf, stderr=subprocess.STDOUT,
+                    start_new_session=True,   # process group of the job = process.pid
+                )
+        except OSError as e:   # e.g., cwd removed since the job was submitted
+            job.update({'status': 'failed', 'ended': time.time(), 'error': str(e)})
+            write_json(get_job_path(args.queue_dir, args.job_id), job)
+            return
+        job.update({'status': 'running', 'pid': process.pid, 'started': time.time()})
+        write_json(get_job_path(args.queue_dir, args.job_id), job)
+    peak_rss_kb = 0
+    while process.poll() is None:
+        peak_rss_kb = max(peak_rss_kb, get_group_rss_kb(process.pid))
+        update_job(args.queue_dir, args.job_id, peak_rss_kb=peak_rss_kb)
+        time.sleep(RSS_POLL_INTERVAL)
+    peak_rss_kb = max(peak_rss_kb, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    with queue_lock(args.queue_dir):
+        job = read_job(args.queue_dir, args.job_id)
+        if job['status'] != 'cancelled':
+            job['status'] = 'succeeded' if process.returncode == 0 else 'failed'
+        job.update({'exit_code': process.returncode, 'ended': time.time(), 'peak_rss_kb': peak_rss_kb})
+        write_json(get_job_path(args.queue_dir, args.job_id), job)
+
+
+def cancel(args):
+    with queue_lock(args.queue_dir):
+        job = read_job(args.queue_dir, args.job_id)
+        if job['status'] in FINAL_STATUSES:
+            print_result(job)
+            return
+        if job['status'] == 'running':
+            try:
+                os.killpg(job['pid'], signal.SIGTERM)   # exec wrapper sets `ended`
+            except ProcessLookupError:
+                pass
+        else:
+            job['ended'] = time.time()   # queued or admitted but not yet started
+        job['status'] = 'cancelled'
+        write_json(get_job_path(args.queue_dir, args.job_id), job)
+    print_result(job)
+
+
+def list_cmd(args):
+    for job in list_jobs(args.queue_dir):
+        ended = job['ended'] or time.time()
+        if args.all or job['status'] not in FINAL_STATUSES or time.time() - ended < 24*60*60:
+            print_result(job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queue-dir', required=True)
+    subparsers = parser.add_subparsers(dest='command_name')
+
+    submit_parser = subparsers.add_parser('submit')
+    submit_parser.add_argument('--name', required=True)
+    submit_parser.add_argument('--cwd', required=True)
+    submit_parser.add_argument('--cpus', type=int, default=1)
+    submit_parser.add_argument('--mem-mb', type=int, default=2000)
+    submit_parser.add_argument('--disk-gb', type=int, default=5)
+    submit_parser.add_argument('--max-cpus', type=int, default=None)
+    submit_parser.add_argument('--max-mem-mb', type=int, default=None)
+    submit_parser.add_argument('--min-free-disk-gb', type=int, default=DEFAULT_MIN_FREE_DISK_GB)
+    submit_parser.add_argument('command', help='shell command to run in cwd')
+
+    list_parser = subparsers.add_parser('list')
+    list_parser.add_argument('--all', action='store_true', help='include old finished jobs')
+    cancel_parser = subparsers.add_parser('cancel')
+    cancel_parser.add_argument('job_id')
+    subparsers.add_parser('scheduler')
+    exec_parser = subparsers.add_parser('exec')
+    exec_parser.add_argument('job_id')
+
+    args = parser.parse_args()
+    os.makedirs(os.path.join(args.queue_dir, 'jobs'), exist_ok=True)
+    if args.command_name == 'submit':
+        submit(args)
+    elif args.command_name == 'list':
+        list_cmd(args)
+    elif args.command_name == 'cancel':
+        cancel(args)
+    elif args.command_name == 'scheduler':
+        scheduler(args)
+    elif args.command_name == 'exec':
+        exec_job(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
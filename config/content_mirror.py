@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Content mirror sync, uploaded and run by the `sync_content_mirror` fab task.
+
+Keeps a copy of the channels in `mirror_dir` laid out like Kolibri's content
+server, so that demoservers can import from it with `--baseurl`:
+  content/databases/{channel_id}.sqlite3     channel databases
+  content/storage/{c[0]}/{c[1]}/{c}.{ext}    files named by checksum (shared
+                                             by all channels, downloaded once)
+  lookup/{channel_id}                        Studio's channel lookup response
+Only channels whose Studio version differs from the mirrored version are
+synced. The files of a channel are downloaded (and their md5 verified) before
+its database and lookup response are replaced, so a demoserver never sees a
+version of a channel that is not completely mirrored.
+Prints one `RESULT {json}` line per channel for the fab task to parse.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+
+STUDIO_URL = 'https://studio.learningequality.org'
+LOOKUP_ENDPOINT = '/api/public/v1/channels/lookup/'
+
+print_lock = threading.Lock()
+
+
+def log(*args):
+    with print_lock:
+        print(*args)
+        sys.stdout.flush()
+
+
+def download(url, dest_path, md5=None):
+    """
+    Download `url` to `dest_path` (atomically), checking the `md5` if given.
+    Returns the number of bytes downloaded.
+    """
+    tmp_path = '{}.{}.tmp'.format(dest_path, threading.get_ident())
+    digest = hashlib.md5()
+    size = 0
+    try:
+        with urlopen(url, timeout=60) as response, open(tmp_path, 'wb') as tmpf:
+            for chunk in iter(lambda: response.read(1024*1024), b''):
+                digest.update(chunk)
+                tmpf.write(chunk)
+                size += len(chunk)
+        if md5 and digest.hexdigest() != md5:
+            raise ValueError('md5 mismatch for ' + url)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def get_storage_path(mirror_dir, filename):
+    return os.path.join(mirror_dir, 'content', 'storage', filename[0], filename[1], filename)
+
+
+def get_channel_files(db_path):
+    """
+    Returns the list of (checksum, extension, size) of the files of a channel.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT id, extension, file_size FROM content_localfile').fetchall()
+    finally:
+        conn.close()
+
+
+def get_mirrored_version(mirror_dir, channel_id):
+    lookup_path = os.path.join(mirror_dir, 'lookup', channel_id)
+    if not os.path.exists(lookup_path):
+        return None
+    with open(lookup_path) as lookupf:
+        channels = json.load(lookupf)
+    return channels[0]['version'] if channels else None
+
+
+def sync_channel(channel_id, args):
+    result = {
+        'channel_id': channel_id,
+        'old_version': get_mirrored_version(args.mirror_dir, channel_id),
+        'new_version': None,
+        'status': 'pending',
+        'files': 0,
+        'downloaded_files': 0,
+        'downloaded_bytes': 0,
+        'seconds': 0,
+        'error': '',
+    }
+    start = time.time()
+    try:
+        with urlopen(args.studio_url + LOOKUP_ENDPOINT + channel_id, timeout=30) as response:
+            lookup_data = response.read()
+        channels = json.loads(lookup_data.decode('utf-8'))
+        if not channels:
+            raise ValueError('channel not found on Studio')
+        result['new_version'] = channels[0]['version']
+        if result['new_version'] == result['old_version'] and not args.force:
+            result['status'] = 'unchanged'
+            return result
+
+        db_path = os.path.join(args.mirror_dir, 'content', 'databases', channel_id + '.sqlite3')
+        new_db_path = db_path + '.new'
+        download(args.studio_url + '/content/databases/' + channel_id + '.sqlite3', new_db_path)
+        files = get_channel_files(new_db_path)
+        result['files'] = len(files)
+        missing_files = []
+        for checksum, extension, size in files:
+            filename = checksum + '.' + extension
+            if not os.path.exists(get_storage_path(args.mirror_dir, filename)):
+                missing_files.append((filename, checksum))
+
+        def download_file(file_info):
+            filename, checksum = file_info
+            dest_path = get_storage_path(args.mirror_dir, filename)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            url = '{}/content/storage/{}/{}/{}'.format(args.studio_url, filename[0], filename[1], filename)
+            return download(url, dest_path, md5=checksum)
+
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for size in pool.map(download_file, missing_files):
+                result['downloaded_files'] += 1
+                result['downloaded_bytes'] += size
+
+        os.replace(new_db_path, db_path)
+        lookup_path = os.path.join(args.mirror_dir, 'lookup', channel_id)
+        with open(lookup_path + '.tmp', 'wb') as lookupf:
+            lookupf.write(lookup_data)
+        os.chmod(lookup_path + '.tmp', 0o644)
+        os.replace(lookup_path + '.tmp', lookup_path)
+        result['status'] = 'updated'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        result['seconds'] = time.time() - start
+    return result
+
+
+def prune_storage(mirror_dir):
+    """
+    Remove the files in storage not used by any of the mirrored channels.
+    Returns the number of files and bytes removed.
+    """
+    databases_dir = os.path.join(mirror_dir, 'content', 'databases')
+    used_filenames = set()
+    for db_filename in os.listdir(databases_dir):
+        if db_filename.endswith('.sqlite3'):
+            for checksum, extension, size in get_channel_files(os.path.join(databases_dir, db_filename)):
+                used_filenames.add(checksum + '.' + extension)
+    removed, removed_bytes = 0, 0
+    for dirpath, _, filenames in os.walk(os.path.join(mirror_dir, 'content', 'storage')):
+        for filename in filenames:
+            if filename not in used_filenames and not filename.endswith('.tmp'):
+                path = os.path.join(dirpath, filename)
+                removed_bytes += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+    return removed, removed_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mirror-dir', required=True)
+    parser.add_argument('--studio-url', default=STUDIO_URL)
+    parser.add_argument('--workers', type=int, default=8, help='parallel file downloads')
+    parser.add_argument('--force', action='store_true', help='sync even if at the same version')
+    parser.add_argument('--prune', action='store_true', help='remove files not used by any channel')
+    parser.add_argument('channel_ids', nargs='*')
+    args = parser.parse_args()
+    args.studio_url = args.studio_url.rstrip('/')
+    for subdir in [os.path.join('content', 'databases'), os.path.join('content', 'storage'), 'lookup']:
+        os.makedirs(os.path.join(args.mirror_dir, subdir), exist_ok=True)
+
+    for channel_id in args.channel_ids:
+        log('START', channel_id)
+        result = sync_channel(channel_id, args)
+        log('DONE', channel_id, result['status'])
+        log('RESULT', json.dumps(result))
+    if args.prune:
+        removed, removed_bytes = prune_storage(args.mirror_dir)
+        log('RESULT', json.dumps({'channel_id': 'PRUNE', 'removed_files': removed, 'removed_bytes': removed_bytes}))
+
+
+if __name__ == '__main__':
+    main()
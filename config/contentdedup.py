@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Content storage checker, uploaded and run (as root) by the `dedup_content` task.
+
+Kolibri stores content files by checksum (`content/storage/a/b/{md5}.{ext}`),
+so a file shared by channels of the same Kolibri home is stored once. This
+script builds an md5 index of the files in `--kolibri-storage` and in the
+other storage `roots` (in parallel, incrementally: files with the same size and
+mtime as in `--index-file` are not hashed again; the index is saved as it goes
+so an interrupted run resumes) and reports:
+  - corrupted files, whose md5 does not match the checksum in their name,
+  - duplicates, i.e., identical files with different inodes in several roots
+    (e.g., a second Kolibri home or a content mirror), hardlinked with `--link`,
+  - orphans, files of the Kolibri storage dir `--kolibri-storage` not used by
+    any channel of the Kolibri home `--kolibri-home`, deleted with
+    `--delete-orphans` (skipped if the storage dir or the database is missing).
+Prints `RESULT {json}` lines for the fab task to parse.
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+
+CHECKSUM_PAT = re.compile(r'^[0-9a-f]{32}$')
+INDEX_COMMIT_EVERY = 500   # files hashed between two saves of the index
+MAX_REPORTED = 50          # max corrupted files and duplicate groups printed
+
+
+
+# HASH INDEX
+################################################################################
+
+class HashIndex(object):
+    """
+    md5 of files by path, valid while the size and mtime of the file match.
+    """
+
+    def __init__(self, index_path):
+        self.conn = sqlite3.connect(index_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files '
+                          '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, md5 TEXT)')
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def get(self, path, stat):
+        row = self.conn.execute('SELECT size, mtime, md5 FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == int(stat.st_mtime):
+            return row[2]
+        return None
+
+    def put(self, path, stat, md5):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                              (path, stat.st_size, int(stat.st_mtime), md5))
+            self.pending += 1
+            if self.pending >= INDEX_COMMIT_EVERY:
+                self.conn.commit()
+                self.pending = 0
+
+    def remove_missing(self, roots, seen_paths):
+        """
+        Remove the files in `roots` that were not seen; files of other roots
+        (not scanned in this run) are kept.
+        """
+        for root in roots:
+            prefix = root.rstrip('/') + '/'
+            paths = [row[0] for row in self.conn.execute(
+                'SELECT path FROM files WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))]
+            for path in paths:
+                if path not in seen_paths:
+                    self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def scan_roots(roots, index, workers):
+    """
+    Returns the list of {'path', 'root', 'stat', 'md5'} for the files in `roots`
+    and the number of files hashed (the others were found in the index).
+    """
+    files = []
+    to_hash = []
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith(('.tmp', '.transfer')):
+                    continue   # download in progress (ours or Kolibri's)
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.lstat(path)
+                except OSError:
+                    continue
+                record = {'path': path, 'root': root, 'stat': stat, 'md5': index.get(path, stat)}
+                files.append(record)
+                if record['md5'] is None:
+                    to_hash.append(record)
+
+    def hash_file(record):
+        try:
+            record['md5'] = file_md5(record['path'])
+        except OSError:
+            return
+        index.put(record['path'], record['stat'], record['md5'])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(hash_file, to_hash))
+    index.remove_missing(roots, set(record['path'] for record in files))
+    return [record for record in files if record['md5']], len(to_hash)
+
+
+
+# CHECKS
+################################################################################
+
+def find_corrupted(files):
+    corrupted = []
+    for record in files:
+        checksum = os.path.splitext(os.path.basename(record['path']))[0]
+        if CHECKSUM_PAT.match(checksum) and checksum != record['md5']:
+            corrupted.append(record)
+    return corrupted
+
+
+def count_inodes(records):
+    return len(set((record['stat'].st_dev, record['stat'].st_ino) for record in records))
+
+
+def find_duplicates(files):
+    """
+    Returns the lists of records with the same md5 and more than one inode.
+    """
+    by_md5 = defaultdict(list)
+    for record in files:
+        by_md5[record['md5']].append(record)
+    return [records for records in by_md5.values() if count_inodes(records) > 1]
+
+
+def link_duplicates(groups):
+    """
+    Replace the duplicates by hardlinks to the first file of their group on the
+    same filesystem. Returns the number of files linked and the bytes saved.
+    """
+    linked, saved_bytes = 0, 0
+    for records in groups:
+        by_dev = defaultdict(list)
+        for record in records:
+            by_dev[record['stat'].st_dev].append(record)
+        for dev_records in by_dev.values():
+            dev_linked, dev_saved_bytes = link_to_first(dev_records)
+            linked += dev_linked
+            saved_bytes += dev_saved_bytes
+    return linked, saved_bytes
+
+
+def link_to_first(records):
+    """
+    Replace `records` (on the same filesystem) by hardlinks to the first one.
+    """
+    linked, saved_bytes = 0, 0
+    source = records[0]
+    for record in records[1:]:
+        if record['stat'].st_ino == source['stat'].st_ino:
+            continue
+        tmp_path = '{}.{}.tmp'.format(record['path'], os.getpid())
+        os.link(source['path'], tmp_path)
+        os.replace(tmp_path, record['path'])
+        if record['stat'].st_nlink == 1:
+            saved_bytes += record['stat'].st_size
+        linked += 1
+    return linked, saved_bytes
+
+
+def find_orphans(files, storage_root, kolibri_home):
+    """
+    Returns the records of the files in `storage_root` that are not an available
+    local file of any channel in the database of `kolibri_home`.
+    """
+    db_path = os.path.join(kolibri_home, 'db.sqlite3')
+    conn = sqlite3.connect('file:' + db_path + '?mode=ro', uri=True, timeout=30)
+    try:
+        used_filenames = set(checksum + '.' + extension for checksum, extension in conn.execute(
+            'SELECT id, extension FROM content_localfile WHERE available = 1'))
+    finally:
+        conn.close()
+    return [record for record in files
+            if record['root'] == storage_root and os.path.basename(record['path']) not in used_filenames]
+
+
+def print_result(result):
+    print('RESULT', json.dumps(result))
+    sys.stdout.flush()
+
+
+
+# MAIN
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--index-file', required=True)
+    parser.add_argument('--kolibri-home', default=None, help='find orphans of this Kolibri home')
+    parser.add_argument('--kolibri-storage', default=None, help='content storage dir of --kolibri-home')
+    parser.add_argument('--workers', type=int, default=4, help='parallel hashing')
+    parser.add_argument('--link', action='store_true', help='hardlink duplicates')
+    parser.add_argument('--delete-orphans', action='store_true')
+    parser.add_argument('roots', nargs='*', help='other content storage dirs')
+    args = parser.parse_args()
+    roots = [os.path.abspath(root) for root in args.roots if os.path.isdir(root)]
+    kolibri_storage = None
+    if args.kolibri_storage and os.path.isdir(args.kolibri_storage):
+        if os.path.abspath(args.kolibri_storage) not in roots:
+            roots.insert(0, os.path.abspath(args.kolibri_storage))
+        if args.kolibri_home and os.path.exists(os.path.join(args.kolibri_home, 'db.sqlite3')):
+            kolibri_storage = os.path.abspath(args.kolibri_storage)   # check its orphans
+
+    start = time.time()
+    index = HashIndex(args.index_file)
+    try:
+        files, hashed = scan_roots(roots, index, args.workers)
+    finally:
+        index.close()
+
+    corrupted = find_corrupted(files)
+    for record in corrupted[0:MAX_REPORTED]:
+        print_result({'type': 'corrupted', 'path': record['path'], 'md5': record['md5']})
+    groups = find_duplicates(files)
+    for records in sorted(groups, key=lambda records: -records[0]['stat'].st_size)[0:MAX_REPORTED]:
+        print_result({'type': 'duplicate', 'size': records[0]['stat'].st_size,
+                      'paths': [record['path'] for record in records]})
+    linked, saved_bytes = link_duplicates(groups) if args.link else (0, 0)
+
+    orphans = []
+    if kolibri_storage:
+        orphans = find_orphans(files, kolibri_storage, args.kolibri_home)
+        if args.delete_orphans:
+            for record in orphans:
+                os.remove(record['path'])
+
+    print_result({
+        'type': 'summary',
+        'files': len(files),
+        'bytes': sum(record['stat'].st_size for record in files),
+        'hashed': hashed,
+        'corrupted': len(corrupted),
+        'duplicate_groups': len(groups),
+        'duplicate_bytes': sum(records[0]['stat'].st_size * (count_inodes(records) - 1) for records in groups),
+        'linked': linked,
+        'saved_bytes': saved_bytes,
+        'orphans': len(orphans),
+        'orphan_bytes': sum(record['stat'].st_size for record in orphans),
+        'orphans_checked': kolibri_storage is not None,
+        'orphans_deleted': args.delete_orphans and kolibri_storage is not None,
+        'seconds': time.time() - start,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Disk usage indexer, uploaded and run (as root) by the `collect_disk_index` task.
+
+Walks each root dir once and computes the total size and number of files of
+every directory below it. Sizes are disk usage (allocated blocks), and files
+with several hardlinks count for size/nlinks in each of their directories, so
+that hardlinked caches are not counted twice.
+
+The per-directory sizes are kept in `--cache-file` so that the next runs are
+incremental: a directory whose mtime did not change has the same files and
+subdirs, so only its recently modified ("active") files and its files with
+several hardlinks (whose share changes when links are added or removed in other
+directories) are stat'ed again. When a file gains hardlinks while it was cached
+as a single link, the root is rescanned fully. Files that grow in place after
+being inactive for `--active-days` are picked up by the full rescan done every
+`--full-every-days` days.
+
+For Kolibri homes (with a db.sqlite3), the size of the available content files
+of each channel is computed from the `content_localfile` table.
+Prints one `RESULT {base64 gzipped json}` line per root, with the sizes of the
+directories at most `--depth` levels below the root.
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import sqlite3
+import stat as stat_module
+import sys
+import time
+
+
+CHANNEL_SIZES_QUERY = """
+SELECT channel_files.channel_id, channel.name, COUNT(localfile.id), SUM(localfile.file_size)
+FROM (SELECT DISTINCT node.channel_id, file.local_file_id
+      FROM content_file file JOIN content_contentnode node ON file.contentnode_id = node.id
+     ) channel_files
+JOIN content_localfile localfile ON localfile.id = channel_files.local_file_id
+LEFT JOIN content_channelmetadata channel ON channel.id = channel_files.channel_id
+WHERE localfile.available = 1
+GROUP BY channel_files.channel_id, channel.name
+"""
+
+
+
+# DIRECTORY SCANNING
+################################################################################
+
+class DiskIndexer(object):
+
+    def __init__(self, cache, full, active_seconds, known_links):
+        self.cache = cache
+        self.new_cache = {}
+        self.full = full
+        self.active_seconds = active_seconds
+        self.known_links = known_links    # inodes with several links in the last run
+        self.links = {}                   # inode --> [nlink, links seen] in this run
+        self.now = time.time()
+        self.scanned_dirs = 0
+        self.cached_dirs = 0
+
+    def file_usage(self, stat):
+        return stat.st_blocks * 512 / max(stat.st_nlink, 1)
+
+    def add_link(self, stat):
+        inode = '{}:{}'.format(stat.st_dev, stat.st_ino)
+        self.links.setdefault(inode, [stat.st_nlink, 0])[1] += 1
+
+    def has_new_links(self):
+        """
+        True if an inode has links that were not seen in this run, and that was
+        not hardlinked in the last run: the other links may be files cached as
+        single links in `static_bytes`.
+        """
+        return any(seen < nlink and inode not in self.known_links
+                   for inode, (nlink, seen) in self.links.items())
+
+    def scan(self, path, depth, max_depth, sizes, root):
+        """
+        Returns the (bytes, files) totals of `path` and adds the totals of the
+        directories at most `max_depth` levels below `root` to `sizes`.
+        """
+        try:
+            dir_stat = os.lstat(path)
+        except OSError:
+            return 0, 0
+        entry = self.cache.get(path)
+        if entry and not self.full and entry['mtime'] == dir_stat.st_mtime:
+            self.cached_dirs += 1
+            own_bytes, own_files = entry['static_bytes'], entry['static_files']
+            active, linked = {}, {}
+            for names, usages in [(entry['active'], active), (entry['linked'], linked)]:
+                for name in names:
+                    try:
+                        file_stat = os.lstat(os.path.join(path, name))
+                    except OSError:
+                        continue
+                    usages[name] = self.file_usage(file_stat)
+                    if file_stat.st_nlink > 1:
+                        self.add_link(file_stat)
+            subdirs = entry['subdirs']
+        else:
+            self.scanned_dirs += 1
+            own_bytes, own_files = 0, 0
+            active, linked, subdirs = {}, {}, []
+            try:
+                dir_entries = list(os.scandir(path))
+            except OSError:
+                dir_entries = []
+            for dir_entry in dir_entries:
+                try:
+                    file_stat = dir_entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat_module.S_ISDIR(file_stat.st_mode):
+                    subdirs.append(dir_entry.name)
+                    continue
+                if file_stat.st_nlink > 1:
+                    self.add_link(file_stat)
+                if self.now - file_stat.st_mtime < self.active_seconds:
+                    active[dir_entry.name] = self.file_usage(file_stat)
+                elif file_stat.st_nlink > 1:
+                    linked[dir_entry.name] = self.file_usage(file_stat)
+                else:
+                    own_bytes += self.file_usage(file_stat)
+                    own_files += 1
+        self.new_cache[path] = {
+            'mtime': dir_stat.st_mtime,
+            'static_bytes': own_bytes,
+            'static_files': own_files,
+            'active': sorted(active.keys()),
+            'linked': sorted(linked.keys()),
+            'subdirs': subdirs,
+        }
+        total_bytes = own_bytes + sum(active.values()) + sum(linked.values())
+        total_files = own_files + len(active) + len(linked)
+        for subdir in subdirs:
+            sub_bytes, sub_files = self.scan(os.path.join(path, subdir), depth + 1, max_depth, sizes, root)
+            total_bytes += sub_bytes
+            total_files += sub_files
+        if depth <= max_depth:
+            sizes[os.path.relpath(path, root)] = [int(total_bytes), total_files]
+        return total_bytes, total_files
+
+
+def get_channel_sizes(kolibri_home):
+    """
+    Returns a list of [channel_id, name, files, bytes] for the channels imported
+    in the Kolibri home `kolibri_home` (files shared by channels count in each).
+    """
+    db_path = os.path.join(kolibri_home, 'db.sqlite3')
+    if not os.path.exists(db_path):
+        return []
+    try:
+        conn = sqlite3.connect('file:' + db_path + '?mode=ro', uri=True, timeout=10)
+        rows = conn.execute(CHANNEL_SIZES_QUERY).fetchall()
+        conn.close()
+    except sqlite3.Error as e:
+        print('Could not read channel sizes from', db_path, e)
+        return []
+    return [[channel_id, name or '', files, size or 0] for channel_id, name, files, size in rows]
+
+
+
+# MAIN
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cache-file', required=True)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--active-days', type=float, default=1)
+    parser.add_argument('--full-every-days', type=float, default=7)
+    parser.add_argument('--full', action='store_true')
+    parser.add_argument('roots', nargs='+')
+    args = parser.parse_args()
+
+    cache = {'full_scan': 0, 'dirs': {}, 'links': []}
+    if os.path.exists(args.cache_file):
+        try:
+            with open(args.cache_file) as cachef:
+                cache = json.load(cachef)
+        except ValueError:
+            pass   # corrupted cache = full scan
+    full = args.full or time.time() - cache['full_scan'] > args.full_every_days * 24 * 3600
+    indexer = DiskIndexer(cache['dirs'], full, args.active_days * 24 * 3600, set(cache['links']))
+    links = {}
+
+    for root in args.roots:
+        if not os.path.isdir(root):
+            continue
+        start = time.time()
+        scanned_dirs, cached_dirs = indexer.scanned_dirs, indexer.cached_dirs
+        sizes = {}
+        indexer.links = {}
+        total_bytes, total_files = indexer.scan(root, 0, args.depth, sizes, root)
+        root_full = full
+        if not full and indexer.has_new_links():
+            indexer.full, root_full = True, True
+            sizes = {}
+            indexer.links = {}
+            total_bytes, total_files = indexer.scan(root, 0, args.depth, sizes, root)
+            indexer.full = False
+        links.update(indexer.links)
+        summary = {
+            'root': root,
+            'bytes': int(total_bytes),
+            'files': total_files,
+            'dirs': sizes,
+            'channels': get_channel_sizes(root),
+            'full': root_full,
+            'scanned_dirs': indexer.scanned_dirs - scanned_dirs,
+            'cached_dirs': indexer.cached_dirs - cached_dirs,
+            'seconds': time.time() - start,
+        }
+        data = base64.b64encode(gzip.compress(json.dumps(summary).encode('utf-8'))).decode('ascii')
+        print('RESULT', data)
+        sys.stdout.flush()
+
+    new_cache = {
+        'full_scan': time.time() if full else cache['full_scan'],
+        'dirs': indexer.new_cache,
+        'links': sorted(links.keys()),
+    }
+    tmp_path = args.cache_file + '.tmp'
+    with open(tmp_path, 'w') as cachef:
+        json.dump(new_cache, cachef)
+    os.replace(tmp_path, args.cache_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Import scheduler for Kolibri channels, uploaded and run by `fab import_channels`.
+
+Runs `importchannel network` (metadata) for several channels in parallel, and
+starts `importcontent network` for each channel as soon as its metadata import
+finishes, with a separate concurrency cap for the content downloads.
+Channels already imported at the current Studio version are skipped, if their
+last content import succeeded (recorded in KOLIBRI_HOME/import_state/).
+With `--baseurl` (a content mirror), channels missing on the mirror, or at
+another version than on Studio (stale mirror), are imported from Studio.
+Prints one `RESULT {json}` line per channel for the fab task to parse.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+
+STUDIO_URL = 'https://studio.learningequality.org'
+LOOKUP_ENDPOINT = '/api/public/v1/channels/lookup/'
+
+print_lock = threading.Lock()
+
+
+def log(*args):
+    with print_lock:
+        print(*args)
+        sys.stdout.flush()
+
+
+def get_local_version(kolibri_home, channel_id):
+    """
+    Version of the channel in the Kolibri database, or None if not imported.
+    """
+    db_path = os.path.join(kolibri_home, 'db.sqlite3')
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        row = conn.execute(
+            'SELECT version FROM content_channelmetadata WHERE id = ?',
+            (channel_id.replace('-', ''),)).fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def get_imported_version(kolibri_home, channel_id):
+    """
+    Version of the channel at its last successful `importcontent`, or None.
+    """
+    state_path = os.path.join(kolibri_home, 'import_state', channel_id + '.json')
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as statef:
+        return json.load(statef)['version']
+
+
+def save_imported_version(kolibri_home, channel_id, version):
+    state_dir = os.path.join(kolibri_home, 'import_state')
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, channel_id + '.json')
+    with open(state_path + '.tmp', 'w') as statef:
+        json.dump({'version': version, 'timestamp': time.time()}, statef)
+    os.replace(state_path + '.tmp', state_path)
+
+
+def get_remote_version(baseurl, channel_id):
+    try:
+        with urlopen(baseurl.rstrip('/') + LOOKUP_ENDPOINT + channel_id, timeout=30) as response:
+            channels = json.loads(response.read().decode('utf-8'))
+        return channels[0]['version'] if channels else None
+    except Exception:
+        return None   # unknown version = channel will be imported
+
+
+def get_channel_size(kolibri_home, channel_id):
+    """
+    Total size of the files of the channel from its content database.
+    """
+    db_path = os.path.join(kolibri_home, 'content', 'databases', channel_id + '.sqlite3')
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('SELECT SUM(file_size) FROM content_localfile').fetchone()
+    except sqlite3.Error:
+        row = None
+    finally:
+        conn.close()
+    if row is None or row[0] is None:
+        return 0
+    return row[0]
+
+
+def run_manage(args, phase, channel_id, baseurl=None):
+    """
+    Run `importchannel` or `importcontent` for `channel_id` from `baseurl` (None
+    for Studio) and return (rc, elapsed).
+    Output goes to a per-channel log file in KOLIBRI_HOME/import_logs.
+    """
+    log_dir = os.path.join(args.kolibri_home, 'import_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, '{}.{}.log'.format(channel_id, phase))
+    cmd = [args.python, args.pex, 'manage', phase, 'network']
+    if baseurl:
+        cmd += ['--baseurl', baseurl]
+    cmd.append(channel_id)
+    env = dict(os.environ, KOLIBRI_HOME=args.kolibri_home)
+    start = time.time()
+    for attempt in range(args.retries + 1):
+        with open(log_path, 'a') as logf:
+            rc = subprocess.call(cmd, stdout=logf, stderr=subprocess.STDOUT, env=env)
+        if rc == 0:
+            break
+        log('RETRY', phase, channel_id, 'rc={}'.format(rc))
+    return rc, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--kolibri-home', required=True)
+    parser.add_argument('--pex', required=True)
+    parser.add_argument('--python', default='python')
+    parser.add_argument('--baseurl', default=None, help='import from this server instead of Studio')
+    parser.add_argument('--metadata-workers', type=int, required=True)
+    parser.add_argument('--content-workers', type=int, required=True)
+    parser.add_argument('--retries', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='import even if at latest version')
+    parser.add_argument('channel_ids', nargs='+')
+    args = parser.parse_args()
+
+    results = {}
+    content_pool = ThreadPoolExecutor(max_workers=args.content_workers)
+    content_futures = []
+
+    def import_content(channel_id):
+        result = results[channel_id]
+        log('START content', channel_id)
+        rc, elapsed = run_manage(args, 'importcontent', channel_id, result['baseurl'])
+        result['content_seconds'] = elapsed
+        result['size'] = get_channel_size(args.kolibri_home, channel_id)
+        result['status'] = 'imported' if rc == 0 else 'failed content'
+        if rc == 0:
+            save_imported_version(args.kolibri_home, channel_id, get_local_version(args.kolibri_home, channel_id))
+        log('DONE content', channel_id, 'rc={}'.format(rc), '{:.0f}s'.format(elapsed))
+
+    def import_metadata(channel_id):
+        result = results[channel_id]
+        log('START metadata', channel_id)
+        rc, elapsed = run_manage(args, 'importchannel', channel_id, result['baseurl'])
+        result['metadata_seconds'] = elapsed
+        log('DONE metadata', channel_id, 'rc={}'.format(rc), '{:.0f}s'.format(elapsed))
+        if rc != 0:
+            result['status'] = 'failed metadata'
+            return
+        content_futures.append(content_pool.submit(import_content, channel_id))
+
+    channels_to_import = []
+    for channel_id in args.channel_ids:
+        local_version = get_local_version(args.kolibri_home, channel_id)
+        remote_version = get_remote_version(STUDIO_URL, channel_id)
+        baseurl = args.baseurl
+        mirror_version = get_remote_version(baseurl, channel_id) if baseurl else None
+        if mirror_version is None:
+            baseurl = None   # not on the mirror
+        elif remote_version is not None and mirror_version != remote_version:
+            baseurl = None   # stale mirror
+            log('WARNING', channel_id, 'is at version', mirror_version, 'on the mirror and',
+                remote_version, 'on Studio, importing from Studio')
+        results[channel_id] = {
+            'channel_id': channel_id,
+            'baseurl': baseurl,
+            'local_version': local_version,
+            'remote_version': remote_version,
+            'mirror_version': mirror_version,
+            'status': 'pending',
+            'metadata_seconds': 0,
+            'content_seconds': 0,
+            'size': 0,
+        }
+        # the metadata version is updated by `importchannel` even if the content
+        # import fails afterwards, so also require a successful content import
+        imported_version = get_imported_version(args.kolibri_home, channel_id)
+        up_to_date = local_version is not None and local_version == remote_version == imported_version
+        if up_to_date and not args.force:
+            results[channel_id]['status'] = 'skipped'
+            log('SKIP', channel_id, 'already at version', local_version)
+        else:
+            channels_to_import.append(channel_id)
+
+    with ThreadPoolExecutor(max_workers=args.metadata_workers) as metadata_pool:
+        list(metadata_pool.map(import_metadata, channels_to_import))
+    # all content jobs have been submitted once the metadata pool is done
+    for future in content_futures:
+        future.result()
+    content_pool.shutdown()
+
+    for channel_id in args.channel_ids:
+        log('RESULT', json.dumps(results[channel_id]))
+    failed = [r for r in results.values() if r['status'].startswith('failed')]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
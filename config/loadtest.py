@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+HTTP load test, uploaded and run by the `benchmark_nginx` fab task on the demo
+server itself, so that it measures nginx and Kolibri rather than the network.
+
+Runs `--requests` GET requests with `--concurrency` threads (one keep-alive
+connection each) for each test:
+  - content: up to 20 files of `--storage-dir` spread over the sizes between
+    `--min-size` and `--max-size` (round robin); files larger than `--max-size`
+    (e.g., videos) are requested with a `Range` of the first `--max-size` bytes,
+  - api: each of the `--api-paths`.
+Response bodies are read in chunks and discarded, so memory use stays small.
+Prints one `RESULT {json}` line per test with the throughput and latencies.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+
+MAX_CONTENT_FILES = 20
+READ_CHUNK_SIZE = 64*1024
+
+
+def pick_content_paths(storage_dir, min_size, max_size):
+    """
+    Returns (url path, use range) for MAX_CONTENT_FILES files of at least
+    `min_size` bytes, evenly spaced in the list of files sorted by size (so they
+    are representative of the sizes in storage), where `use range` is True for
+    the files larger than `max_size`.
+    """
+    files = []
+    for dirpath, _, filenames in os.walk(storage_dir):
+        for filename in filenames:
+            if filename.endswith(('.tmp', '.transfer')):
+                continue
+            try:
+                size = os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if size >= min_size:
+                files.append((size, dirpath, filename))
+    files.sort()
+    step = max(1, len(files) // MAX_CONTENT_FILES)
+    paths = []
+    for size, dirpath, filename in files[::step][0:MAX_CONTENT_FILES]:
+        relpath = os.path.relpath(os.path.join(dirpath, filename), storage_dir)
+        paths.append(('/content/storage/' + relpath.replace(os.sep, '/'), size > max_size))
+    return paths
+
+
+def read_and_discard(response):
+    nbytes = 0
+    for chunk in iter(lambda: response.read(READ_CHUNK_SIZE), b''):
+        nbytes += len(chunk)
+    return nbytes
+
+
+def run_test(name, paths, args):
+    local = threading.local()
+    latencies = []
+    counters = {'errors': 0, 'bytes': 0, 'cache_hits': 0}
+    lock = threading.Lock()
+
+    def do_request(i):
+        if not hasattr(local, 'conn'):
+            local.conn = http.client.HTTPConnection(args.host, args.port, timeout=60)
+        path, use_range = paths[i % len(paths)]
+        headers = {'Host': args.host_header, 'Accept-Encoding': 'gzip'}
+        if use_range:
+            headers['Range'] = 'bytes=0-{}'.format(args.max_size - 1)
+        start = time.time()
+        try:
+            local.conn.request('GET', path, headers=headers)
+            response = local.conn.getresponse()
+            nbytes = read_and_discard(response)
+            ok = response.status in [200, 206]
+            cache_hit = response.getheader('X-Cache-Status') == 'HIT'
+        except (OSError, http.client.HTTPException):
+            local.conn.close()
+            del local.conn
+            ok, nbytes, cache_hit = False, 0, False
+        elapsed = time.time() - start
+        with lock:
+            latencies.append(elapsed)
+            counters['bytes'] += nbytes
+            counters['errors'] += 0 if ok else 1
+            counters['cache_hits'] += 1 if cache_hit else 0
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(do_request, range(args.requests)))
+    seconds = time.time() - start
+    latencies.sort()
+
+    def percentile(percent):
+        return latencies[min(int(len(latencies) * percent / 100.0), len(latencies) - 1)]
+
+    return {
+        'test': name,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'errors': counters['errors'],
+        'cache_hits': counters['cache_hits'],
+        'seconds': seconds,
+        'rps': args.requests / seconds,
+        'mb_per_sec': counters['bytes'] / 1024.0 / 1024.0 / seconds,
+        'p50_ms': percentile(50) * 1000,
+        'p90_ms': percentile(90) * 1000,
+        'p99_ms': percentile(99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--host-header', required=True, help='server_name of the nginx site')
+    parser.add_argument('--storage-dir', required=True)
+    parser.add_argument('--api-paths', nargs='+', default=['/api/public/v1/channels', '/api/public/info/'])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--min-size', type=int, default=100*1024, help='skip smaller content files')
+    parser.add_argument('--max-size', type=int, default=8*1024*1024, help='bytes read from larger files')
+    args = parser.parse_args()
+
+    content_paths = pick_content_paths(args.storage_dir, args.min_size, args.max_size)
+    if content_paths:
+        print('RESULT', json.dumps(run_test('content', content_paths, args)))
+    for api_path in args.api_paths:
+        print('RESULT', json.dumps(run_test('api ' + api_path, [(api_path, False)], args)))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Incremental log reader, uploaded and run by the `tail_chef` fab task.
+
+For each `path=inode:offset` argument, reads the bytes of the log `path` added
+after `offset` (at most `--max-bytes`), up to the last complete line. The read
+starts over from the beginning of the file if its inode changed or if it was
+truncated, and from `--initial-bytes` before the end for logs not seen before
+(inode 0). Prints one `RESULT {json}` line per log with the new bytes gzipped
+and base64-encoded, so that a log line is transferred only once.
+"""
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+
+
+def read_new_bytes(path, inode, offset, max_bytes, initial_bytes):
+    result = {
+        'path': path,
+        'inode': 0,
+        'size': 0,
+        'start': 0,
+        'end': 0,
+        'reset': False,
+        'data': '',
+        'error': '',
+    }
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        result['error'] = str(e)
+        return result
+    result['inode'] = stat.st_ino
+    result['size'] = stat.st_size
+    if inode == 0:
+        offset = max(0, stat.st_size - initial_bytes)
+    elif inode != stat.st_ino or stat.st_size < offset:
+        offset = 0           # log rotated or truncated (chef restarted)
+        result['reset'] = True
+    with open(path, 'rb') as logf:
+        logf.seek(offset)
+        if inode == 0 and offset > 0:
+            logf.readline()  # skip to the first complete line
+            offset = logf.tell()
+        chunk = logf.read(max_bytes)
+    last_newline = chunk.rfind(b'\n')
+    if last_newline >= 0:
+        chunk = chunk[:last_newline + 1]
+    elif len(chunk) < max_bytes:
+        chunk = b''          # wait for the rest of the line
+    result['start'] = offset
+    result['end'] = offset + len(chunk)
+    result['data'] = base64.b64encode(gzip.compress(chunk)).decode('ascii')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max-bytes', type=int, default=8*1024*1024)
+    parser.add_argument('--initial-bytes', type=int, default=64*1024)
+    parser.add_argument('logs', nargs='+', help='path=inode:offset')
+    args = parser.parse_args()
+    for log_arg in args.logs:
+        path, _, position = log_arg.rpartition('=')
+        inode, _, offset = position.partition(':')
+        result = read_new_bytes(path, int(inode), int(offset), args.max_bytes, args.initial_bytes)
+        print('RESULT', json.dumps(result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
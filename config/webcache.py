@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Web cache manager for the chefs on integration servers, uploaded and run by the
+`run_chef` (webcache=clear|warm), `webcache_stats`, and `prune_webcache` tasks.
+
+Chefs cache the HTTP responses they get in `{chef_dir}/.webcache` (cachecontrol's
+FileCache), where each response is stored in a file named after a hash of the
+URL. The same relative path in two chefs' caches is therefore the same URL, so
+  - identical responses are hardlinked to the shared store STORE_DIR,
+  - warm starts link the store entries into a chef's (empty or old) cache,
+  - least recently used entries are removed from all the caches to keep the
+    total size (counting hardlinked files once) under the budget.
+Prints `RESULT {json}` lines for the fab tasks to parse.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+
+WEBCACHE_DIRNAME = '.webcache'
+STORE_OWNER = 'STORE'
+
+
+
+# CACHE SCANNING
+################################################################################
+
+def find_chef_caches(data_dir, store_dir):
+    """
+    Returns {chef_name: cache_dir} for the `.webcache` dirs in the chef repos
+    in `data_dir` or in their subdirectories (for chefs that run with cwd).
+    """
+    caches = {}
+    for entry in os.scandir(data_dir):
+        if not entry.is_dir(follow_symlinks=False) or entry.path == store_dir:
+            continue
+        candidates = [entry.path]
+        try:
+            candidates += [sub.path for sub in os.scandir(entry.path)
+                           if sub.is_dir(follow_symlinks=False) and not sub.name.startswith('.')]
+        except OSError:
+            continue
+        for candidate in candidates:
+            cache_dir = os.path.join(candidate, WEBCACHE_DIRNAME)
+            if os.path.isdir(cache_dir):
+                caches[os.path.relpath(candidate, data_dir)] = cache_dir
+    return caches
+
+
+def walk_cache(cache_dir):
+    """
+    Yield `(key, path, stat)` for the entries in `cache_dir`, where `key` is the
+    path relative to `cache_dir` (the same for the same URL in all caches).
+    """
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith(('.lock', '.tmp')):
+                continue  # cachecontrol locks and our links of writes in progress
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            yield os.path.relpath(path, cache_dir), path, stat
+
+
+def scan_all(data_dir, store_dir):
+    """
+    Returns `(caches, inodes)` where `caches` is {owner: cache_dir} including the
+    store, and `inodes` is {inode: {'size', 'last_used', 'paths', 'owners'}}.
+    """
+    caches = find_chef_caches(data_dir, store_dir)
+    caches[STORE_OWNER] = store_dir
+    inodes = {}
+    for owner, cache_dir in caches.items():
+        for key, path, stat in walk_cache(cache_dir):
+            info = inodes.setdefault(stat.st_ino, {
+                'size': stat.st_size,
+                'last_used': 0,
+                'paths': [],
+                'owners': set(),
+            })
+            info['last_used'] = max(info['last_used'], stat.st_atime, stat.st_mtime)
+            info['paths'].append(path)
+            info['owners'].add(owner)
+    return caches, inodes
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(chunk)
+    try:
+        os.utime(path, (stat.st_atime, stat.st_mtime))  # reading is not a cache use
+    except OSError:
+        pass
+    return sha1.hexdigest()
+
+
+def link(src, dest):
+    """
+    Atomically replace `dest` with a hardlink to `src`.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(dest, os.getpid())
+    os.link(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+
+# COMMANDS
+################################################################################
+
+def share(caches, store_dir):
+    """
+    Hardlink the entries of the chef caches to the store, or to the store entry
+    when it has the same content. The store keeps the most recent response.
+    Returns the number of entries linked and the bytes saved.
+    """
+    linked, saved_bytes = 0, 0
+    for owner, cache_dir in sorted(caches.items()):
+        if owner == STORE_OWNER:
+            continue
+        for key, path, stat in walk_cache(cache_dir):
+            store_path = os.path.join(store_dir, key)
+            try:
+                store_stat = os.lstat(store_path)
+            except OSError:
+                link(path, store_path)     # first chef to fetch this URL
+                continue
+            if store_stat.st_ino == stat.st_ino:
+                continue
+            if store_stat.st_size == stat.st_size and file_digest(store_path) == file_digest(path):
+                link(store_path, path)
+                linked += 1
+                saved_bytes += stat.st_size
+            elif stat.st_mtime > store_stat.st_mtime:
+                link(path, store_path)     # newer response for the same URL
+    return linked, saved_bytes
+
+
+def evict(inodes, budget_bytes):
+    """
+    Remove the least recently used entries (all their hardlinks) until the total
+    size is under `budget_bytes`. Returns the number of entries and bytes removed.
+    """
+    total = sum(info['size'] for info in inodes.values())
+    removed, freed_bytes = 0, 0
+    for inode, info in sorted(inodes.items(), key=lambda item: item[1]['last_used']):
+        if total <= budget_bytes:
+            break
+        for path in info['paths']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= info['size']
+        removed += 1
+        freed_bytes += info['size']
+        del inodes[inode]
+    return removed, freed_bytes
+
+
+def prune_cmd(args):
+    caches, _ = scan_all(args.data_dir, args.store_dir)
+    linked, saved_bytes = share(caches, args.store_dir)
+    caches, inodes = scan_all(args.data_dir, args.store_dir)   # rescan after linking
+    removed, freed_bytes = evict(inodes, args.budget_gb * 1024**3)
+    print_result({
+        'linked': linked,
+        'saved_bytes': saved_bytes,
+        'removed': removed,
+        'freed_bytes': freed_bytes,
+        'total_bytes': sum(info['size'] for info in inodes.values()),
+        'budget_bytes': args.budget_gb * 1024**3,
+    })
+
+
+def prepare_cmd(args):
+    """
+    Prune the caches, then clear or warm the cache of the chef in `chef_dir`.
+    """
+    prune_cmd(args)
+    cache_dir = os.path.join(args.chef_dir, WEBCACHE_DIRNAME)
+    warmed = 0
+    if args.mode == 'clear':
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    elif args.mode == 'warm':
+        for key, path, stat in walk_cache(args.store_dir):
+            chef_path = os.path.join(cache_dir, key)
+            if not os.path.exists(chef_path):
+                link(path, chef_path)
+                warmed += 1
+    print_result({'chef_dir': args.chef_dir, 'mode': args.mode, 'warmed': warmed})
+
+
+def stats_cmd(args):
+    caches, inodes = scan_all(args.data_dir, args.store_dir)
+    stats = dict((owner, {'owner': owner, 'files': 0, 'bytes': 0, 'shared_bytes': 0, 'last_used': 0})
+                 for owner in caches.keys())
+    for info in inodes.values():
+        chef_owners = info['owners'] - set([STORE_OWNER])
+        for owner in info['owners']:
+            owner_stats = stats[owner]
+            owner_stats['files'] += 1
+            owner_stats['bytes'] += info['size']
+            if len(chef_owners) > 1 and owner != STORE_OWNER:
+                owner_stats['shared_bytes'] += info['size']
+            owner_stats['last_used'] = max(owner_stats['last_used'], info['last_used'])
+    for owner in sorted(stats.keys()):
+        print_result(stats[owner])
+    print_result({
+        'owner': 'TOTAL',
+        'files': len(inodes),
+        'bytes': sum(info['size'] for info in inodes.values()),
+        'shared_bytes': 0,
+        'last_used': max([info['last_used'] for info in inodes.values()] or [0]),
+        'budget_bytes': args.budget_gb * 1024**3,
+    })
+
+
+def print_result(result):
+    print('RESULT', json.dumps(result))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--store-dir', required=True)
+    parser.add_argument('--budget-gb', type=float, required=True)
+    subparsers = parser.add_subparsers(dest='command_name')
+    subparsers.add_parser('stats')
+    subparsers.add_parser('prune')
+    prepare_parser = subparsers.add_parser('prepare')
+    prepare_parser.add_argument('--mode', choices=['clear', 'warm'], required=True)
+    prepare_parser.add_argument('chef_dir')
+    args = parser.parse_args()
+    args.store_dir = os.path.abspath(args.store_dir)
+    os.makedirs(args.store_dir, exist_ok=True)
+
+    start = time.time()
+    if args.command_name == 'stats':
+        stats_cmd(args)
+    elif args.command_name == 'prune':
+        prune_cmd(args)
+    elif args.command_name == 'prepare':
+        prepare_cmd(args)
+    else:
+        parser.print_help()
+    print('Done in {:.1f}sec'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
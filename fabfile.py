@@ -11,6 +11,20 @@ env.roledefs = {}  # combined roles from inventory and integrationservers
 env.password = os.environ.get('SUDO_PASSWORD')
 
 
+# TIMING
+################################################################################
+# Tasks and their run/sudo/local commands are recorded in cache/timing.jsonl
+from fabfiles.timing import install_timing, timing_report
+install_timing()
+
+
+# SSH CONNECTION POOL
+################################################################################
+# One warm connection per host for the whole session (keepalive, idle eviction)
+from fabfiles.sshpool import install_ssh_pool, ssh_pool_stats
+install_ssh_pool()
+
+
 # PREREQUISITES
 ################################################################################
 # 1. SusOps engineer be part of the GCP project kolibri-demo-servers
@@ -30,9 +44,18 @@ env.roledefs.update(inventory)  # QA demoservers inventory (GCP VMs)
 
 # DEMOSERVERS
 ################################################################################
-from fabfiles.demoservers import demoserver, update_kolibri
+from fabfiles.demoservers import demoserver, update_kolibri, rolling_update_kolibri
 from fabfiles.demoservers import import_channel, import_channels
 from fabfiles.demoservers import restart_kolibri, stop_kolibri
+from fabfiles.demoservers import download_kolibri, push_kolibri_pex
+from fabfiles.demoservers import wait_for_kolibri, kolibri_readiness_report
+from fabfiles.demoservers import configure_nginx, benchmark_nginx
+from fabfiles.contentdedup import dedup_content
+
+
+# CONTENT MIRROR
+################################################################################
+from fabfiles.contentmirror import setup_content_mirror, sync_content_mirror
 
 
 # PROXY SERVICE
@@ -46,10 +69,20 @@ from fabfiles.proxyservice import uninstall_squid_proxy
 ################################################################################
 from fabfiles.chefops import integrationservers
 from fabfiles.chefops import run_chef, setup_chef, unsetup_chef, update_chef
+from fabfiles.chefops import gc_chef_venvs
+from fabfiles.chefops import tail_chef
+from fabfiles.chefops import submit_chef, list_chef_jobs, cancel_chef_job
+from fabfiles.chefops import webcache_stats, prune_webcache
+from fabfiles.chefops import batch_chefs
 
 env.roledefs.update(integrationservers)  # content integration servers (vader)
 
 
+# DISK USAGE
+################################################################################
+from fabfiles.diskindex import collect_disk_index, disk_index_report
+
+
 # CATALOG SERVER CHECKS
 ################################################################################
 from fabfiles.catalogservers import check_catalog_channels
@@ -58,10 +91,12 @@ from fabfiles.catalogservers import check_catalog_channels
 # GITHUB
 ################################################################################
 from fabfiles.github import clone_chef_repos, create_github_repo, list_chef_repos, list_pipeline_repos
+from fabfiles.github import github_cache_stats
 
 
 # CODE REPORTS
 ################################################################################
 from fabfiles.codereports import local_setup_chef, local_update_chef, local_unsetup_chef
-from fabfiles.codereports import analyze_chef_repo, analyze_chef_repos
+from fabfiles.codereports import analyze_chef_repo, analyze_chef_repos, invalidate_code_reports
+from fabfiles.codereports import benchmark_line_counter
 
@@ -1,15 +1,25 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 
 from fabric.api import task
 
+from .timing import timed
 
-STUDIO_URL = 'https://studio.learningequality.org'
+
+# Studio, catalog, and demo server URLs can be overridden using env variables to
+# run the checks against other servers, e.g. local stub servers for testing:
+#   CATALOG_DEMO_SERVERS="en=http://localhost:8001 es=http://localhost:8002"
+STUDIO_URL = os.environ.get('STUDIO_URL', 'https://studio.learningequality.org')
 API_PUBLIC_ENDPOINT = '/api/public/v1/channels'
 
-CATALOG_URL = "https://catalog.learningequality.org"
-API_CATALOG_ENDPOINT = "/api/catalog?page_size=200&public=true&published=true"
+CATALOG_URL = os.environ.get('CATALOG_URL', "https://catalog.learningequality.org")
+API_CATALOG_ENDPOINT = "/api/catalog"
+CATALOG_PAGE_SIZE = 200
 
 CATALOG_DEMO_SERVERS = {
     'ar': 'https://kolibri-catalog-ar.learningequality.org',
@@ -19,13 +29,25 @@ CATALOG_DEMO_SERVERS = {
     'hi': 'https://kolibri-catalog-hi.learningequality.org',
     'other': 'https://kolibri-demo.learningequality.org',
 }
+if os.environ.get('CATALOG_DEMO_SERVERS'):
+    CATALOG_DEMO_SERVERS = dict(
+        item.split('=', 1) for item in os.environ['CATALOG_DEMO_SERVERS'].split())
+
+# (connect, read) timeouts in seconds; Studio is slow to list all public channels
+CATALOG_TIMEOUTS = {
+    'studio': (5, 60),
+    'catalog': (5, 30),
+    'demoserver': (5, 30),
+}
+CATALOG_FETCH_WORKERS = 8
 
 
 # CATALOG SERVER CHECKS
 ################################################################################
 
 @task
-def check_catalog_channels():
+@timed
+def check_catalog_channels(workers=CATALOG_FETCH_WORKERS):
     """
     Obtain the list of public channels on Kolibri Studio and compare with the
     list of channels imported on the catalog demo servers. Prints the following:
@@ -33,73 +55,179 @@ def check_catalog_channels():
       - list channels that are oudated (studio version > version on demo server)
       - list channels with missing or broken demo_server_url
     """
-    # 1. Get Studio channels
-    studio_channels = requests.get(STUDIO_URL + API_PUBLIC_ENDPOINT).json()
-    studio_channels_by_id = dict((ch['id'], ch) for ch in studio_channels)
-    print('Found', len(studio_channels_by_id), 'PUBLIC channels on Studio.')
-
-    # 2. Get Catalog channels
-    catalog_data = requests.get(CATALOG_URL + API_CATALOG_ENDPOINT).json()
-    catalog_channels = catalog_data['results']
-    catalog_channels_by_id = dict((ch['id'], ch) for ch in catalog_channels)
-    print('Found', len(studio_channels_by_id), 'PUBLIC channels in Catalog.')
-
-    # 3. Get Catalog demo server channels
-    demoserver_channels = []
-    for lang, demoserver in CATALOG_DEMO_SERVERS.items():
-        # print('   - getting channel list from the', lang, 'demoserver...')
-        channels = requests.get(demoserver + API_PUBLIC_ENDPOINT).json()
-        for channel in channels:
-            channel['demoserver'] = demoserver
-            channel['lang'] = lang
-            demoserver_channels.append(channel)
-    # group all channels found by `channel_id`
-    demoserver_channels_by_id = defaultdict(list)
-    for ch in demoserver_channels:
-        ch_id = ch['id']
-        demoserver_channels_by_id[ch_id].append(ch)
-    print('Found', len(demoserver_channels_by_id), 'channels on demoservers.')
+    data = fetch_catalog_data(workers=int(workers))
+    print('Found', len(data['studio']), 'PUBLIC channels on Studio.')
+    print('Found', len(data['catalog']), 'PUBLIC channels in Catalog.')
+    for demoserver, error in sorted(data['errors'].items()):
+        print('WARNING: could not get channels from', demoserver, '(' + error + ')')
+
+    indexes = build_catalog_indexes(data)
+    print('Found', len(indexes['versions_by_id']), 'channels on demoservers.')
 
     # Sanity check: Studio channels and Catalog channels should be identical
-    studio_ids = set(studio_channels_by_id.keys())
-    catalog_ids = set(catalog_channels_by_id.keys())
-    if studio_ids != catalog_ids:
+    if set(indexes['studio_by_id'].keys()) != set(indexes['catalog_by_id'].keys()):
         print('WARNING: Studio PUBCLIC channels and Catalog channels differ!')
 
+    reports = compute_catalog_reports(indexes)
 
     # REPORT A: PUBLIC channels must be imported on at least one demoserver
     print('\n\nREPORT A: Check no channels missing from catalog demoservers:')
-    for ch_id, studio_ch in studio_channels_by_id.items():
-        if ch_id not in demoserver_channels_by_id:
-            print(' - Cannot find', ch_id, studio_ch['name'])
+    for ch_id, name in reports['missing']:
+        print(' - Cannot find', ch_id, name)
 
     # REPORT B: Catalog demoservers must have the latest version of the channel
     print('\n\nREPORT B: Check channel versions on catalog demoservers:')
-    for ch_id, studio_ch in studio_channels_by_id.items():
-        latest_version = studio_ch["version"]
-        if ch_id in demoserver_channels_by_id:
-            demoserver_channels = demoserver_channels_by_id[ch_id]
-            for channel in demoserver_channels:
-                if channel["version"] < latest_version:
-                    print(' - Channel', ch_id, studio_ch['name'], 'needs to be updated on', channel['demoserver'])
+    for ch_id, name, demoserver in reports['outdated']:
+        print(' - Channel', ch_id, name, 'needs to be updated on', demoserver)
 
     # REPORT C: Catalog demoservers links must point to an existing channel
     print('\n\nREPORT C: Check the demo_server_url links in Catalog are good:')
-    for ch_id, catalog_ch in catalog_channels_by_id.items():
-        demo_server_url = catalog_ch["demo_server_url"]
-        if demo_server_url:
-            if ch_id not in demo_server_url:
-                print(' - ERROR: demo_server_url', demo_server_url, 'does not contain', ch_id)
-            parsed_url_obj = urlparse(demo_server_url)
-            catalog_demoserver = parsed_url_obj.scheme + '://' + parsed_url_obj.netloc
-            if ch_id in demoserver_channels_by_id:
-                found = False
-                demoserver_channels = demoserver_channels_by_id[ch_id]
-                for channel in demoserver_channels:
-                    if channel['demoserver'] == catalog_demoserver:
-                        found = True
-                if not found:
-                    print(' - Channel', ch_id, catalog_ch['name'], 'has demo_server_url',
-                        demo_server_url, 'but it is not present on that server')
+    for ch_id, name, demo_server_url, problem in reports['bad_links']:
+        if problem == 'no_url':
+            print(' - Channel', ch_id, name, 'does not have a demo_server_url')
+        elif problem == 'wrong_id':
+            print(' - ERROR: demo_server_url', demo_server_url, 'does not contain', ch_id)
         else:
-            print(' - Channel', ch_id, catalog_ch['name'], 'does not have a demo_server_url')
+            print(' - Channel', ch_id, name, 'has demo_server_url',
+                demo_server_url, 'but it is not present on that server')
+
+
+
+# FETCH LAYER
+################################################################################
+
+def fetch_catalog_data(studio_url=None, catalog_url=None, demoservers=None,
+                       workers=CATALOG_FETCH_WORKERS):
+    """
+    Get the channel lists from Studio, the Catalog (all pages), and the catalog
+    demo servers concurrently using a thread pool sharing one pooled session.
+    Returns a dict with the keys `studio`, `catalog`, `demoservers` (a dict
+    {lang: (demoserver, channels)}), and `errors` ({demoserver: message}).
+    Studio and Catalog errors are raised, since the reports are meaningless
+    without them, but unreachable demo servers are only reported in `errors`.
+    """
+    studio_url = studio_url or STUDIO_URL
+    catalog_url = catalog_url or CATALOG_URL
+    demoservers = demoservers or CATALOG_DEMO_SERVERS
+    session = _get_pooled_session(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        studio_future = executor.submit(
+            _get_json, session, studio_url + API_PUBLIC_ENDPOINT, CATALOG_TIMEOUTS['studio'])
+        demoserver_futures = {}
+        for lang, demoserver in demoservers.items():
+            demoserver_futures[lang] = executor.submit(
+                _get_json, session, demoserver + API_PUBLIC_ENDPOINT, CATALOG_TIMEOUTS['demoserver'])
+        catalog_channels = _get_all_catalog_pages(executor, session, catalog_url)
+
+        data = {
+            'studio': studio_future.result(),
+            'catalog': catalog_channels,
+            'demoservers': {},
+            'errors': {},
+        }
+        for lang, future in demoserver_futures.items():
+            demoserver = demoservers[lang]
+            try:
+                data['demoservers'][lang] = (demoserver, future.result())
+            except (requests.RequestException, ValueError) as e:
+                data['errors'][demoserver] = e.__class__.__name__ + ': ' + str(e)
+    return data
+
+
+def _get_all_catalog_pages(executor, session, catalog_url):
+    """
+    Get the first page of the catalog API to learn the total `count`, then get
+    the remaining pages concurrently. Falls back to following the `next` links
+    if the response does not include a `count`.
+    """
+    url = catalog_url + API_CATALOG_ENDPOINT
+    timeout = CATALOG_TIMEOUTS['catalog']
+    params = {'page_size': CATALOG_PAGE_SIZE, 'public': 'true', 'published': 'true'}
+    first_page = _get_json(session, url, timeout, params=dict(params, page=1))
+    channels = list(first_page['results'])
+    count = first_page.get('count')
+    if count is not None:
+        npages = int(math.ceil(count / float(max(len(channels), 1))))
+        futures = [executor.submit(_get_json, session, url, timeout, params=dict(params, page=page))
+                   for page in range(2, npages + 1)]
+        for future in futures:
+            channels.extend(future.result()['results'])
+    else:
+        next_url = first_page.get('next')
+        while next_url:
+            page_data = _get_json(session, next_url, timeout)
+            channels.extend(page_data['results'])
+            next_url = page_data.get('next')
+    return channels
+
+
+def _get_pooled_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=len(CATALOG_DEMO_SERVERS) + 2, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _get_json(session, url, timeout, params=None):
+    response = session.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+
+# INDEXED COMPARISON
+################################################################################
+
+def build_catalog_indexes(data):
+    """
+    Build the lookup indexes used by the reports from the `fetch_catalog_data` data:
+      - studio_by_id: {ch_id: studio channel}
+      - catalog_by_id: {ch_id: catalog channel}
+      - versions_by_id: {ch_id: {demoserver: version}} for all demo servers
+    """
+    versions_by_id = defaultdict(dict)
+    for lang, (demoserver, channels) in data['demoservers'].items():
+        for channel in channels:
+            versions_by_id[channel['id']][demoserver] = channel['version']
+    return {
+        'studio_by_id': dict((ch['id'], ch) for ch in data['studio']),
+        'catalog_by_id': dict((ch['id'], ch) for ch in data['catalog']),
+        'versions_by_id': versions_by_id,
+    }
+
+
+def compute_catalog_reports(indexes):
+    """
+    Compute the reports from the `build_catalog_indexes` indexes. Returns a dict:
+      - missing: list of (ch_id, name) of Studio channels not on any demoserver
+      - outdated: list of (ch_id, name, demoserver) with older versions than Studio
+      - bad_links: list of (ch_id, name, demo_server_url, problem) where problem
+        is one of `no_url`, `wrong_id`, or `not_on_server`
+    """
+    studio_by_id = indexes['studio_by_id']
+    versions_by_id = indexes['versions_by_id']
+    reports = {'missing': [], 'outdated': [], 'bad_links': []}
+
+    for ch_id, studio_ch in studio_by_id.items():
+        versions = versions_by_id.get(ch_id)
+        if versions is None:
+            reports['missing'].append((ch_id, studio_ch['name']))
+            continue
+        for demoserver, version in versions.items():
+            if version < studio_ch['version']:
+                reports['outdated'].append((ch_id, studio_ch['name'], demoserver))
+
+    for ch_id, catalog_ch in indexes['catalog_by_id'].items():
+        demo_server_url = catalog_ch['demo_server_url']
+        if not demo_server_url:
+            reports['bad_links'].append((ch_id, catalog_ch['name'], demo_server_url, 'no_url'))
+            continue
+        if ch_id not in demo_server_url:
+            reports['bad_links'].append((ch_id, catalog_ch['name'], demo_server_url, 'wrong_id'))
+        parsed_url_obj = urlparse(demo_server_url)
+        catalog_demoserver = parsed_url_obj.scheme + '://' + parsed_url_obj.netloc
+        versions = versions_by_id.get(ch_id)
+        if versions is not None and catalog_demoserver not in versions:
+            reports['bad_links'].append((ch_id, catalog_ch['name'], demo_server_url, 'not_on_server'))
+    return reports
@@ -0,0 +1,95 @@
+import json
+import os
+import re
+import time
+
+
+# CHEF LOG SETTINGS
+################################################################################
+# Read offsets and progress counters of the chef logs followed by `tail_chef`,
+# keyed by `host:path`, so that no part of a log is transferred twice.
+CHEF_LOGS_STATE_FILE = os.path.join('cache', 'chef_logs.json')
+CHEF_LOG_MAX_BYTES = 8*1024*1024      # max new bytes transferred per log and poll
+CHEF_LOG_INITIAL_BYTES = 64*1024      # start this far from the end for new logs
+
+# Ricecooker progress messages
+RICECOOKER_STAGE_PAT = re.compile(r'(Calling construct_channel|Downloading files|Getting file diff'
+                                  r'|Uploading files|Creating channel|Publishing channel|DONE)')
+RICECOOKER_DOWNLOADED_PAT = re.compile(r'--- Downloaded ')
+RICECOOKER_UPLOADED_PAT = re.compile(r'Uploaded .* \((?P<count>\d+)/(?P<total>\d+)\)')
+RICECOOKER_NODES_PAT = re.compile(r'\((?P<count>\d+) of (?P<total>\d+) uploaded\)')
+RICECOOKER_ERROR_PAT = re.compile(r'\b(ERROR|CRITICAL)\b|Traceback \(most recent call last\)')
+RICECOOKER_WARNING_PAT = re.compile(r'\bWARNING\b')
+
+
+
+# LOG STATE
+################################################################################
+
+def load_chef_logs_state():
+    if not os.path.exists(CHEF_LOGS_STATE_FILE):
+        return {}
+    with open(CHEF_LOGS_STATE_FILE) as statef:
+        return json.load(statef)
+
+
+def save_chef_logs_state(state):
+    os.makedirs(os.path.dirname(CHEF_LOGS_STATE_FILE), exist_ok=True)
+    tmp_path = CHEF_LOGS_STATE_FILE + '.tmp'
+    with open(tmp_path, 'w') as statef:
+        json.dump(state, statef, indent=2, sort_keys=True)
+    os.replace(tmp_path, CHEF_LOGS_STATE_FILE)
+
+
+def new_log_state():
+    return {
+        'inode': 0,
+        'offset': 0,
+        'updated': time.time(),
+        'counters': new_progress_counters(),
+    }
+
+
+
+# PROGRESS EXTRACTION
+################################################################################
+
+def new_progress_counters():
+    return {
+        'stage': '',
+        'nodes': 0,
+        'nodes_total': 0,
+        'downloaded': 0,
+        'uploaded': 0,
+        'uploaded_total': 0,
+        'errors': 0,
+        'warnings': 0,
+    }
+
+
+def parse_progress_lines(counters, lines):
+    """
+    Update the progress `counters` from the ricecooker log `lines`. Returns the
+    error lines found.
+    """
+    error_lines = []
+    for line in lines:
+        stage_match = RICECOOKER_STAGE_PAT.search(line)
+        if stage_match:
+            counters['stage'] = stage_match.group(1)
+        if RICECOOKER_DOWNLOADED_PAT.search(line):
+            counters['downloaded'] += 1
+        uploaded_match = RICECOOKER_UPLOADED_PAT.search(line)
+        if uploaded_match:
+            counters['uploaded'] = int(uploaded_match.group('count'))
+            counters['uploaded_total'] = int(uploaded_match.group('total'))
+        nodes_match = RICECOOKER_NODES_PAT.search(line)
+        if nodes_match:
+            counters['nodes'] = int(nodes_match.group('count'))
+            counters['nodes_total'] = int(nodes_match.group('total'))
+        if RICECOOKER_ERROR_PAT.search(line):
+            counters['errors'] += 1
+            error_lines.append(line)
+        elif RICECOOKER_WARNING_PAT.search(line):
+            counters['warnings'] += 1
+    return error_lines
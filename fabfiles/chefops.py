@@ -1,12 +1,23 @@
+import base64
+import gzip
+from io import BytesIO
+import json
 import os
 import re
+from shlex import quote
+import time
 
-from fabric.api import env, task, local, sudo, run, prompt
+from fabric.api import env, task, local, sudo, run, prompt, put
 from fabric.colors import red, green, blue, yellow
-from fabric.context_managers import cd, prefix
+from fabric.context_managers import cd, prefix, hide
 from fabric.contrib.files import exists
 from fabric.utils import puts
 
+from .cheflogs import CHEF_LOG_INITIAL_BYTES, CHEF_LOG_MAX_BYTES
+from .cheflogs import load_chef_logs_state, save_chef_logs_state, new_log_state
+from .cheflogs import new_progress_counters, parse_progress_lines
+from .timing import timed
+
 
 # Studio
 STUDIO_TOKEN = os.environ.get('STUDIO_TOKEN', None)
@@ -17,6 +28,28 @@ STUDIO_TOKEN = os.environ.get('STUDIO_TOKEN', None)
 CHEF_USER = 'chef'
 DATA_DIR = '/data'
 VIRTUALENV_PYTHON = 'python3.5'
+CONFIG_DIR = './config'
+
+# Shared wheel cache and base virtualenvs (keyed by a hash of requirements.txt)
+# that are symlinked as the `venv` of the chefs, see config/chef_venv.sh
+WHEELHOUSE_DIR = os.path.join(DATA_DIR, 'wheelhouse')
+VENVS_DIR = os.path.join(DATA_DIR, 'venvs')
+
+
+# CHEF JOB QUEUE SETTINGS
+################################################################################
+CHEFQUEUE_DIR = os.path.join(DATA_DIR, 'chefqueue')
+CHEFQUEUE_MAX_CPUS = None         # None = all the CPUs of the host
+CHEFQUEUE_MAX_MEM_MB = None       # None = 80% of the RAM of the host
+CHEFQUEUE_MIN_FREE_DISK_GB = 50   # jobs wait if /data would have less free space
+
+
+# WEB CACHE SETTINGS
+################################################################################
+# The `.webcache` dirs of all chefs share identical responses (hardlinks) with
+# the store, and are pruned of least recently used responses to fit the budget
+WEBCACHE_STORE_DIR = os.path.join(DATA_DIR, 'webcache')
+WEBCACHE_BUDGET_GB = 100
 
 
 # INTEGRATIONS SERVERS (UNIX hosts with good internet and lots of storage space)
@@ -33,29 +66,24 @@ integrationservers = {
 ################################################################################
 
 @task
-def run_chef(nickname, repo_name=None, nohup=False, prfx=None, args='', cwd=None):
+@timed
+def run_chef(nickname, repo_name=None, nohup=False, prfx=None, args='', cwd=None, webcache=None):
     """
     Run the command: `cd cwd; prfx && ./sushichef.py --thumbnails --token={}`
     where {} will be replaced by the value of the env variable STUDIO_TOKEN.
+    Use `webcache=clear` to start with an empty `.webcache` (full crawl), or
+    `webcache=warm` to add the responses cached by other chefs to `.webcache`.
     All keyword arguments are optional and used only for special cases.
     """
     nohup = (nohup and nohup.lower() == 'true')  # defaults to False
-    if STUDIO_TOKEN is None:
-        raise ValueError('Must define STUDIO_TOKEN env var to run chefs.')
-
-    if repo_name is None:
-        repo_name = 'sushi-chef-' + nickname
-    chef_repo_dir = os.path.join(DATA_DIR, repo_name)
-    chef_root_dir = os.path.join(chef_repo_dir, cwd) if cwd else chef_repo_dir
-
-    # TODO rm chef_root_dir/.webcache if needed...
-    cmd = './sushichef.py --token={} --thumbnails '.format(STUDIO_TOKEN)
-    if args:
-        cmd += args
-
+    chef_root_dir = get_chef_root_dir(nickname, repo_name=repo_name, cwd=cwd)
+    full_prfx, cmd = build_chef_command(chef_root_dir, prfx=prfx, args=args)
+    if webcache:
+        if webcache not in ['clear', 'warm']:
+            raise ValueError('webcache must be one of clear or warm')
+        result = _run_webcache('prepare', ['--mode', webcache, chef_root_dir])[-1]
+        puts(green('Web cache {}: {} responses added from the store.'.format(webcache, result['warmed'])))
     with cd(chef_root_dir):
-        full_prfx = prfx + ' && ' if prfx else ''
-        full_prfx += 'source ' + os.path.join(chef_root_dir, 'venv/bin/activate')
         with prefix(full_prfx):
             if nohup == False:
                 # Normal operation (blocking)
@@ -66,12 +94,304 @@ def run_chef(nickname, repo_name=None, nohup=False, prfx=None, args='', cwd=None
                 sudo(cmd_nohup, user=CHEF_USER)
                 nohup_out_file = os.path.join(chef_root_dir, 'nohup.out')
                 puts(green('Script stdout is sent to   ' + nohup_out_file))
+                puts(green('Use `tail_chef:' + nickname + '` to follow its progress.'))
+
+
+# CHEF LOGS
+################################################################################
+
+@task
+@timed
+def tail_chef(nicknames, follow=False, interval=10, lines=False):
+    """
+    Print the progress of the chefs `nicknames` (space-separated) that run in the
+    background, parsed from the new lines of their `nohup.out`: current stage,
+    nodes and files uploaded, files downloaded, upload rate, and errors. Only the
+    part of the logs not seen before is transferred (offsets in cache/). Items
+    that contain a `/` are log paths, e.g., the log of a queued job. Use
+    `follow=true` to poll every `interval` seconds (Ctrl-C to stop), and
+    `lines=true` to also print the new log lines.
+    """
+    follow = (follow and str(follow).lower() == 'true')
+    lines = (lines and str(lines).lower() == 'true')
+    log_paths = []
+    for item in nicknames.split():
+        if '/' in item:
+            log_path = item
+        else:
+            log_path = os.path.join(get_chef_root_dir(item), 'nohup.out')
+        if log_path not in [path for _, path in log_paths]:
+            log_paths.append((item, log_path))
+    state = load_chef_logs_state()
+    upload = True
+    try:
+        while True:
+            _poll_chef_logs(log_paths, state, upload=upload, print_lines=lines)
+            save_chef_logs_state(state)
+            upload = False
+            if not follow:
+                break
+            time.sleep(int(interval))
+    except KeyboardInterrupt:
+        save_chef_logs_state(state)
+
+
+def _poll_chef_logs(log_paths, state, upload=True, print_lines=False):
+    """
+    Read the new bytes of all the `(name, log_path)` logs in one remote command,
+    update their offsets and progress counters in `state`, and print a table.
+    """
+    script_args = [
+        '--max-bytes', str(CHEF_LOG_MAX_BYTES),
+        '--initial-bytes', str(CHEF_LOG_INITIAL_BYTES),
+    ]
+    for name, log_path in log_paths:
+        log_state = state.setdefault(env.host_string + ':' + log_path, new_log_state())
+        script_args.append('{}={}:{}'.format(log_path, log_state['inode'], log_state['offset']))
+    results = _run_remote_script('logtail.py', DATA_DIR, script_args, upload=upload)
+
+    now = time.time()
+    rows = []
+    for (name, log_path), result in zip(log_paths, results):
+        log_state = state[env.host_string + ':' + log_path]
+        if result['error']:
+            rows.append([name, red('missing'), '', '', '', '', '', '', ''])
+            continue
+        if result['reset'] or log_state['inode'] == 0:
+            log_state['counters'] = new_progress_counters()
+        counters = log_state['counters']
+        uploaded_before = counters['uploaded']
+        chunk = gzip.decompress(base64.b64decode(result['data'])).decode('utf-8', errors='replace')
+        new_lines = re.split(r'[\r\n]+', chunk.rstrip('\r\n')) if chunk else []
+        error_lines = parse_progress_lines(counters, new_lines)
+        if print_lines:
+            for line in new_lines:
+                print('[' + name + '] ' + line)
+        for line in error_lines[-5:]:
+            puts(red('[' + name + '] ' + line))
+        elapsed = now - log_state['updated'] if log_state['inode'] else 0
+        upload_rate = max(counters['uploaded'] - uploaded_before, 0) * 60.0 / elapsed if elapsed else 0
+        log_state.update({'inode': result['inode'], 'offset': result['end'], 'updated': now})
+        rows.append([
+            name,
+            counters['stage'],
+            '{}/{}'.format(counters['nodes'], counters['nodes_total']),
+            str(counters['downloaded']),
+            '{}/{}'.format(counters['uploaded'], counters['uploaded_total']),
+            '{:.1f}/min'.format(upload_rate),
+            (red if counters['errors'] else green)(str(counters['errors'])),
+            _format_size(result['size']),
+            _format_size(result['end'] - result['start']),
+        ])
+    print('\t'.join(['chef', 'stage', 'nodes', 'downloaded', 'uploaded', 'upload rate', 'errors', 'log size', 'new']))
+    for row in rows:
+        print('\t'.join(row))
+
+
+# CHEF JOB QUEUE
+################################################################################
+
+@task
+@timed
+def submit_chef(nickname, repo_name=None, prfx=None, args='', cwd=None, cpus=1, mem_mb=2000, disk_gb=5):
+    """
+    Add a run of the chef `nickname` to the job queue on the integration server.
+    The job starts when the `cpus`, `mem_mb` (RAM), and `disk_gb` it needs fit in
+    the CHEFQUEUE budgets. Other arguments are the same as for `run_chef`.
+    """
+    chef_root_dir = get_chef_root_dir(nickname, repo_name=repo_name, cwd=cwd)
+    full_prfx, cmd = build_chef_command(chef_root_dir, prfx=prfx, args=args)
+    submit_args = [
+        '--name', nickname,
+        '--cwd', chef_root_dir,
+        '--cpus', str(cpus),
+        '--mem-mb', str(mem_mb),
+        '--disk-gb', str(disk_gb),
+        '--min-free-disk-gb', str(CHEFQUEUE_MIN_FREE_DISK_GB),
+    ]
+    if CHEFQUEUE_MAX_CPUS:
+        submit_args += ['--max-cpus', str(CHEFQUEUE_MAX_CPUS)]
+    if CHEFQUEUE_MAX_MEM_MB:
+        submit_args += ['--max-mem-mb', str(CHEFQUEUE_MAX_MEM_MB)]
+    submit_args.append(full_prfx + ' && ' + cmd)
+    jobs = _run_chefqueue('submit', submit_args)
+    puts(green('Submitted job ' + jobs[0]['id'] + ' (use `list_chef_jobs` to see its status)'))
+    puts(green('Script stdout is sent to   ' + jobs[0]['log']))
+    return jobs[0]
+
+
+@task
+@timed
+def list_chef_jobs(all=False):
+    """
+    Print the status, runtime, exit code, and peak RSS of the jobs in the queue.
+    Jobs that finished more than a day ago are shown only if `all=true`.
+    """
+    all = (all and str(all).lower() == 'true')
+    jobs = _run_chefqueue('list', ['--all'] if all else [])
+    print('\t'.join(['id', 'status', 'cpus', 'mem_mb', 'waited', 'runtime', 'exit_code', 'peak_rss']))
+    for job in jobs:
+        now = time.time()
+        waited = (job['started'] or job['ended'] or now) - job['submitted']
+        runtime = (job['ended'] or now) - job['started'] if job['started'] else 0
+        exit_code = job['exit_code']
+        print('\t'.join([
+            job['id'],
+            job['status'],
+            str(job['cpus']),
+            str(job['mem_mb']),
+            _format_duration(waited),
+            _format_duration(runtime),
+            (job['error'] or '') if exit_code is None else str(exit_code),
+            '{:.0f}MB'.format(job['peak_rss_kb']/1024.0),
+        ]))
+    return jobs
+
+
+@task
+@timed
+def cancel_chef_job(job_id):
+    """
+    Remove the job `job_id` from the queue, or terminate it if already running.
+    """
+    jobs = _run_chefqueue('cancel', [job_id])
+    puts(green('Job ' + job_id + ' is ' + jobs[0]['status']))
+
+
+
+# BATCH CHEF OPERATIONS
+################################################################################
+
+@task
+@timed
+def batch_chefs(manifest, update=True, submit=False, refresh=False, git_workers=8, pip_workers=3):
+    """
+    Update and/or run all the chefs in the json file `manifest`, which contains a
+    list of dicts with the key `nickname` and the optional keys `repo_name`,
+    `organization`, `branch`, `cwd` (like `setup_chef`), and `prfx`, `args`,
+    `cpus`, `mem_mb`, `disk_gb` (like `submit_chef`).
+    The code of the chefs is cloned or updated with `git_workers` parallel git
+    operations and their venvs are setup with `pip_workers` parallel installs.
+    Use `submit=true` to submit the chefs to the job queue (after a successful update).
+    """
+    update = update in [True, 'true', 'True']
+    submit = (submit and str(submit).lower() == 'true')
+    refresh = (refresh and str(refresh).lower() == 'true')
+    with open(manifest) as manifestf:
+        chefs = json.load(manifestf)
+    nicknames = [chef['nickname'] for chef in chefs]
+    results = dict((nickname, {'status': 'ok', 'commit': '', 'venv': '', 'git_seconds': 0, 'venv_seconds': 0})
+                   for nickname in nicknames)
+
+    if update:
+        batch_dir = os.path.join(DATA_DIR, 'chefbatch')
+        sudo('mkdir -p ' + batch_dir)
+        remote_chefs = []
+        for chef in chefs:
+            repo_name = chef.get('repo_name') or 'sushi-chef-' + chef['nickname']
+            organization = chef.get('organization', 'learningequality')
+            remote_chefs.append({
+                'nickname': chef['nickname'],
+                'repo_dir': os.path.join(DATA_DIR, repo_name),
+                'chef_root_dir': get_chef_root_dir(chef['nickname'], repo_name=repo_name, cwd=chef.get('cwd')),
+                'github_url': 'https://github.com/{}/{}'.format(organization, repo_name),
+                'branch': chef.get('branch', 'master'),
+            })
+        manifest_path = os.path.join(batch_dir, 'manifest.json')
+        with hide('running'):
+            put(BytesIO(json.dumps(remote_chefs).encode('utf-8')), manifest_path, use_sudo=True)
+        script_args = [
+            '--data-dir', DATA_DIR,
+            '--chef-user', CHEF_USER,
+            '--venv-script', _upload_chef_venv_script(),
+            '--python', VIRTUALENV_PYTHON,
+            '--git-workers', str(git_workers),
+            '--pip-workers', str(pip_workers),
+        ]
+        if refresh:
+            script_args.append('--refresh')
+        for result in _run_remote_script('chefbatch.py', batch_dir, script_args + [manifest_path], user=None):
+            results[result['nickname']] = result
+            if 'error' in result:
+                puts(red(result['nickname'] + ' ' + result['status'] + ':\n' + result['error']))
+        if refresh:
+            gc_chef_venvs()
+
+    if submit:
+        for chef in chefs:
+            result = results[chef['nickname']]
+            if result['status'] != 'ok':
+                continue
+            submit_kwargs = dict((key, chef[key]) for key in chef.keys()
+                                 if key in ['repo_name', 'cwd', 'prfx', 'args', 'cpus', 'mem_mb', 'disk_gb'])
+            try:
+                result['job'] = submit_chef(chef['nickname'], **submit_kwargs)['id']
+            except Exception as e:
+                result['status'] = 'failed submit'
+                puts(red(chef['nickname'] + ' failed submit: ' + str(e)))
+
+    print('\t'.join(['nickname', 'status', 'commit', 'git', 'venv', 'job']))
+    for nickname in nicknames:
+        result = results[nickname]
+        print('\t'.join([
+            nickname,
+            result['status'],
+            result['commit'],
+            '{:.1f}s'.format(result['git_seconds']),
+            '{} {:.1f}s'.format(result['venv'], result['venv_seconds']),
+            result.get('job', ''),
+        ]))
+    return results
+
+
+
+# WEB CACHE
+################################################################################
+
+@task
+@timed
+def webcache_stats():
+    """
+    Print the number of files, size, and size shared with other chefs of the
+    `.webcache` of each chef, and the total size compared to the budget.
+    """
+    results = _run_webcache('stats')
+    print('\t'.join(['chef', 'files', 'size', 'shared', 'last used']))
+    for result in results:
+        last_used = time.strftime('%Y-%m-%d', time.localtime(result['last_used'])) if result['last_used'] else ''
+        size = _format_size(result['bytes'])
+        if 'budget_bytes' in result:
+            size += ' of ' + _format_size(result['budget_bytes'])
+        print('\t'.join([
+            result['owner'],
+            str(result['files']),
+            size,
+            _format_size(result['shared_bytes']),
+            last_used,
+        ]))
+
+
+@task
+@timed
+def prune_webcache(budget_gb=WEBCACHE_BUDGET_GB):
+    """
+    Hardlink identical cached responses and remove the least recently used
+    responses of all chefs until their total size is under `budget_gb`.
+    """
+    result = _run_webcache('prune', budget_gb=budget_gb)[0]
+    puts(green('Linked {} identical responses ({} saved).'.format(
+        result['linked'], _format_size(result['saved_bytes']))))
+    puts(green('Removed {} least recently used responses ({} freed), {} used of {}.'.format(
+        result['removed'], _format_size(result['freed_bytes']),
+        _format_size(result['total_bytes']), _format_size(result['budget_bytes']))))
+
 
 
 # CHEF SETUP
 ################################################################################
 
 @task
+@timed
 def setup_chef(nickname, repo_name=None, cwd=None, organization='learningequality', branch='master'):
     """
     Git-clone, setup virtualenv, and pip-install the the chef `nickname`.
@@ -100,19 +420,13 @@ def setup_chef(nickname, repo_name=None, cwd=None, organization='learningequalit
             sudo('git checkout ' + branch, user=CHEF_USER)
         puts(green('Setup code from ' + github_http_url + ' in ' + chef_repo_dir))
 
-        # setup python virtualenv
-        with cd(chef_root_dir):
-            sudo('virtualenv -p ' + VIRTUALENV_PYTHON + ' venv', user=CHEF_USER)
-
-        # install requirements
-        activate_sh = os.path.join(chef_root_dir, 'venv/bin/activate')
-        reqs_filepath = os.path.join(chef_root_dir, 'requirements.txt')
-        with prefix('export HOME=/data && source ' + activate_sh):
-            sudo('pip install --no-input --quiet -r ' + reqs_filepath, user=CHEF_USER)
+        # setup python virtualenv and install requirements
+        setup_chef_venv(chef_root_dir)
         puts(green('Python env setup in ' + os.path.join(chef_root_dir, 'venv')))
 
 
 @task
+@timed
 def unsetup_chef(nickname, repo_name=None):
     """
     Remove the repo `sushi-chef-{nickname}` form the content integration server.
@@ -125,10 +439,14 @@ def unsetup_chef(nickname, repo_name=None):
 
 
 @task
-def update_chef(nickname, repo_name=None, cwd=None, branch='master'):
+@timed
+def update_chef(nickname, repo_name=None, cwd=None, branch='master', refresh=False):
     """
     Run pull -f in the chef repo to update the chef code to the lastest version.
+    The venv is updated only if requirements.txt changed; use `refresh=true` to
+    reinstall it with the latest versions of unpinned requirements.
     """
+    refresh = (refresh and str(refresh).lower() == 'true')
     if repo_name is None:
         repo_name = 'sushi-chef-' + nickname
     chef_repo_dir = os.path.join(DATA_DIR, repo_name)
@@ -138,16 +456,28 @@ def update_chef(nickname, repo_name=None, cwd=None, branch='master'):
         sudo('git checkout ' + branch, user=CHEF_USER)
         sudo('git reset --hard origin/' + branch, user=CHEF_USER)
 
-    # setup python virtualenv
-    if not exists(os.path.join(chef_root_dir, 'venv')):
-        with cd(chef_root_dir):
-            sudo('virtualenv -p ' + VIRTUALENV_PYTHON + ' venv', user=CHEF_USER)
+    # update python virtualenv and requirements
+    result = setup_chef_venv(chef_root_dir, refresh=refresh)
+    if result and result['action'] == 'built':
+        gc_chef_venvs()   # the previous build, once no running chef uses it
+
 
-    # update requirements
-    activate_sh = os.path.join(chef_root_dir, 'venv/bin/activate')
-    reqs_filepath = os.path.join(chef_root_dir, 'requirements.txt')
-    with prefix('export HOME=/data && source ' + activate_sh):
-        sudo('pip install -U --no-input --quiet -r ' + reqs_filepath, user=CHEF_USER)
+@task
+@timed
+def gc_chef_venvs():
+    """
+    Delete the base venv builds in VENVS_DIR that are not the current build of a
+    base venv linked by a chef and that are not used by a running process.
+    """
+    script_path = _upload_chef_venv_script()
+    with prefix('export DATA_DIR=' + DATA_DIR):
+        output = sudo(' '.join(quote(arg) for arg in ['bash', script_path, 'gc']), user=CHEF_USER)
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            result = json.loads(line[len('RESULT '):])
+            puts(green('Removed {} base venv builds ({:.1f}MB freed).'.format(
+                result['removed'], result['freed_kb'] / 1024.0)))
+            return result
 
 
 
@@ -155,6 +485,124 @@ def update_chef(nickname, repo_name=None, cwd=None, branch='master'):
 # HELPER METHODS
 ################################################################################
 
+def get_chef_root_dir(nickname, repo_name=None, cwd=None):
+    if repo_name is None:
+        repo_name = 'sushi-chef-' + nickname
+    chef_repo_dir = os.path.join(DATA_DIR, repo_name)
+    return os.path.join(chef_repo_dir, cwd) if cwd else chef_repo_dir
+
+
+def build_chef_command(chef_root_dir, prfx=None, args=''):
+    """
+    Returns the tuple `(full_prfx, cmd)` where `cmd` is the chef command and
+    `full_prfx` is the `prfx` command (if any) followed by the venv activation.
+    """
+    if STUDIO_TOKEN is None:
+        raise ValueError('Must define STUDIO_TOKEN env var to run chefs.')
+    cmd = './sushichef.py --token={} --thumbnails '.format(STUDIO_TOKEN)
+    if args:
+        cmd += args
+    full_prfx = prfx + ' && ' if prfx else ''
+    full_prfx += 'source ' + os.path.join(chef_root_dir, 'venv/bin/activate')
+    return full_prfx, cmd
+
+
+def setup_chef_venv(chef_root_dir, refresh=False):
+    """
+    Make `chef_root_dir/venv` a link to the base venv for its requirements.txt,
+    installing the base venv from the shared wheelhouse if it doesn't exist yet.
+    """
+    script_path = _upload_chef_venv_script()
+    cmd = ' '.join(quote(arg) for arg in ['bash', script_path, chef_root_dir, VIRTUALENV_PYTHON])
+    if refresh:
+        cmd += ' refresh'
+    with prefix('export HOME={} && export DATA_DIR={}'.format(DATA_DIR, DATA_DIR)):
+        output = sudo(cmd, user=CHEF_USER)
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            result = json.loads(line[len('RESULT '):])
+            puts(green('Base venv {} {} in {}sec'.format(result['hash'], result['action'], result['seconds'])))
+            return result
+
+
+def _upload_chef_venv_script():
+    for shared_dir in [WHEELHOUSE_DIR, VENVS_DIR]:
+        if not exists(shared_dir):
+            sudo('mkdir -p ' + shared_dir)
+            sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, shared_dir))
+    script_path = os.path.join(VENVS_DIR, 'chef_venv.sh')
+    with hide('running'):
+        put(os.path.join(CONFIG_DIR, 'chef_venv.sh'), script_path, use_sudo=True, mode=0o755)
+    return script_path
+
+
+def _run_chefqueue(command_name, cmd_args):
+    """
+    Run the `command_name` command of config/chefqueue.py in CHEFQUEUE_DIR.
+    Returns the jobs in the `RESULT` lines of its output.
+    """
+    if not exists(CHEFQUEUE_DIR):
+        sudo('mkdir -p ' + CHEFQUEUE_DIR)
+        sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, CHEFQUEUE_DIR))
+        sudo('chmod 700 ' + CHEFQUEUE_DIR)   # job files contain the studio token
+    script_args = ['--queue-dir', CHEFQUEUE_DIR, command_name] + cmd_args
+    return _run_remote_script('chefqueue.py', CHEFQUEUE_DIR, script_args)
+
+
+def _run_webcache(command_name, cmd_args=None, budget_gb=WEBCACHE_BUDGET_GB):
+    """
+    Run the `command_name` command of config/webcache.py on all the chef caches.
+    Returns the dicts in the `RESULT` lines of its output.
+    """
+    if not exists(WEBCACHE_STORE_DIR):
+        sudo('mkdir -p ' + WEBCACHE_STORE_DIR)
+        sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, WEBCACHE_STORE_DIR))
+    script_args = [
+        '--data-dir', DATA_DIR,
+        '--store-dir', WEBCACHE_STORE_DIR,
+        '--budget-gb', str(budget_gb),
+        command_name,
+    ] + (cmd_args or [])
+    return _run_remote_script('webcache.py', DATA_DIR, script_args)   # not in the store
+
+
+def _run_remote_script(script_name, remote_dir, script_args, user=CHEF_USER, upload=True):
+    """
+    Upload the python script `script_name` from CONFIG_DIR to `remote_dir` and
+    run it with `script_args` as `user` (None for root). Returns the parsed json
+    of the lines of its output that start with `RESULT `. Use `upload=False` if
+    the script was already uploaded (repeated calls).
+    """
+    script_path = os.path.join(remote_dir, script_name)
+    if upload:
+        with hide('running'):
+            put(os.path.join(CONFIG_DIR, script_name), script_path, use_sudo=True, mode=0o755)
+            if user:
+                sudo('chown {}:{} {}'.format(user, user, script_path))
+    cmd = ' '.join(quote(arg) for arg in ['python3', script_path] + script_args)
+    with hide('running', 'stdout'):
+        output = sudo(cmd, user=user)
+    results = []
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            results.append(json.loads(line[len('RESULT '):]))
+    return results
+
+
+def _format_size(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return '{:.1f}{}'.format(nbytes, unit)
+        nbytes /= 1024.0
+    return '{:.1f}TB'.format(nbytes)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
 def wrap_in_nohup(cmd):
     """
     This wraps the chef command `cmd` appropriately for it to run in background
@@ -1,16 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import functools
 import json
 import os
 import requirements
+import shutil
 import tempfile
-import xmlrpc.client
+import time
 
 from fabric.api import env, task, local
 from fabric.colors import red, green, blue, yellow
 from fabric.context_managers import hide, lcd
-from fabric.utils import puts
+from fabric.utils import abort, puts
 
-from .github import get_chef_repos
+from .gitclone import GIT_CLONE_MODE, clone_or_fetch
+from .github import get_chef_repos, github_cache_stats
+from .linecount import count_lines, count_lines_in_dirs, generate_benchmark_tree
+from .pypi import get_latest_version, normalize_package_name, prefetch_latest_versions
+from .reportstore import get_stored_report, store_report, invalidate_reports
+from .timing import timed
 
 
 class FabricException(Exception):    # Generic Exception for using Fabric Errors
@@ -42,16 +49,24 @@ REPORT_FIELDS_TO_PRINT = {
     # 'Comments': manually added containing combined comments from all reports
 }
 
+# Pipeline packages whose `==` pins are also compared with the latest on PyPI
+PINNED_PACKAGES_TO_CHECK = ['le-utils', 'pressurecooker']
+
 
 
 # CODE REPORTS
 ################################################################################
+CODE_REPORTS_WORKERS = 8   # number of chef repos analyzed in parallel
+CODE_REPORT_CHECKER_VERSION = 2   # bump when checks change to invalidate stored reports
 
 @task
-def analyze_chef_repo(nickname, repo_name=None, organization='learningequality', branch='master', printing=True):
+@timed
+def analyze_chef_repo(nickname, repo_name=None, organization='learningequality', branch='master', printing=True, cache=True):
     """
     Ruch chef repo convention checks and count LOC for a given chef repo.
+    Set `cache=false` to re-analyze even if the commit was analyzed before.
     """
+    cache = cache not in [False, 'false', 'False']
     if repo_name is None:
         repo_name = 'sushi-chef-' + nickname
     chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
@@ -60,23 +75,7 @@ def analyze_chef_repo(nickname, repo_name=None, organization='learningequality',
     else:
         local_update_chef(None, repo_name=repo_name, branch=branch)
 
-    # The "report" for the chef repo is a dict of checks and data
-    report = {
-        'repo_name': repo_name,
-        'branch': branch,
-    }
-
-    # requirements.txt report
-    requirements_check = check_requirements_txt(repo_name, branch=branch)
-    report['requirements_check'] = requirements_check
-
-    # sushichef.py report
-    sushichef_check = check_sushichef_py(repo_name, branch=branch)
-    report['sushichef_check'] = sushichef_check
-
-    # cloc
-    cloc_data = run_cloc_in_repo(repo_name)
-    report['cloc_data'] = cloc_data
+    report = get_code_report(repo_name, branch=branch, cache=cache)
 
     if printing:
         print_code_reports([report])
@@ -85,26 +84,149 @@ def analyze_chef_repo(nickname, repo_name=None, organization='learningequality',
 
 
 @task
-def analyze_chef_repos(allbranches=False):
+@timed
+def analyze_chef_repos(allbranches=False, workers=CODE_REPORTS_WORKERS, offline=False, cache=True):
     """
     Ruch chef repo convention checks on all repos (based on local code checkout).
+    Repos are fetched and analyzed in parallel by `workers` processes and the
+    report lines are printed as soon as each repo is finished.
+    Use `offline=true` to compare with the cached latest PyPI versions only.
+    Repos whose HEAD commit was analyzed before reuse the stored report, unless
+    `cache=false` is given.
     """
     allbranches = (allbranches and allbranches.lower() == 'true')
+    cache = cache not in [False, 'false', 'False']
+    workers = int(workers)
+    if offline and offline.lower() == 'true':
+        os.environ['PYPI_OFFLINE'] = 'true'   # inherited by the worker processes
+    # lookup latest versions once, so worker processes will find them in cache
+    prefetch_latest_versions(['ricecooker'] + PINNED_PACKAGES_TO_CHECK)
     chef_repos = get_chef_repos()
-    reports = []
-    for i, chef_repo in enumerate(chef_repos):
+    jobs = []
+    for chef_repo in chef_repos:
         organization = chef_repo.owner.login
         repo_name = chef_repo.name
         if allbranches:
-            branches = list(chef_repo.get_branches())
-            for branch in branches:
-                report = analyze_chef_repo(None, repo_name=repo_name, organization=organization, branch=branch.name, printing=False)
-                reports.append(report)
+            branch_names = [branch.name for branch in chef_repo.get_branches()]
         else:
-            report = analyze_chef_repo(None, repo_name=repo_name, organization=organization, branch='master', printing=False)
+            branch_names = ['master']
+        jobs.append((organization, repo_name, branch_names))
+
+    # column widths are computed upfront so lines can be printed as they arrive
+    placeholder_reports = []
+    for organization, repo_name, branch_names in jobs:
+        for branch_name in branch_names:
+            placeholder_reports.append({'repo_name': repo_name, 'branch': branch_name})
+    max_lens = get_report_column_widths(placeholder_reports)
+    print_code_report_header(max_lens)
+
+    reports = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(analyze_repo_branches, *job, cache=cache) for job in jobs]
+        for future in as_completed(futures):
+            for report in future.result():
+                print_code_report_line(report, max_lens)
+                reports.append(report)
+
+    hits = len([r for r in reports if rget(r, 'cache.hit')])
+    puts(green('Code report cache: {} hits, {} misses'.format(hits, len(reports) - hits)))
+    github_cache_stats()
+    return reports
+
+
+@task
+@timed
+def invalidate_code_reports(repo_name=None, branch=None):
+    """
+    Remove stored code reports for a repo (and branch), or for all repos.
+    """
+    count = invalidate_reports(repo_name=repo_name, branch=branch)
+    puts(green('Removed {} stored code reports.'.format(count)))
+
+
+def analyze_repo_branches(organization, repo_name, branch_names, cache=True):
+    """
+    Clone or fetch the chef repo `repo_name` once, then checkout and analyze each
+    of the branches in `branch_names`. Runs in a worker process so it must not
+    print anything; failures are returned as a report with an error comment.
+    """
+    chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
+    reports = []
+    with hide('running', 'stdout', 'stderr', 'user', 'warnings', 'aborts'):
+        try:
+            if not os.path.exists(chef_repo_dir):
+                local_setup_chef(None, repo_name=repo_name, organization=organization, branch=branch_names[0])
+            with lcd(chef_repo_dir):
+                local('git fetch --quiet origin')
+        except FabricException as e:
+            return [_error_report(repo_name, branch_name, 'git fetch failed', e) for branch_name in branch_names]
+        for branch_name in branch_names:
+            try:
+                _checkout_branch(chef_repo_dir, branch_name)
+                report = get_code_report(repo_name, branch=branch_name, cache=cache)
+            except Exception as e:
+                report = _error_report(repo_name, branch_name, 'analysis failed', e)
             reports.append(report)
+    return reports
 
-    print_code_reports(reports)
+
+def get_code_report(repo_name, branch='master', cache=True):
+    """
+    Return the code report for the current HEAD commit of the local checkout of
+    `repo_name`, reusing the stored report if this commit was analyzed before.
+    The requirements check is always re-evaluated since its verdict depends on
+    the latest versions on PyPI and not only on the code.
+    The returned report has an extra `cache` subreport, which is not stored.
+    """
+    chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
+    with lcd(chef_repo_dir), hide('running', 'stdout', 'stderr'):
+        sha = local('git rev-parse HEAD', capture=True).strip()
+    report = None
+    if cache:
+        report = get_stored_report(repo_name, branch, sha, CODE_REPORT_CHECKER_VERSION)
+    if report is not None:
+        report['requirements_check'] = check_requirements_txt(repo_name, branch=branch)
+        report['cache'] = {'hit': True, 'sha': sha}
+    else:
+        report = build_code_report(repo_name, branch=branch)
+        store_report(report, sha, CODE_REPORT_CHECKER_VERSION)
+        report['cache'] = {'hit': False, 'sha': sha}
+    return report
+
+
+def build_code_report(repo_name, branch='master'):
+    """
+    Run all the convention checks and count lines of code in the local checkout of
+    the chef repo `repo_name` (assumed to be already at the right `branch`).
+    """
+    # The "report" for the chef repo is a dict of checks and data
+    report = {
+        'repo_name': repo_name,
+        'branch': branch,
+    }
+
+    # requirements.txt report
+    requirements_check = check_requirements_txt(repo_name, branch=branch)
+    report['requirements_check'] = requirements_check
+
+    # sushichef.py report
+    sushichef_check = check_sushichef_py(repo_name, branch=branch)
+    report['sushichef_check'] = sushichef_check
+
+    # lines of code (cloc-compatible data)
+    cloc_data = count_lines_in_repo(repo_name)
+    report['cloc_data'] = cloc_data
+
+    return report
+
+
+def _error_report(repo_name, branch, message, exception):
+    first_line = str(exception).strip().split('\n')[0]
+    return {
+        'repo_name': repo_name,
+        'branch': branch,
+        'error': {'verdict': '❌', 'comment': message + ': ' + first_line},
+    }
 
 
 
@@ -114,39 +236,58 @@ def analyze_chef_repos(allbranches=False):
 def check_requirements_txt(repo_name, branch='master'):
     """
     Check if repo contains a file `requirements.txt` and if ricecooker version
-    in it is up to date.
+    in it is up to date. Outdated pins of PINNED_PACKAGES_TO_CHECK are noted
+    in the comment of the subreport.
     """
     chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
     requirements_txt = os.path.join(chef_repo_dir, 'requirements.txt')
     if not os.path.exists(requirements_txt):
         return {'verdict':'❌'}
-    else:
-        # get the latest version of ricecooker from PyPI
-        pypi = xmlrpc.client.ServerProxy('https://pypi.python.org/pypi')
-        latest_ricecooker_version = pypi.package_releases('ricecooker')[0]
-
-        # compare with version in requirements.txt
-        with open(requirements_txt, 'r') as reqsf:
-            found = False
-            for req in requirements.parse(reqsf):
-                if req.name.lower() == 'ricecooker':
-                    found = True
-                    if not req.specs:
-                        return {'verdict':'✅ *'} # not pinned so will be latest
-                    else:
-                        reln, version = req.specs[0]   # we assume only one spec
-                        if reln == '==':
-                            if version == latest_ricecooker_version:
-                                return {'verdict': '✅'}   # latest and greatest
-                            if version != latest_ricecooker_version:
-                                return {        
-                                    'verdict': version + ' ⬆️',  # needs upgrade
-                                    'comment': 'Ricecooker needs to be updated',
-                                }    
-                        else:
-                            return {'verdict':'✅ >='}      # >= means is latest
-            if not found:
-                return {'verdict':'❌'}
+    with open(requirements_txt, 'r') as reqsf:
+        reqs = list(requirements.parse(reqsf))
+
+    subreport = _check_ricecooker_requirement(reqs)
+
+    # compare other pinned packages with their latest versions on PyPI
+    outdated = []
+    for req in reqs:
+        if req.name and normalize_package_name(req.name) in PINNED_PACKAGES_TO_CHECK and req.specs:
+            reln, version = req.specs[0]   # we assume only one spec
+            latest_version = get_latest_version(req.name)
+            if reln == '==' and latest_version and version != latest_version:
+                outdated.append('{}=={} (latest {})'.format(req.name, version, latest_version))
+    if outdated:
+        comment = 'Outdated pins: ' + ', '.join(outdated)
+        if 'comment' in subreport:
+            comment = subreport['comment'] + '; ' + comment
+        subreport['comment'] = comment
+    return subreport
+
+
+def _check_ricecooker_requirement(reqs):
+    """
+    Compare the ricecooker requirement in `reqs` with the latest ricecooker.
+    """
+    for req in reqs:
+        if req.name and normalize_package_name(req.name) == 'ricecooker':
+            if not req.specs:
+                return {'verdict':'✅ *'} # not pinned so will be latest
+            reln, version = req.specs[0]   # we assume only one spec
+            if reln != '==':
+                return {'verdict':'✅ >='}      # >= means is latest
+            latest_ricecooker_version = get_latest_version('ricecooker')
+            if latest_ricecooker_version is None:
+                return {
+                    'verdict': version + ' ?',
+                    'comment': 'Latest ricecooker version unknown (offline)',
+                }
+            if version == latest_ricecooker_version:
+                return {'verdict': '✅'}   # latest and greatest
+            return {
+                'verdict': version + ' ⬆️',  # needs upgrade
+                'comment': 'Ricecooker needs to be updated',
+            }
+    return {'verdict':'❌'}
 
 
 def check_sushichef_py(repo_name, branch='master'):
@@ -193,7 +334,16 @@ def print_code_reports(reports):
     """
     Print a table with the attributes REPORT_FIELDS_TO_PRINT from the `report`s.
     """
-    # 0. compute max length of each column so that the table will look nice
+    max_lens = get_report_column_widths(reports)
+    print_code_report_header(max_lens)
+    for report in reports:
+        print_code_report_line(report, max_lens)
+
+
+def get_report_column_widths(reports):
+    """
+    Compute max length of each column so that the table will look nice.
+    """
     max_lens = {}
     for header, attrpath in REPORT_FIELDS_TO_PRINT.items():
         lens = [len(header)]
@@ -202,8 +352,10 @@ def print_code_reports(reports):
             val_str = str(val) if val else ''
             lens.append(len(val_str))
         max_lens[header] = max(lens)
+    return max_lens
+
 
-    # 1. print header line
+def print_code_report_header(max_lens):
     header_strs = []
     for header in REPORT_FIELDS_TO_PRINT.keys():
         max_len = max_lens[header]
@@ -212,58 +364,145 @@ def print_code_reports(reports):
     header_strs.append('Comments')
     print('\t'.join(header_strs))
 
-    # 2. print report lines
-    for report in reports:
 
-        # extract comments from any subreports
-        comments = []
-        for subreport in report.values():
-            if 'comment' in subreport:
-                comments.append(subreport['comment'])
-        combined_comments = '; '.join(comments)
+def print_code_report_line(report, max_lens):
+    # extract comments from any subreports
+    comments = []
+    for subreport in report.values():
+        if isinstance(subreport, dict) and 'comment' in subreport:
+            comments.append(subreport['comment'])
+    combined_comments = '; '.join(comments)
 
-        report_strs = []
-        for header, attrpath in REPORT_FIELDS_TO_PRINT.items():
-            max_len = max_lens[header]
-            val = rget(report, attrpath)
-            val_str = str(val) if val else ''
-            report_str = val_str.ljust(max_len)
-            if '⬆️' in report_str:
-                report_str += ' '
-            report_strs.append(report_str)
-        report_strs.append(combined_comments)
-        print('\t'.join(report_strs))
+    report_strs = []
+    for header, attrpath in REPORT_FIELDS_TO_PRINT.items():
+        max_len = max_lens[header]
+        val = rget(report, attrpath)
+        val_str = str(val) if val else ''
+        report_str = val_str.ljust(max_len)
+        if '⬆️' in report_str:
+            report_str += ' '
+        report_strs.append(report_str)
+    report_strs.append(combined_comments)
+    print('\t'.join(report_strs), flush=True)
 
 
 
 # CODE ANALYSIS
 ################################################################################
 
+def count_lines_in_repo(repo_name):
+    """
+    Count lines of code in the chef repo using the built-in line counter, which
+    produces the same `cloc_data` structure as `cloc --json`.
+    """
+    chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
+    return count_lines(chef_repo_dir)
+
+
 def run_cloc_in_repo(repo_name):
+    chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
+    return run_cloc(chef_repo_dir)
+
+
+def run_cloc(root_dir):
+    """
+    Run the command line tool `cloc` in `root_dir` and return its json output.
+    """
     try:
         with hide('running', 'stdout', 'stderr'):
             local('which cloc')
     except FabricException:
         puts(red('command line tool  cloc  not found. Please install cloc.'))
         return
-    chef_repo_dir = os.path.join(CHEF_REPOS_DIR, repo_name)
     # json tempfile file to store cloc output
     with tempfile.NamedTemporaryFile(suffix='.json') as tmpf:
-        with lcd(chef_repo_dir), hide('running', 'stdout', 'stderr'):
+        with lcd(root_dir), hide('running', 'stdout', 'stderr'):
             local('cloc --exclude-dir=venv . --json > ' + tmpf.name)
         with open(tmpf.name) as jsonf:
             cloc_data = json.load(jsonf)
     return cloc_data
 
 
+@task
+@timed
+def benchmark_line_counter(nfiles=1000, nrepos=8, workers=None):
+    """
+    Compare the built-in line counter with `cloc` for speed and accuracy on a
+    generated tree of `nrepos` fake repos with `nfiles` source files each.
+    """
+    nfiles, nrepos = int(nfiles), int(nrepos)
+    workers = int(workers) if workers else None
+    bench_dir = tempfile.mkdtemp(prefix='linecount-benchmark-')
+    try:
+        puts(green('Generating {} repos with {} files each in {}'.format(nrepos, nfiles, bench_dir)))
+        repo_dirs, expected_datas = [], []
+        for i in range(nrepos):
+            repo_dir = os.path.join(bench_dir, 'repo{}'.format(i))
+            expected_datas.append(generate_benchmark_tree(repo_dir, nfiles, seed=i))
+            repo_dirs.append(repo_dir)
+        expected = _sum_cloc_datas(expected_datas)
+
+        timings = {}
+        start = time.time()
+        linecount_datas = [count_lines(repo_dir) for repo_dir in repo_dirs]
+        timings['linecount'] = time.time() - start
+        start = time.time()
+        count_lines_in_dirs(repo_dirs, workers=workers)
+        timings['linecount (parallel)'] = time.time() - start
+        results = {'linecount': _sum_cloc_datas(linecount_datas)}
+        if shutil.which('cloc'):
+            start = time.time()
+            cloc_datas = [run_cloc(repo_dir) for repo_dir in repo_dirs]
+            timings['cloc'] = time.time() - start
+            results['cloc'] = _sum_cloc_datas(cloc_datas)
+        else:
+            puts(yellow('command line tool  cloc  not found, skipping cloc comparison.'))
+    finally:
+        shutil.rmtree(bench_dir)
+
+    # accuracy table
+    print('\t'.join(['language'.ljust(14), 'counter'.ljust(10), 'nFiles', 'blank', 'comment', 'code', 'matches']))
+    for language in sorted(expected.keys()):
+        rows = [('expected', expected[language])]
+        for counter, data in results.items():
+            rows.append((counter, data.get(language, {})))
+        for counter, counts in rows:
+            matches = all(counts.get(k) == expected[language][k] for k in ['nFiles', 'blank', 'comment', 'code'])
+            print('\t'.join([language.ljust(14), counter.ljust(10)] +
+                            [str(counts.get(k, '')) for k in ['nFiles', 'blank', 'comment', 'code']] +
+                            ['' if counter == 'expected' else ('✅' if matches else '❌')]))
+    # speed table
+    for counter, elapsed in timings.items():
+        print(counter.ljust(22), '{:.3f}s'.format(elapsed),
+              '({:.0f} files/s)'.format(nrepos * nfiles / elapsed if elapsed else 0))
+
+
+def _sum_cloc_datas(cloc_datas):
+    """
+    Add up the per-language counts of several `cloc_data` dicts.
+    """
+    totals = {}
+    for cloc_data in cloc_datas:
+        for language, counts in cloc_data.items():
+            if language in ['header', 'SUM']:
+                continue
+            language_totals = totals.setdefault(language, {'nFiles': 0, 'blank': 0, 'comment': 0, 'code': 0})
+            for key in language_totals.keys():
+                language_totals[key] += counts[key]
+    return totals
+
+
 
 # LOCAL CHEF SETUP
 ################################################################################
 
 @task
-def local_setup_chef(nickname, repo_name=None, cwd=None, organization='learningequality', branch='master'):
+@timed
+def local_setup_chef(nickname, repo_name=None, cwd=None, organization='learningequality', branch='master',
+                     mode=GIT_CLONE_MODE):
     """
     Locally git-clone the repo `sushi-chef-{nickname}` to the dir `chefrepos/`.
+    The clone `mode` is one of blobless (default), shallow, or full.
     """
     if repo_name is None:
         repo_name = 'sushi-chef-' + nickname
@@ -276,8 +515,10 @@ def local_setup_chef(nickname, repo_name=None, cwd=None, organization='learninge
         return
 
     # clone the repo
-    with lcd(CHEF_REPOS_DIR):
-        local('git clone  --quiet  ' + github_ssh_url)
+    result = clone_or_fetch(github_ssh_url, chef_repo_dir, mode=mode)
+    if result['status'] != 'ok':
+        abort('git clone of ' + github_ssh_url + ' failed: ' + result['error'])
+    puts(green('Received {:.1f}MB in {:.1f}s'.format(result['bytes']/1024.0/1024.0, result['seconds'])))
 
     # checkout the desired branch
     with lcd(chef_repo_dir):
@@ -286,6 +527,7 @@ def local_setup_chef(nickname, repo_name=None, cwd=None, organization='learninge
 
 
 @task
+@timed
 def local_unsetup_chef(nickname, repo_name=None):
     """
     Remove the local repo `chefrepos/sushi-chef-{nickname}`.
@@ -301,6 +543,7 @@ def local_unsetup_chef(nickname, repo_name=None):
 
 
 @task
+@timed
 def local_update_chef(nickname, repo_name=None, cwd=None, branch='master'):
     """
     Run pull -f in the local chef repo to update the code to the lastest version.
@@ -311,5 +554,13 @@ def local_update_chef(nickname, repo_name=None, cwd=None, branch='master'):
     puts(green('Updating ' + chef_repo_dir + ' to branch ' + branch))
     with lcd(chef_repo_dir), hide('running', 'stdout', 'stderr'):
         local('git fetch origin  ' + branch)
+    _checkout_branch(chef_repo_dir, branch)
+
+
+def _checkout_branch(chef_repo_dir, branch):
+    """
+    Checkout `branch` in `chef_repo_dir` and reset it to the fetched origin/branch.
+    """
+    with lcd(chef_repo_dir), hide('running', 'stdout', 'stderr'):
         local('git checkout ' + branch)
         local('git reset --hard origin/' + branch)
@@ -0,0 +1,94 @@
+import json
+import os
+from shlex import quote
+
+from fabric.api import task, sudo, put
+from fabric.colors import red, green, yellow
+from fabric.context_managers import hide
+from fabric.contrib.files import exists
+from fabric.utils import puts
+
+from .chefops import _format_size
+from .demoservers import CONFIG_DIR, KOLIBRI_HOME
+from .timing import timed
+
+
+# CONTENT DEDUP SETTINGS
+################################################################################
+# Kolibri stores the files of all channels by checksum, so identical files in
+# the same Kolibri home are already stored once. `dedup_content` verifies the
+# checksums, links identical files in other storage dirs on the same host (e.g.
+# a content mirror), and finds files no channel uses anymore.
+CONTENT_STORAGE_DIR = os.path.join(KOLIBRI_HOME, 'content', 'storage')
+CONTENT_DEDUP_REMOTE_DIR = '/var/cache/contentdedup'   # script and md5 index
+CONTENT_DEDUP_WORKERS = 4    # parallel md5 computations (disk bound)
+
+
+
+# CONTENT DEDUP
+################################################################################
+
+@task
+@timed
+def dedup_content(link=False, delete_orphans=False, workers=CONTENT_DEDUP_WORKERS, roots=None):
+    """
+    Check the content storage of the Kolibri on the host, and of the other storage
+    dirs in `roots` (space-separated). Prints the files whose md5 doesn't match
+    their name, the identical files stored more than once (use `link=true` to
+    replace them with hardlinks), and the files not used by any channel (use
+    `delete_orphans=true` to delete them, but not while channels are imported).
+    Only new or modified files are hashed on subsequent runs.
+    """
+    link = (link and str(link).lower() == 'true')
+    delete_orphans = (delete_orphans and str(delete_orphans).lower() == 'true')
+    if not exists(CONTENT_DEDUP_REMOTE_DIR):
+        sudo('mkdir -p ' + CONTENT_DEDUP_REMOTE_DIR)
+        sudo('chmod 700 ' + CONTENT_DEDUP_REMOTE_DIR)
+    script_path = os.path.join(CONTENT_DEDUP_REMOTE_DIR, 'contentdedup.py')
+    with hide('running'):
+        put(os.path.join(CONFIG_DIR, 'contentdedup.py'), script_path, use_sudo=True, mode=0o700)
+    cmd_args = [
+        'python3', script_path,
+        '--index-file', os.path.join(CONTENT_DEDUP_REMOTE_DIR, 'index.sqlite3'),
+        '--kolibri-home', KOLIBRI_HOME,
+        '--kolibri-storage', CONTENT_STORAGE_DIR,
+        '--workers', str(workers),
+    ]
+    if link:
+        cmd_args.append('--link')
+    if delete_orphans:
+        cmd_args.append('--delete-orphans')
+    cmd_args += roots.split() if roots else []
+    with hide('running', 'stdout'):
+        output = sudo(' '.join(quote(arg) for arg in cmd_args))
+    results = []
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            results.append(json.loads(line[len('RESULT '):]))
+
+    for result in results:
+        if result['type'] == 'corrupted':
+            puts(red('Corrupted: {} (md5 {})'.format(result['path'], result['md5'])))
+        elif result['type'] == 'duplicate':
+            puts(yellow('Duplicate ({}): {}'.format(_format_size(result['size']), ' '.join(result['paths']))))
+    summary = results[-1]
+    print('\t'.join(['files', 'size', 'hashed', 'corrupted', 'duplicates', 'linked', 'orphans', 'time']))
+    print('\t'.join([
+        str(summary['files']),
+        _format_size(summary['bytes']),
+        str(summary['hashed']),
+        str(summary['corrupted']),
+        '{} ({})'.format(summary['duplicate_groups'], _format_size(summary['duplicate_bytes'])),
+        '{} ({} saved)'.format(summary['linked'], _format_size(summary['saved_bytes'])),
+        '{} ({}{})'.format(summary['orphans'], _format_size(summary['orphan_bytes']),
+                           ', deleted' if summary['orphans_deleted'] else '')
+            if summary['orphans_checked'] else 'not checked',
+        '{:.0f}s'.format(summary['seconds']),
+    ]))
+    if not summary['orphans_checked']:
+        puts(yellow('No Kolibri content storage or database in {}, orphans not checked.'.format(KOLIBRI_HOME)))
+    if summary['corrupted']:
+        puts(red('Delete and reimport the channels that use the corrupted files.'))
+    else:
+        puts(green('Content storage checked.'))
+    return summary
@@ -0,0 +1,96 @@
+import os
+
+from fabric.api import env, task, sudo
+from fabric.colors import red, green, yellow
+from fabric.contrib.files import exists, upload_template
+from fabric.utils import puts
+
+from .chefops import CHEF_USER, CONFIG_DIR, DATA_DIR, _format_size, _run_remote_script
+from .timing import timed
+
+
+# CONTENT MIRROR SETTINGS
+################################################################################
+# A host (vader by default) keeps a copy of the channels imported on the demo
+# servers, served by nginx on CONTENT_MIRROR_PORT with the same paths as Studio,
+# so that demoservers import with `--baseurl` (set CONTENT_MIRROR_URL locally).
+CONTENT_MIRROR_DIR = os.path.join(DATA_DIR, 'contentmirror')
+CONTENT_MIRROR_PORT = 8088
+CONTENT_MIRROR_WORKERS = 8    # parallel file downloads from Studio
+
+
+
+# CONTENT MIRROR
+################################################################################
+
+@task
+@timed
+def setup_content_mirror(port=CONTENT_MIRROR_PORT):
+    """
+    Create CONTENT_MIRROR_DIR and configure nginx to serve it on `port`.
+    Use as `fab -R vader setup_content_mirror`.
+    """
+    if not exists(CONTENT_MIRROR_DIR):
+        sudo('mkdir -p ' + CONTENT_MIRROR_DIR)
+        sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, CONTENT_MIRROR_DIR))
+        sudo('chmod 755 ' + CONTENT_MIRROR_DIR)
+    context = {
+        'CONTENT_MIRROR_DIR': CONTENT_MIRROR_DIR,
+        'CONTENT_MIRROR_PORT': port,
+    }
+    upload_template(os.path.join(CONFIG_DIR, 'nginx_mirror.template.conf'),
+                    '/etc/nginx/sites-available/contentmirror.conf',
+                    context=context, use_jinja=True, use_sudo=True, backup=False)
+    sudo('chown root:root /etc/nginx/sites-available/contentmirror.conf')
+    sudo('ln -sf /etc/nginx/sites-available/contentmirror.conf /etc/nginx/sites-enabled/contentmirror.conf')
+    sudo('nginx -t')
+    sudo('service nginx reload')
+    puts(green('Content mirror served on port {}, use CONTENT_MIRROR_URL=http://{}:{}'.format(port, env.host, port)))
+
+
+@task
+@timed
+def sync_content_mirror(channels=None, workers=CONTENT_MIRROR_WORKERS, force=False, prune=False):
+    """
+    Update the mirror with the channels in the `channels_to_import` of all the
+    roles (or the space-separated `channels`). Only channels whose version on
+    Studio changed are synced, and only files not already on the mirror are
+    downloaded. Use `prune=true` to delete the files no channel uses anymore.
+    """
+    force = (force and str(force).lower() == 'true')
+    prune = (prune and str(prune).lower() == 'true')
+    if channels:
+        channel_ids = channels.split()
+    else:
+        channel_ids = sorted(set(channel_id for role in env.roledefs.values()
+                                 for channel_id in role.get('channels_to_import', [])))
+    if not channel_ids and not prune:
+        puts(yellow('No channels to mirror.'))
+        return []
+    if not exists(CONTENT_MIRROR_DIR):
+        sudo('mkdir -p ' + CONTENT_MIRROR_DIR)
+        sudo('chown {}:{} {}'.format(CHEF_USER, CHEF_USER, CONTENT_MIRROR_DIR))
+    script_args = ['--mirror-dir', CONTENT_MIRROR_DIR, '--workers', str(workers)]
+    if force:
+        script_args.append('--force')
+    if prune:
+        script_args.append('--prune')
+    results = _run_remote_script('content_mirror.py', CONTENT_MIRROR_DIR, script_args + channel_ids)
+
+    print('\t'.join(['channel_id'.ljust(32), 'status'.ljust(9), 'version', 'files', 'downloaded', 'size', 'time']))
+    for result in results:
+        if result['channel_id'] == 'PRUNE':
+            puts(green('Pruned {} unused files ({})'.format(result['removed_files'], _format_size(result['removed_bytes']))))
+            continue
+        print('\t'.join([
+            result['channel_id'].ljust(32),
+            (red if result['status'] == 'failed' else green)(result['status'].ljust(9)),
+            '{} -> {}'.format(result['old_version'], result['new_version']),
+            str(result['files']),
+            str(result['downloaded_files']),
+            _format_size(result['downloaded_bytes']),
+            '{:.0f}s'.format(result['seconds']),
+        ]))
+        if result['error']:
+            puts(red(result['channel_id'] + ': ' + result['error']))
+    return results
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import dns.resolver
+import hashlib
 import json
 import os
 import time
@@ -7,17 +8,23 @@ import requests
 import socket
 from urllib.parse import urlparse
 
-from fabric.api import env, task, local, sudo, run, settings
+from fabric.api import env, execute, task, local, sudo, run, settings
 from fabric.api import get, put, require
 from fabric.colors import red, green, blue, yellow
 from fabric.context_managers import cd, prefix, show, hide, shell_env
 from fabric.contrib.files import exists, sed, upload_template
-from fabric.utils import puts
+from fabric.utils import abort, puts
+
+from .chefops import _run_remote_script
+from .fleet import get_fleet_targets
+from .timing import timed
 
 
 # LOCAL SETTINGS
 ################################################################################
 CONFIG_DIR = './config'
+ARTIFACTS_DIR = os.path.join('cache', 'artifacts')   # pex files stored by sha256
+ARTIFACTS_INDEX_FILE = os.path.join(ARTIFACTS_DIR, 'index.json')   # url --> sha256
 
 
 # KOLIBRI SETTINGS
@@ -31,6 +38,24 @@ KOLIBRI_USER = 'kolibri'
 KOLIBRI_RUN_MODE="demoserver"
 
 
+# CHANNEL IMPORT SETTINGS
+IMPORT_METADATA_WORKERS = 3   # parallel `importchannel` (small downloads, sqlite writes)
+IMPORT_CONTENT_WORKERS = 2    # parallel `importcontent` (limited by disk and bandwidth)
+CONTENT_MIRROR_URL = os.environ.get('CONTENT_MIRROR_URL', None)  # e.g. http://eslgenie.com:8088
+
+# ROLLING UPDATE SETTINGS
+ROLLING_UPDATE_BATCH_SIZE = 3   # demoservers updated at the same time
+PEX_PUSH_POOL_SIZE = 10         # demoservers receiving the pex at the same time
+
+# NGINX SETTINGS
+NGINX_PROFILES = ['default', 'performance']   # set with 'nginx_profile' in a role
+NGINX_PROFILE_DEFAULT = 'default'
+NGINX_CACHE_DIR = '/var/cache/nginx/kolibri'  # API micro-cache (performance profile)
+NGINX_BENCHMARKS_FILE = os.path.join('cache', 'nginx_benchmarks.jsonl')
+NGINX_BENCHMARK_API_PATHS = ['/api/public/v1/channels', '/api/public/info/']
+NGINX_BENCHMARK_MAX_BYTES = 8*1024*1024   # bytes requested from larger content files
+
+
 KOLIBRI_PROVISIONDEVICE_PRESET = "formal"  # other options "nonformal" "informal"
 KOLIBRI_PROVISIONDEVICE_SUPERUSER_USERNAME = "devowner"
 KOLIBRI_PROVISIONDEVICE_SUPERUSER_PASSWORD = "admin123"
@@ -42,6 +67,7 @@ KOLIBRI_PROVISIONDEVICE_SUPERUSER_PASSWORD = "admin123"
 ################################################################################
 
 @task
+@timed
 def demoserver():
     """
     Main setup command that does all the steps.
@@ -50,14 +76,15 @@ def demoserver():
     download_kolibri()
     configure_nginx()
     configure_kolibri()
-    restart_kolibri(post_restart_sleep=30)  # wait for DB migration to happen...
+    restart_kolibri(wait=True)  # wait for DB migration to happen...
     provisiondevice()
     import_channels()
-    restart_kolibri()
+    restart_kolibri(wait=True)
     puts(green('Kolibri demo server setup complete.'))
 
 
 @task
+@timed
 def update_kolibri(kolibri_lang=KOLIBRI_LANG_DEFAULT):
     """
     Use this task to re-install kolibri:
@@ -71,11 +98,178 @@ def update_kolibri(kolibri_lang=KOLIBRI_LANG_DEFAULT):
     download_kolibri()
     # no nginx, because already confured
     configure_kolibri(kolibri_lang=kolibri_lang)
-    restart_kolibri(post_restart_sleep=30)  # wait for DB migration to happen...
+    restart_kolibri(wait=True)  # wait for DB migration to happen...
     # no need to provisiondevice; we assume facily has already been created
     import_channels()
-    restart_kolibri()
+    ready_seconds = restart_kolibri(wait=True)
     puts(green('Kolibri server update complete.'))
+    return ready_seconds
+
+
+
+# ROLLING UPDATES
+################################################################################
+
+@task
+@timed
+def rolling_update_kolibri(batch_size=ROLLING_UPDATE_BATCH_SIZE, roles=None, kolibri_lang=KOLIBRI_LANG_DEFAULT):
+    """
+    Run `update_kolibri` on all the demoservers in the inventory (or on the space-
+    separated list of `roles`), `batch_size` hosts at a time in parallel. A host
+    is done when Kolibri answers again after the update; the rollout stops after
+    the first batch that has a failed host. Run without -R/-H, e.g.,
+    `fab "rolling_update_kolibri:batch_size=3,roles=demo-ar alejandro-demo"`.
+    """
+    if env.host_string:
+        abort('Run rolling_update_kolibri without -R or -H (use the roles argument).')
+    batch_size = max(1, int(batch_size))
+    targets = _get_demoserver_targets(roles)
+    fetch_kolibri_pex()   # download once before forking, not in every host process
+    batches = [targets[i:i+batch_size] for i in range(0, len(targets), batch_size)]
+    puts(green('Updating {} demoservers to {} in {} batches of at most {} hosts.'.format(
+        len(targets), KOLIBRI_PEX_FILE, len(batches), batch_size)))
+
+    results = []
+    start = time.time()
+    for batch_number, batch in enumerate(batches, 1):
+        batch_start = time.time()
+        puts(blue('Batch {}/{}: {}'.format(batch_number, len(batches), ' '.join(t[0] for t in batch))))
+        with settings(parallel=True, pool_size=len(batch)):
+            host_results = execute(_update_kolibri_host, kolibri_lang, hosts=[t[1] for t in batch])
+        for role_name, host, role in batch:
+            result = host_results.get(host)
+            if not isinstance(result, dict):   # the host process died without a result
+                result = {'status': 'failed', 'seconds': 0, 'ready_seconds': 0,
+                          'detail': str(result)}
+            result.update({'role_name': role_name, 'host': host, 'batch': batch_number})
+            results.append(result)
+        failed = [r for r in results if r['batch'] == batch_number and r['status'] != 'ok']
+        puts('Batch {} done in {:.0f}sec'.format(batch_number, time.time() - batch_start))
+        if failed:
+            puts(red('Stopping the rollout: update failed on ' + ', '.join(r['role_name'] for r in failed)))
+            for later_batch in batches[batch_number:]:
+                for role_name, host, role in later_batch:
+                    results.append({'role_name': role_name, 'host': host, 'batch': None,
+                                    'status': 'skipped', 'seconds': 0, 'ready_seconds': 0, 'detail': ''})
+            break
+
+    print_rolling_update_results(results, time.time() - start)
+    if any(r['status'] != 'ok' for r in results):
+        abort('Rolling update incomplete.')
+    puts(green('Rolling update complete.'))
+
+
+def print_rolling_update_results(results, elapsed):
+    """
+    Print tab-separated table of per-host update times for a rolling update.
+    """
+    status_colors = {'ok': green, 'failed': red, 'skipped': yellow}
+    print('\t'.join(['role', 'host', 'batch', 'status', 'update', 'ready', 'detail']))
+    for result in results:
+        print('\t'.join([
+            result['role_name'],
+            result['host'],
+            str(result['batch'] or ''),
+            status_colors[result['status']](result['status']),
+            '{:.0f}s'.format(result['seconds']),
+            '{:.1f}s'.format(result['ready_seconds']),
+            result['detail'],
+        ]))
+    total = sum(r['seconds'] for r in results)
+    print('Rolling update took {:.0f}s (sequential time would be {:.0f}s)'.format(elapsed, total))
+
+
+def _update_kolibri_host(kolibri_lang):
+    """
+    Run `update_kolibri` on the current host and return a result dict (since the
+    rolling update runs hosts in parallel processes, errors are not raised).
+    """
+    start = time.time()
+    try:
+        ready_seconds = update_kolibri(kolibri_lang=kolibri_lang)
+        status, detail = 'ok', ''
+    except (Exception, SystemExit) as e:   # SystemExit is raised by fab abort()
+        ready_seconds = 0
+        status, detail = 'failed', str(e).strip().split('\n')[0] or e.__class__.__name__
+    return {
+        'status': status,
+        'seconds': time.time() - start,
+        'ready_seconds': ready_seconds or 0,
+        'detail': detail,
+    }
+
+
+
+# KOLIBRI PEX ARTIFACTS
+################################################################################
+
+@task
+@timed
+def push_kolibri_pex(pool_size=PEX_PUSH_POOL_SIZE, roles=None):
+    """
+    Download the pex from KOLIBRI_PEX_URL once and install it on all demoservers
+    (or on the space-separated list of `roles`) in parallel. Hosts that already
+    have it are skipped. Kolibri must then be restarted to use the new pex.
+    Run without -R/-H, e.g., `fab push_kolibri_pex:pool_size=10`.
+    """
+    if env.host_string:
+        abort('Run push_kolibri_pex without -R or -H (use the roles argument).')
+    targets = _get_demoserver_targets(roles)
+    fetch_kolibri_pex()   # before forking so that all hosts use the same local file
+    with settings(parallel=True, pool_size=max(1, int(pool_size))):
+        execute(download_kolibri, hosts=[target[1] for target in targets])
+    puts(green('Kolibri pex {} installed on {} demoservers.'.format(KOLIBRI_PEX_FILE, len(targets))))
+
+
+def fetch_kolibri_pex(url=KOLIBRI_PEX_URL):
+    """
+    Download the pex at `url` to the local artifact cache ARTIFACTS_DIR, unless
+    it was already downloaded. Returns the local path and the sha256 checksum.
+    """
+    index = {}
+    if os.path.exists(ARTIFACTS_INDEX_FILE):
+        with open(ARTIFACTS_INDEX_FILE) as indexf:
+            index = json.load(indexf)
+    if url in index:
+        pex_sha256 = index[url]['sha256']
+        pex_path = os.path.join(ARTIFACTS_DIR, pex_sha256)
+        if os.path.exists(pex_path):
+            return pex_path, pex_sha256
+
+    puts('Downloading ' + url + ' to the local artifact cache.')
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    tmp_path = os.path.join(ARTIFACTS_DIR, 'download.{}.tmp'.format(os.getpid()))
+    sha256 = hashlib.sha256()
+    with requests.get(url, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        with open(tmp_path, 'wb') as tmpf:
+            for chunk in response.iter_content(chunk_size=1024*1024):
+                sha256.update(chunk)
+                tmpf.write(chunk)
+    pex_sha256 = sha256.hexdigest()
+    pex_path = os.path.join(ARTIFACTS_DIR, pex_sha256)
+    os.replace(tmp_path, pex_path)
+    index[url] = {
+        'sha256': pex_sha256,
+        'size': os.path.getsize(pex_path),
+        'filename': os.path.basename(url.split("?")[0]),
+        'downloaded': time.time(),
+    }
+    with open(ARTIFACTS_INDEX_FILE + '.tmp', 'w') as indexf:
+        json.dump(index, indexf, indent=2, sort_keys=True)
+    os.replace(ARTIFACTS_INDEX_FILE + '.tmp', ARTIFACTS_INDEX_FILE)
+    return pex_path, pex_sha256
+
+
+def _get_remote_sha256(path):
+    """
+    Returns the sha256 of the file at `path` on the host, or None if missing.
+    """
+    with settings(warn_only=True), hide('running', 'stdout', 'stderr', 'warnings'):
+        output = sudo('sha256sum ' + path)
+    if output.failed or not output.strip():
+        return None
+    return output.split()[0]
 
 
 
@@ -83,6 +277,7 @@ def update_kolibri(kolibri_lang=KOLIBRI_LANG_DEFAULT):
 ################################################################################
 
 @task
+@timed
 def install_base():
     """
     Install base system pacakges, add swap, and create application user.
@@ -117,34 +312,66 @@ def install_base():
 
 
 @task
-def download_kolibri():
+@timed
+def download_kolibri(push=True):
     """
-    Downloads and installs Kolibri `.pex` file to KOLIBRI_HOME.
+    Installs the Kolibri `.pex` file from KOLIBRI_PEX_URL to KOLIBRI_HOME, unless
+    the host already has the same file (sha256 checksum). The pex is downloaded
+    once to the local artifact cache and uploaded to the host; use `push=false`
+    to have the host download it from KOLIBRI_PEX_URL instead.
     """
+    push = push in [True, 'true', 'True']
+    pex_path, pex_sha256 = fetch_kolibri_pex()
+    remote_pex_path = os.path.join(KOLIBRI_HOME, KOLIBRI_PEX_FILE)
     if not exists(KOLIBRI_HOME):
         sudo('mkdir -p ' + KOLIBRI_HOME)
         sudo('chmod 777 ' + KOLIBRI_HOME)
-    with cd(KOLIBRI_HOME):
-        sudo('wget --no-verbose "{}" -O {}'.format(KOLIBRI_PEX_URL, KOLIBRI_PEX_FILE))
-    sudo('chown -R {}:{}  {}'.format(KOLIBRI_USER, KOLIBRI_USER, KOLIBRI_HOME))
+    if _get_remote_sha256(remote_pex_path) == pex_sha256:
+        puts(green('Kolibri pex {} already installed (same sha256).'.format(KOLIBRI_PEX_FILE)))
+        return
+    tmp_pex_path = remote_pex_path + '.download'
+    if push:
+        put(pex_path, tmp_pex_path, use_sudo=True, mode=0o644)
+    else:
+        sudo('wget --no-verbose "{}" -O {}'.format(KOLIBRI_PEX_URL, tmp_pex_path))
+    remote_sha256 = _get_remote_sha256(tmp_pex_path)
+    if remote_sha256 != pex_sha256:
+        sudo('rm -f ' + tmp_pex_path)
+        abort('Checksum mismatch for {} on host: {} != {}'.format(KOLIBRI_PEX_FILE, remote_sha256, pex_sha256))
+    sudo('mv {} {}'.format(tmp_pex_path, remote_pex_path))
+    # only the pex changed, so no need to chown -R the content in KOLIBRI_HOME
+    sudo('chown {}:{} {} {}'.format(KOLIBRI_USER, KOLIBRI_USER, KOLIBRI_HOME, remote_pex_path))
     puts(green('Kolibri pex downloaded.'))
 
 
 @task
-def configure_nginx():
+@timed
+def configure_nginx(profile=None):
     """
     Perform necessary NGINX configurations to forward HTTP traffic to kolibri.
+    The `profile` (default: the role's 'nginx_profile', else NGINX_PROFILE_DEFAULT)
+    selects the site config: `performance` serves content files with sendfile,
+    open file cache and long-lived cache headers, gzips the API responses, keeps
+    connections to Kolibri alive and micro-caches the anonymous API responses.
     """
-    current_role = env.effective_roles[0]
+    current_role = _current_role()
     demo_server_hostname = env.roledefs[current_role]['hostname']
+    if profile is None:
+        profile = env.roledefs[current_role].get('nginx_profile', NGINX_PROFILE_DEFAULT)
+    if profile not in NGINX_PROFILES:
+        abort('nginx profile must be one of ' + ', '.join(NGINX_PROFILES))
 
     if exists('/etc/nginx/sites-enabled/default'):
         sudo('rm /etc/nginx/sites-enabled/default')
+    if profile == 'performance':
+        sudo('mkdir -p ' + NGINX_CACHE_DIR)
+        sudo('chown www-data:www-data ' + NGINX_CACHE_DIR)
     context = {
         'INSTANCE_PUBLIC_IP': env.host,
         'DEMO_SERVER_HOSTNAME': demo_server_hostname,
         'KOLIBRI_HOME': KOLIBRI_HOME,
         'KOLIBRI_PORT': KOLIBRI_PORT,
+        'NGINX_PROFILE': profile,
     }
     if exists('/etc/nginx/sites-enabled/kolibri.conf'):
         sudo('rm /etc/nginx/sites-enabled/kolibri.conf')
@@ -154,11 +381,13 @@ def configure_nginx():
     sudo('chown root:root /etc/nginx/sites-available/kolibri.conf')
     sudo('ln -s /etc/nginx/sites-available/kolibri.conf /etc/nginx/sites-enabled/kolibri.conf')
     sudo('chown root:root /etc/nginx/sites-enabled/kolibri.conf')
+    sudo('nginx -t')   # a broken config would make the reload fail silently
     sudo('service nginx reload')
-    puts(green('NGINX site kolibri.conf configured.'))
+    puts(green('NGINX site kolibri.conf configured ({} profile).'.format(profile)))
 
 
 @task
+@timed
 def configure_kolibri(kolibri_lang=KOLIBRI_LANG_DEFAULT):
     """
     Upload kolibri startup script and configure supervisor
@@ -190,16 +419,17 @@ def configure_kolibri(kolibri_lang=KOLIBRI_LANG_DEFAULT):
                     context=context, use_jinja=True, use_sudo=True, backup=False)
     sudo('chown root:root /etc/supervisor/conf.d/kolibri.conf')
     sudo('service supervisor restart')
-    time.sleep(1)
+    wait_for_supervisor()
     puts(green('Kolibri start script and supervisor config done.'))
 
 
 @task
+@timed
 def provisiondevice():
     """
     Provision Kolibri facility. Works for Kolibri versions 0.9 and later.
     """
-    current_role = env.effective_roles[0]
+    current_role = _current_role()
     role = env.roledefs[current_role]
     facility_name = role.get('facility_name', current_role.replace('-', ' '))
     prfx = 'export KOLIBRI_RUN_MODE="{}"'.format(KOLIBRI_RUN_MODE)
@@ -220,18 +450,84 @@ def provisiondevice():
 
 
 @task
-def import_channels():
+@timed
+def import_channels(metadata_workers=IMPORT_METADATA_WORKERS, content_workers=IMPORT_CONTENT_WORKERS, force=False, mirror=None):
     """
     Import the channels in `channels_to_import` using the command line interface.
+    Metadata imports run in parallel and each channel's content download starts
+    as soon as its metadata is imported (at most `content_workers` at a time).
+    Channels already imported at the latest version are skipped unless `force`.
+    Channels are imported from the content mirror at CONTENT_MIRROR_URL when it
+    is set (channels not on the mirror come from Studio); use `mirror=false` to
+    import everything from Studio.
     """
-    current_role = env.effective_roles[0]
+    force = force in [True, 'true', 'True']
+    use_mirror = CONTENT_MIRROR_URL is not None and mirror not in [False, 'false', 'False']
+    if mirror in [True, 'true', 'True'] and CONTENT_MIRROR_URL is None:
+        abort('Set the env variable CONTENT_MIRROR_URL to import from a content mirror.')
+    current_role = _current_role()
     channels_to_import = env.roledefs[current_role]['channels_to_import']
-    for channel_id in channels_to_import:
-        import_channel(channel_id)
-    puts(green('Channels ' + str(channels_to_import) + ' imported.'))
+    if not channels_to_import:
+        puts(yellow('No channels_to_import for role ' + current_role))
+        return []
+
+    scheduler_path = os.path.join(KOLIBRI_HOME, 'import_channels.py')
+    put(os.path.join(CONFIG_DIR, 'import_channels.py'), scheduler_path, use_sudo=True, mode=0o755)
+    sudo('chown {}:{} {}'.format(KOLIBRI_USER, KOLIBRI_USER, scheduler_path))
+    cmd = 'python3 ' + scheduler_path
+    cmd += ' --kolibri-home ' + KOLIBRI_HOME
+    cmd += ' --pex ' + os.path.join(KOLIBRI_HOME, KOLIBRI_PEX_FILE)
+    cmd += ' --metadata-workers ' + str(metadata_workers)
+    cmd += ' --content-workers ' + str(content_workers)
+    if force:
+        cmd += ' --force'
+    if use_mirror:
+        cmd += ' --baseurl ' + CONTENT_MIRROR_URL
+    cmd += ' ' + ' '.join(channels_to_import)
+    with settings(warn_only=True), hide('running'):
+        output = sudo(cmd, user=KOLIBRI_USER)
+
+    results = []
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            results.append(json.loads(line[len('RESULT '):]))
+    print_import_results(results)
+    stale_channels = [result['channel_id'] for result in results
+                      if result.get('mirror_version') is not None and not result['baseurl']]
+    if stale_channels:
+        puts(yellow('Channels imported from Studio because the mirror has another version: ' +
+                    ', '.join(stale_channels) + ' (run sync_content_mirror)'))
+    if output.failed:
+        puts(red('Some channel imports failed, see logs in ' + os.path.join(KOLIBRI_HOME, 'import_logs')))
+    else:
+        puts(green('Channels ' + str(channels_to_import) + ' imported.'))
+    return results
+
+
+def print_import_results(results):
+    """
+    Print tab-separated table of per-channel import times and throughput.
+    """
+    print('\t'.join(['channel_id'.ljust(32), 'status'.ljust(15), 'source', 'version', 'metadata', 'content', 'size', 'throughput']))
+    for result in results:
+        size_mb = result['size'] / 1024.0 / 1024.0
+        content_seconds = result['content_seconds']
+        throughput = '{:.2f} MB/s'.format(size_mb / content_seconds) if content_seconds else ''
+        version = '{} -> {}'.format(result['local_version'], result['remote_version'])
+        print('\t'.join([
+            result['channel_id'].ljust(32),
+            result['status'].ljust(15),
+            'mirror' if result.get('baseurl') else 'studio',
+            version,
+            '{:.0f}s'.format(result['metadata_seconds']),
+            '{:.0f}s'.format(content_seconds),
+            '{:.1f} MB'.format(size_mb),
+            throughput,
+        ]))
 
 
 @task
+@timed
 def import_channel(channel_id):
     """
     Import the channels in `channels_to_import` using the command line interface.
@@ -245,6 +541,7 @@ def import_channel(channel_id):
 
 
 @task
+@timed
 def generateuserdata():
     """
     Generates student usage data to demonstrate more of Kolibri's functionality.
@@ -256,22 +553,266 @@ def generateuserdata():
 
 
 @task
-def restart_kolibri(post_restart_sleep=0):
+@timed
+def restart_kolibri(post_restart_sleep=0, wait=False):
+    """
+    Restart kolibri. Use `wait=true` to return only once the server answers.
+    """
+    wait = wait in [True, 'true', 'True']
+    post_restart_sleep = int(post_restart_sleep)
     sudo('supervisorctl restart kolibri')
     if post_restart_sleep > 0:
         puts(green('Taking a pause for ' + str(post_restart_sleep) + 'sec to let migrations run...'))
         time.sleep(post_restart_sleep)
+    if wait:
+        return wait_for_kolibri()
+
+
+# READINESS PROBES
+################################################################################
+KOLIBRI_READY_TIMEOUT = 900     # deadline in sec (migrations on f1-micro are slow)
+KOLIBRI_READY_MAX_DELAY = 15    # max sec between two polls (exponential backoff)
+SUPERVISOR_READY_TIMEOUT = 30
+READINESS_LOG_FILE = os.path.join('cache', 'kolibri_readiness.jsonl')
+
+@task
+@timed
+def wait_for_kolibri(timeout=KOLIBRI_READY_TIMEOUT):
+    """
+    Poll the supervisor status and the Kolibri HTTP port KOLIBRI_PORT on the
+    host until Kolibri answers, using exponential backoff until `timeout` sec.
+    Time-to-ready is appended to READINESS_LOG_FILE to track regressions.
+    """
+    timeout = int(timeout)
+    start = time.time()
+    delay = 1
+    attempts = 0
+    puts(green('Waiting for Kolibri to be ready (timeout {}sec)...'.format(timeout)))
+    while True:
+        attempts += 1
+        supervisor_state, http_code = _get_kolibri_readiness()
+        elapsed = time.time() - start
+        if supervisor_state == 'RUNNING' and http_code.startswith(('2', '3')):
+            status = 'ready'
+            break
+        if supervisor_state in ['FATAL', 'EXITED', 'STOPPED']:
+            status = 'failed'
+            break
+        if elapsed + delay > timeout:
+            status = 'timeout'
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, KOLIBRI_READY_MAX_DELAY)
+    _record_readiness(status, elapsed, attempts, supervisor_state, http_code)
+    if status != 'ready':
+        abort('Kolibri not ready after {:.0f}sec (supervisor={}, http={})'.format(
+            elapsed, supervisor_state, http_code))
+    puts(green('Kolibri ready after {:.1f}sec ({} polls).'.format(elapsed, attempts)))
+    return elapsed
+
+
+def wait_for_supervisor(timeout=SUPERVISOR_READY_TIMEOUT):
+    """
+    Wait until supervisord accepts commands again after `service supervisor restart`.
+    """
+    start = time.time()
+    delay = 0.5
+    while True:
+        with settings(warn_only=True), hide('running', 'stdout', 'stderr', 'warnings'):
+            result = sudo('supervisorctl status kolibri')
+        if 'refused connection' not in result and 'no such file' not in result.lower():
+            return time.time() - start
+        if time.time() - start + delay > timeout:
+            abort('supervisord not answering after {}sec'.format(timeout))
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+@task
+@timed
+def kolibri_readiness_report():
+    """
+    Print time-to-ready statistics per host from READINESS_LOG_FILE.
+    """
+    if not os.path.exists(READINESS_LOG_FILE):
+        puts(yellow('No readiness data in ' + READINESS_LOG_FILE))
+        return
+    records_by_host = defaultdict(list)
+    with open(READINESS_LOG_FILE) as logf:
+        for line in logf:
+            record = json.loads(line)
+            records_by_host[(record['role'], record['host'])].append(record)
+    print('\t'.join(['role', 'host', 'runs', 'failed', 'last', 'median', 'max']))
+    for (role, host), records in sorted(records_by_host.items()):
+        times = sorted(r['seconds'] for r in records if r['status'] == 'ready')
+        failed = len([r for r in records if r['status'] != 'ready'])
+        last = records[-1]
+        print('\t'.join([
+            role, host, str(len(records)), str(failed),
+            '{:.1f}s ({})'.format(last['seconds'], last['status']),
+            '{:.1f}s'.format(times[len(times)//2]) if times else '',
+            '{:.1f}s'.format(times[-1]) if times else '',
+        ]))
+
+
+def _get_kolibri_readiness():
+    """
+    Returns the supervisor state of kolibri and the HTTP status code of the
+    Kolibri server (`000` if not answering), both obtained in one remote call.
+    """
+    cmd = 'supervisorctl status kolibri; echo "HTTP_CODE=$(curl -s -o /dev/null --max-time 5'
+    cmd += " -w '%{http_code}' http://127.0.0.1:" + str(KOLIBRI_PORT) + '/)"'
+    with settings(warn_only=True), hide('running', 'stdout', 'stderr', 'warnings'):
+        output = sudo(cmd)
+    supervisor_state, http_code = 'UNKNOWN', '000'
+    for line in output.splitlines():
+        if line.startswith('kolibri') and len(line.split()) > 1:
+            supervisor_state = line.split()[1]
+        elif line.startswith('HTTP_CODE='):
+            http_code = line.split('=', 1)[1].strip() or '000'
+    return supervisor_state, http_code
+
+
+def _record_readiness(status, elapsed, attempts, supervisor_state, http_code):
+    record = {
+        'timestamp': time.time(),
+        'role': _current_role() or '',
+        'host': env.host_string,
+        'kolibri_pex': KOLIBRI_PEX_FILE,
+        'status': status,
+        'seconds': elapsed,
+        'attempts': attempts,
+        'supervisor_state': supervisor_state,
+        'http_code': http_code,
+    }
+    os.makedirs(os.path.dirname(READINESS_LOG_FILE), exist_ok=True)
+    with open(READINESS_LOG_FILE, 'a') as logf:
+        logf.write(json.dumps(record) + '\n')
 
 
 @task
+@timed
 def stop_kolibri():
     sudo('supervisorctl stop kolibri')
 
 
 @task
+@timed
 def delete_kolibri():
     stop_kolibri()
     sudo('rm -rf ' + KOLIBRI_HOME)
     sudo('rm /etc/nginx/sites-available/kolibri.conf /etc/nginx/sites-enabled/kolibri.conf')
     sudo('rm /etc/supervisor/conf.d/kolibri.conf')
 
+
+
+# NGINX BENCHMARKS
+################################################################################
+
+@task
+@timed
+def benchmark_nginx(num_requests=500, concurrency=10, label=None):
+    """
+    Load test nginx on the host (over loopback, so the network is not measured):
+    `num_requests` GETs with `concurrency` keep-alive connections for content
+    files of representative sizes (range requests of NGINX_BENCHMARK_MAX_BYTES
+    for larger files) and for each of NGINX_BENCHMARK_API_PATHS. Results are appended
+    to NGINX_BENCHMARKS_FILE with `label` (default: the nginx profile of the role)
+    and compared with the previous run on the same host, e.g., before and after
+    `configure_nginx:profile=performance`.
+    """
+    current_role = _current_role()
+    role = env.roledefs[current_role]
+    if label is None:
+        label = role.get('nginx_profile', NGINX_PROFILE_DEFAULT)
+    previous = _load_last_benchmark(env.host)
+    script_args = [
+        '--host-header', role['hostname'],
+        '--storage-dir', os.path.join(KOLIBRI_HOME, 'content', 'storage'),
+        '--requests', str(int(num_requests)),
+        '--concurrency', str(int(concurrency)),
+        '--max-size', str(NGINX_BENCHMARK_MAX_BYTES),
+        '--api-paths',
+    ] + NGINX_BENCHMARK_API_PATHS
+    results = _run_remote_script('loadtest.py', '/tmp', script_args, user=None)
+    record = {
+        'timestamp': time.time(),
+        'role': current_role or '',
+        'host': env.host,
+        'label': label,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(NGINX_BENCHMARKS_FILE), exist_ok=True)
+    with open(NGINX_BENCHMARKS_FILE, 'a') as benchmarksf:
+        benchmarksf.write(json.dumps(record) + '\n')
+    print_benchmark_results(record, previous)
+    return record
+
+
+def print_benchmark_results(record, previous=None):
+    previous_results = {}
+    if previous:
+        previous_results = dict((result['test'], result) for result in previous['results'])
+        puts(green('Compared with the previous run ({}) of {}.'.format(
+            previous['label'], time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['timestamp'])))))
+    print('\t'.join(['test', 'rps', 'MB/s', 'p50', 'p90', 'p99', 'errors', 'cache_hits', 'previous_rps']))
+    for result in record['results']:
+        previous_result = previous_results.get(result['test'])
+        print('\t'.join([
+            result['test'],
+            '{:.1f}'.format(result['rps']),
+            '{:.1f}'.format(result['mb_per_sec']),
+            '{:.0f}ms'.format(result['p50_ms']),
+            '{:.0f}ms'.format(result['p90_ms']),
+            '{:.0f}ms'.format(result['p99_ms']),
+            str(result['errors']),
+            str(result['cache_hits']),
+            '{:.1f} ({:+.0f}%)'.format(previous_result['rps'], 100.0 * (result['rps'] / previous_result['rps'] - 1))
+                if previous_result and previous_result['rps'] else '',
+        ]))
+
+
+def _load_last_benchmark(host):
+    if not os.path.exists(NGINX_BENCHMARKS_FILE):
+        return None
+    last = None
+    with open(NGINX_BENCHMARKS_FILE) as benchmarksf:
+        for line in benchmarksf:
+            if line.strip():
+                record = json.loads(line)
+                if record['host'] == host:
+                    last = record
+    return last
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _current_role():
+    """
+    Returns the name of the role of the current host: the role given with -R, or
+    the role whose hosts include the current host (for tasks run with `execute`).
+    Returns None if the host is not in any role.
+    """
+    if env.effective_roles:
+        return env.effective_roles[0]
+    for role_name, role in sorted(env.roledefs.items()):
+        if env.host in role.get('hosts', []):
+            return role_name
+    return None
+
+
+def _get_demoserver_targets(roles=None):
+    """
+    Returns the fleet targets of all the demoservers in `env.roledefs`, or of the
+    roles in `roles` (space-separated role names).
+    """
+    targets = get_fleet_targets(require='hostname')
+    if roles:
+        role_names = roles.split()
+        unknown_roles = set(role_names) - set(target[0] for target in targets)
+        if unknown_roles:
+            abort('Unknown demoserver roles: ' + ', '.join(sorted(unknown_roles)))
+        targets = [target for target in targets if target[0] in role_names]
+    return targets
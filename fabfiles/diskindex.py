@@ -0,0 +1,224 @@
+import base64
+import fnmatch
+import gzip
+import json
+import os
+from shlex import quote
+import time
+
+from fabric.api import env, execute, task, sudo, put, settings
+from fabric.colors import green, yellow
+from fabric.context_managers import hide
+from fabric.contrib.files import exists
+from fabric.utils import abort, puts
+
+from .chefops import DATA_DIR, CONFIG_DIR, _format_size
+from .demoservers import KOLIBRI_HOME, _current_role
+from .timing import timed
+
+
+# DISK INDEX SETTINGS
+################################################################################
+# The remote indexer config/diskindex.py keeps its incremental state on each
+# host, and every run appends a snapshot of the directory sizes to a jsonl file
+# per host in DISK_INDEX_LOCAL_DIR, used by `disk_index_report`.
+DISK_INDEX_ROOTS = [DATA_DIR, KOLIBRI_HOME]   # roots missing on a host are skipped
+DISK_INDEX_DEPTH = 3             # directory sizes kept in the snapshots
+DISK_INDEX_FULL_SCAN_DAYS = 7    # full rescans to pick up old files that grew
+DISK_INDEX_REMOTE_DIR = '/var/cache/diskindex'
+DISK_INDEX_LOCAL_DIR = os.path.join('cache', 'diskindex')
+DISK_INDEX_POOL_SIZE = 10
+
+# Parts of chef repos shown in the per-chef breakdown
+CHEF_DIR_PATTERN = 'sushi-chef-*'
+CHEF_DIR_PARTS = ['.webcache', 'venv', 'chefdata', 'storage', 'restore', '.git']
+
+
+
+# DISK INDEX COLLECTION
+################################################################################
+
+@task
+@timed
+def collect_disk_index(roots=None, full=False, pool_size=DISK_INDEX_POOL_SIZE):
+    """
+    Index the disk usage of the directories under DISK_INDEX_ROOTS (or under the
+    space-separated `roots`) on the current host, or on all the hosts in the
+    inventory (in parallel) when run without -R/-H. Later runs only rescan the
+    directories that changed; use `full=true` to force a full rescan.
+    """
+    full = (full and str(full).lower() == 'true')
+    roots = roots.split() if roots else DISK_INDEX_ROOTS
+    if env.host_string:
+        return _collect_host_disk_index(roots, full)
+    hosts = sorted(set(host for role in env.roledefs.values() for host in role['hosts']))
+    with settings(parallel=True, pool_size=max(1, int(pool_size))):
+        execute(_collect_host_disk_index, roots, full, hosts=hosts)
+
+
+def _collect_host_disk_index(roots, full):
+    if not exists(DISK_INDEX_REMOTE_DIR):
+        sudo('mkdir -p ' + DISK_INDEX_REMOTE_DIR)
+        sudo('chmod 700 ' + DISK_INDEX_REMOTE_DIR)
+    script_path = os.path.join(DISK_INDEX_REMOTE_DIR, 'diskindex.py')
+    with hide('running'):
+        put(os.path.join(CONFIG_DIR, 'diskindex.py'), script_path, use_sudo=True, mode=0o700)
+    cmd_args = [
+        'python3', script_path,
+        '--cache-file', os.path.join(DISK_INDEX_REMOTE_DIR, 'cache.json'),
+        '--depth', str(DISK_INDEX_DEPTH),
+        '--full-every-days', str(DISK_INDEX_FULL_SCAN_DAYS),
+    ]
+    if full:
+        cmd_args.append('--full')
+    with hide('running', 'stdout'):
+        output = sudo(' '.join(quote(arg) for arg in cmd_args + roots))
+    summaries = []
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            data = gzip.decompress(base64.b64decode(line[len('RESULT '):]))
+            summaries.append(json.loads(data.decode('utf-8')))
+    snapshot = {
+        'timestamp': time.time(),
+        'host': env.host,
+        'role': _current_role() or '',
+        'roots': summaries,
+    }
+    os.makedirs(DISK_INDEX_LOCAL_DIR, exist_ok=True)
+    with open(os.path.join(DISK_INDEX_LOCAL_DIR, env.host + '.jsonl'), 'a') as snapshotsf:
+        snapshotsf.write(json.dumps(snapshot) + '\n')
+    for summary in summaries:
+        puts(green('{} {}: {} in {} files ({} dirs scanned, {} unchanged, {:.1f}sec)'.format(
+            'Indexed' if not summary['full'] else 'Fully indexed', summary['root'],
+            _format_size(summary['bytes']), summary['files'],
+            summary['scanned_dirs'], summary['cached_dirs'], summary['seconds'])))
+    return snapshot
+
+
+
+# DISK INDEX REPORTS
+################################################################################
+
+@task
+@timed
+def disk_index_report(top=20, depth=2, sort='size', host=None):
+    """
+    Print the `top` largest (`sort=size`) or fastest growing (`sort=growth`)
+    directories `depth` levels below the roots across the fleet, then the size of
+    the parts of each chef repo and of each Kolibri channel. Growth is computed
+    since the previous `collect_disk_index` run on each host.
+    """
+    if sort not in ['size', 'growth']:
+        abort('sort must be one of size or growth')
+    snapshots = _load_last_snapshots(host)
+    if not snapshots:
+        puts(yellow('No disk index in ' + DISK_INDEX_LOCAL_DIR + ', run collect_disk_index first.'))
+        return
+
+    rows = []
+    for host_name, (last, previous) in sorted(snapshots.items()):
+        previous_dirs = _get_dir_sizes(previous) if previous else {}
+        for path, (size, files) in _get_dir_sizes(last).items():
+            if _get_depth(path, last) == int(depth):
+                growth = size - previous_dirs[path][0] if path in previous_dirs else size
+                rows.append((host_name, path, size, growth, files))
+    rows.sort(key=lambda row: -row[2] if sort == 'size' else -row[3])
+    print('\t'.join(['host', 'path', 'size', 'growth', 'files']))
+    for host_name, path, size, growth, files in rows[0:int(top)]:
+        print('\t'.join([host_name, path, _format_size(size), _format_growth(growth), str(files)]))
+
+    print('')
+    print('\t'.join(['host', 'chef', 'total', 'growth'] + CHEF_DIR_PARTS + ['other']))
+    for host_name, (last, previous) in sorted(snapshots.items()):
+        previous_dirs = _get_dir_sizes(previous) if previous else {}
+        for chef_dir, parts in sorted(_get_chef_breakdown(last).items()):
+            total = parts.pop('total')
+            growth = total - previous_dirs[chef_dir][0] if chef_dir in previous_dirs else total
+            other = total - sum(parts.values())
+            print('\t'.join([host_name, os.path.basename(chef_dir), _format_size(total), _format_growth(growth)] +
+                            [_format_size(parts.get(part, 0)) for part in CHEF_DIR_PARTS] +
+                            [_format_size(other)]))
+
+    print('')
+    print('\t'.join(['host', 'channel_id', 'files', 'size', 'growth', 'name']))
+    for host_name, (last, previous) in sorted(snapshots.items()):
+        previous_channels = _get_channel_sizes(previous) if previous else {}
+        for channel_id, (name, files, size) in sorted(_get_channel_sizes(last).items(), key=lambda item: -item[1][2]):
+            growth = size - previous_channels[channel_id][2] if channel_id in previous_channels else size
+            print('\t'.join([host_name, channel_id, str(files), _format_size(size), _format_growth(growth), name]))
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _load_last_snapshots(host=None):
+    """
+    Returns {host: (last snapshot, previous snapshot or None)} from the local
+    snapshot files of all the hosts, or of `host` only.
+    """
+    snapshots = {}
+    if not os.path.exists(DISK_INDEX_LOCAL_DIR):
+        return snapshots
+    for filename in sorted(os.listdir(DISK_INDEX_LOCAL_DIR)):
+        host_name = filename[:-len('.jsonl')]
+        if not filename.endswith('.jsonl') or (host and host_name != host):
+            continue
+        with open(os.path.join(DISK_INDEX_LOCAL_DIR, filename)) as snapshotsf:
+            lines = [line for line in snapshotsf if line.strip()]
+        if lines:
+            previous = json.loads(lines[-2]) if len(lines) > 1 else None
+            snapshots[host_name] = (json.loads(lines[-1]), previous)
+    return snapshots
+
+
+def _get_dir_sizes(snapshot):
+    """
+    Returns {absolute path: (bytes, files)} for all the dirs in `snapshot`.
+    """
+    sizes = {}
+    for summary in snapshot['roots']:
+        for relpath, (size, files) in summary['dirs'].items():
+            sizes[os.path.normpath(os.path.join(summary['root'], relpath))] = (size, files)
+    return sizes
+
+
+def _get_depth(path, snapshot):
+    for summary in snapshot['roots']:
+        relpath = os.path.relpath(path, summary['root'])
+        if not relpath.startswith('..'):
+            return 0 if relpath == '.' else len(relpath.split(os.sep))
+    return None
+
+
+def _get_chef_breakdown(snapshot):
+    """
+    Returns {chef_dir: {'total': bytes, part: bytes}} for the chef repos in the
+    roots of `snapshot`, where the CHEF_DIR_PARTS are searched in the chef repo
+    and in its subdirectories (chefs that run with `cwd`).
+    """
+    sizes = _get_dir_sizes(snapshot)
+    breakdown = {}
+    for path, (size, files) in sizes.items():
+        if fnmatch.fnmatch(os.path.basename(path), CHEF_DIR_PATTERN) and _get_depth(path, snapshot) == 1:
+            breakdown[path] = {'total': size}
+    for path, (size, files) in sizes.items():
+        part = os.path.basename(path)
+        if part not in CHEF_DIR_PARTS:
+            continue
+        for chef_dir, parts in breakdown.items():
+            if path.startswith(chef_dir + os.sep):
+                parts[part] = parts.get(part, 0) + size
+    return breakdown
+
+
+def _get_channel_sizes(snapshot):
+    channels = {}
+    for summary in snapshot['roots']:
+        for channel_id, name, files, size in summary['channels']:
+            channels[channel_id] = (name, files, size)
+    return channels
+
+
+def _format_growth(nbytes):
+    return ('-' if nbytes < 0 else '+') + _format_size(abs(nbytes))
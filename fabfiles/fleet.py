@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import math
+import time
+
+from fabric.api import env, execute, settings
+from fabric.colors import red, green, yellow
+from fabric.context_managers import hide
+
+
+# FLEET SETTINGS
+################################################################################
+FLEET_POOL_SIZE = 10        # max number of hosts probed at the same time
+FLEET_PROBE_TIMEOUT = 15    # seconds allowed per host (connect + command)
+FLEET_PROBE_GRACE = 5       # extra seconds before a stuck local probe is dropped
+
+PROBE_STATUS_COLORS = {
+    'ok': green,
+    'warn': yellow,
+    'fail': red,
+    'error': red,
+    'timeout': red,
+}
+
+
+
+# FLEET TARGETS
+################################################################################
+
+def get_fleet_targets(roledefs=None, require=None):
+    """
+    Return a list of `(role_name, host, role)` tuples for the roles in `roledefs`
+    (defaults to `env.roledefs`) sorted by role name. Use `require` to select
+    only the roles that define a given key, e.g. `require='hostname'` selects
+    the demoservers and skips integration servers like vader.
+    Pass a dict like `{'local': {'hosts':['127.0.0.1']}}`, or the path of a json
+    file containing one (from the command line), to probe stand-in hosts.
+    """
+    if roledefs is None:
+        roledefs = env.roledefs
+    elif isinstance(roledefs, str):
+        with open(roledefs) as roledefsf:
+            roledefs = json.load(roledefsf)
+    targets = []
+    for role_name, role in sorted(roledefs.items()):
+        assert len(role['hosts'])==1, 'Multiple hosts found for role'
+        if require and role.get(require) is None:
+            continue
+        targets.append((role_name, role['hosts'][0], role))
+    return targets
+
+
+
+# FLEET PROBES
+################################################################################
+
+def probe_fleet(probe, targets, pool_size=FLEET_POOL_SIZE, timeout=FLEET_PROBE_TIMEOUT):
+    """
+    Run `probe(role_name, host, role, timeout)` for all `targets` concurrently
+    using a pool of `pool_size` threads. The probe must return a tuple
+    `(status, detail)` where status is one of the keys of PROBE_STATUS_COLORS,
+    and it must honor `timeout` for its own network calls (socket timeouts,
+    DNS resolver lifetime). Probes still running after the deadline are reported
+    as `timeout` and not waited for.
+    Use this for local probes only; probes that need an SSH session must use
+    `probe_fleet_remote` since Fabric's `env` is not thread-safe.
+    """
+    if not targets:
+        return []
+    pool_size = max(1, min(pool_size, len(targets)))
+    rounds = math.ceil(len(targets) / pool_size)
+    deadline = rounds * timeout + FLEET_PROBE_GRACE
+    executor = ThreadPoolExecutor(max_workers=pool_size)
+    futures = []
+    for role_name, host, role in targets:
+        future = executor.submit(_run_probe, probe, role_name, host, role, timeout)
+        futures.append(future)
+    wait(futures, timeout=deadline)
+    executor.shutdown(wait=False)
+    results = []
+    for (role_name, host, role), future in zip(targets, futures):
+        if future.done():
+            results.append(future.result())
+        else:
+            future.cancel()
+            detail = 'no answer after {}sec'.format(deadline)
+            results.append(_make_result(role_name, host, 'timeout', detail, deadline))
+    return results
+
+
+def probe_fleet_remote(probe, targets, pool_size=FLEET_POOL_SIZE, timeout=FLEET_PROBE_TIMEOUT):
+    """
+    Run `probe(role_name, host, role)` on all `targets` using Fabric's parallel
+    (multiprocessing) execution, so every host gets its own SSH session and at
+    most `pool_size` hosts are contacted at the same time. The probe can use
+    `run` and `sudo` normally and must return a tuple `(status, detail)`.
+    `timeout` bounds both the SSH connection and the remote command.
+    """
+    if not targets:
+        return []
+    roles_by_host = dict((host, (role_name, role)) for role_name, host, role in targets)
+
+    def _remote_probe():
+        role_name, role = roles_by_host[env.host_string]
+        return _run_probe(probe, role_name, env.host_string, role)
+
+    fleet_settings = dict(
+        parallel=True,
+        pool_size=max(1, pool_size),
+        timeout=timeout,
+        command_timeout=timeout,
+        connection_attempts=1,
+        abort_on_prompts=True,
+        skip_bad_hosts=True,
+        warn_only=True,
+        use_exceptions_for={'network': True},
+    )
+    start = time.time()
+    with settings(**fleet_settings), hide('running', 'stdout', 'stderr', 'warnings', 'aborts'):
+        host_results = execute(_remote_probe, hosts=[host for _, host, _ in targets])
+    elapsed = time.time() - start
+    results = []
+    for role_name, host, role in targets:
+        result = host_results.get(host)
+        if isinstance(result, dict):
+            results.append(result)
+        else:
+            detail = str(result) if result is not None else 'host did not return a result'
+            results.append(_make_result(role_name, host, 'error', detail, elapsed))
+    return results
+
+
+def print_fleet_results(results):
+    """
+    Print the combined result table for a fleet probe (tab-separated).
+    """
+    if not results:
+        print('No hosts to check.')
+        return
+    role_width = max(len(r['role_name']) for r in results)
+    host_width = max(len(r['host']) for r in results)
+    for result in sorted(results, key=lambda r: r['role_name']):
+        color = PROBE_STATUS_COLORS.get(result['status'], red)
+        output_vals = [
+            result['role_name'].ljust(role_width),
+            result['host'].ljust(host_width),
+            color(result['status'].ljust(7)),
+            '{:6.2f}s'.format(result['elapsed']),
+            result['detail'],
+        ]
+        print('\t'.join(output_vals))
+    slowest = max(r['elapsed'] for r in results)
+    total = sum(r['elapsed'] for r in results)
+    print('Checked', len(results), 'hosts in', '{:.2f}s'.format(slowest),
+          '(sequential time would be {:.2f}s)'.format(total))
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _run_probe(probe, role_name, host, role, timeout=None):
+    """
+    Call `probe` and turn its return value or exception into a result dict.
+    """
+    start = time.time()
+    args = (role_name, host, role) if timeout is None else (role_name, host, role, timeout)
+    try:
+        status, detail = probe(*args)
+    except (Exception, SystemExit) as e:   # SystemExit is raised by fab abort()
+        status, detail = 'error', str(e).strip().split('\n')[0] or e.__class__.__name__
+    return _make_result(role_name, host, status, detail, time.time() - start)
+
+
+def _make_result(role_name, host, status, detail, elapsed):
+    return {
+        'role_name': role_name,
+        'host': host,
+        'status': status,
+        'detail': detail,
+        'elapsed': elapsed,
+    }
@@ -1,13 +1,18 @@
+import dns.exception
 import dns.resolver
-from itertools import groupby
 import json
 import re
+import time
 
 from fabric.api import env, task, local, sudo, run
 from fabric.colors import red, green, blue, yellow
 from fabric.context_managers import hide
 from fabric.utils import puts
 
+from .fleet import FLEET_POOL_SIZE, FLEET_PROBE_TIMEOUT
+from .fleet import get_fleet_targets, probe_fleet, probe_fleet_remote, print_fleet_results
+from .timing import timed
+
 
 # GCP SETTINGS
 ################################################################################
@@ -84,6 +89,7 @@ inventory = {
 ################################################################################
 
 @task
+@timed
 def create(instance_name, region=GCP_REGION, zone=GCP_ZONE, disk_size=GCP_BOOT_DISK_SIZE, address_name=None):
     """
     Create a GCP instance `instance_name` and associate a new static IP with it.
@@ -118,10 +124,12 @@ def create(instance_name, region=GCP_REGION, zone=GCP_ZONE, disk_size=GCP_BOOT_D
     puts(blue("        'channels_to_import': [],"                                  ))
     puts(blue("        'facility_name': '" + instance_name.replace('-', ' ') + "',"))
     puts(blue("        'hostname': '%s.learningequality.org',"  % instance_name    ))
+    puts(blue("        'nginx_profile': 'performance',"                            ))
     puts(blue("    },"                                                             ))
 
 
 @task
+@timed
 def delete(instance_name, region=GCP_REGION, zone=GCP_ZONE, address_name=None):
     """
     Delete the GCP instance `instance_name` and it's associated IP address.
@@ -144,6 +152,7 @@ def delete(instance_name, region=GCP_REGION, zone=GCP_ZONE, address_name=None):
 ################################################################################
 
 @task
+@timed
 def list_instances(tsv=None):
     """
     Show list of all currently running demo instances.
@@ -163,41 +172,35 @@ def list_instances(tsv=None):
 
 
 @task
-def check_diskspace():
+@timed
+def check_diskspace(pool_size=FLEET_POOL_SIZE, timeout=FLEET_PROBE_TIMEOUT, roledefs=None):
     """
-    Check available disk space on all demo servers.
+    Check available disk space on all demo servers (all hosts checked at once).
+    Use `roledefs` (path of a json file of roles) to check stand-in hosts.
     """
     puts(blue('Checking available disk space on all demo servers.'))
-    demo_servers = list(env.roledefs.items())
-    for role_name, role in demo_servers:
-        assert len(role['hosts'])==1, 'Multiple hosts found for role'
-        print('role_name', role_name)
-        env.host_string = role['hosts'][0]
-        run('df -h | grep /dev/sda1')
+    targets = get_fleet_targets(roledefs=roledefs)
+    results = probe_fleet_remote(_diskspace_probe, targets,
+                                 pool_size=int(pool_size), timeout=int(timeout))
+    print_fleet_results(results)
 
 
 @task
-def check_dns():
+@timed
+def check_dns(nameserver=None, pool_size=FLEET_POOL_SIZE, timeout=FLEET_PROBE_TIMEOUT, roledefs=None):
     """
-    Checks if DNS lookup matches hosts IP.
+    Checks if DNS lookup matches hosts IP (all hostnames resolved at once).
+    Use `nameserver` (IP or IP:port) to query a specific DNS server, and
+    `roledefs` (path of a json file of roles) to check stand-in hosts.
     """
     puts(blue('Checking DNS records for all demo servers.'))
-    for role_name, role in env.roledefs.items():
-        assert len(role['hosts'])==1, 'Multiple hosts found for role'
-        host_ip = role['hosts'][0]
-        hostname = role.get('hostname')
-        if hostname:
-            results = []
-            try:
-                for rdata in dns.resolver.query(hostname, 'A'):
-                    results.append(rdata)
-                results_text = [r.to_text().rstrip('.') for r in results]
-                if host_ip in results_text:
-                    print('DNS for', role_name, 'OK')
-                else:
-                    print('WRONG DNS for', role_name, 'Hostname:', hostname, 'Expected:', host_ip, 'Got:', results_text)
-            except dns.resolver.NoAnswer:
-                print('MISSING DNS for', role_name, 'Hostname:', hostname, 'Expected:', host_ip)
+    targets = get_fleet_targets(roledefs=roledefs, require='hostname')
+
+    def _dns_probe(role_name, host_ip, role, timeout):
+        return _check_dns_record(role['hostname'], host_ip, timeout, nameserver=nameserver)
+
+    results = probe_fleet(_dns_probe, targets, pool_size=int(pool_size), timeout=int(timeout))
+    print_fleet_results(results)
 
 
 
@@ -205,6 +208,7 @@ def check_dns():
 ################################################################################
 
 @task
+@timed
 def exec(cmd, usesudo=False):
     """
     Run the command `cmd` on the remote host. Set usesudo to True to use `sudo`.
@@ -217,24 +221,69 @@ def exec(cmd, usesudo=False):
 
 
 @task
+@timed
 def shell():
     puts(green('To connect to the server run:'))
     puts(blue('ssh ' + env.user + '@' + env.host_string))
 
 
+# python programs that are not sushi chefs
+EXCLUDE_PYPSAUX_PATTERNS = [
+    'system-config', 'cinnamon-killer', 'apport-gtk',
+    'buildkite', 'gpt2-slackbot', 'jamalex/.virtualenvs'
+]
+PYPSAUX_CWD_MARKER = '__PYPSAUX_CWD__'
+# One remote command for the whole census: `ps auxww` followed by the marker
+# line and `<pid> <cwd>` lines for all the processes with python in their cmdline
+PYPSAUX_CMD = (
+    'ps auxww; echo ' + PYPSAUX_CWD_MARKER + '; '
+    'for pid in $(pgrep -f python); do echo "$pid $(readlink /proc/$pid/cwd)"; done'
+)
+
 @task
-def pypsaux():
+@timed
+def pypsaux(watch=False, interval=30, samples=10):
     """
     Print info about content integrartion scripts on the host.
+    Use `watch=true` to sample the processes every `interval` seconds, `samples`
+    times, and print the RSS and CPU usage trend of each process at the end.
+    """
+    watch = (watch and str(watch).lower() == 'true')
+    if watch:
+        _watch_pyprocesses(int(interval), int(samples))
+        return
+    pyprocesses = _collect_pyprocesses()
+    # print tab-separated output
+    for pyp in sorted(pyprocesses, key=lambda pyp: pyp['COMMAND']):
+        output_vals = [
+            pyp['PID'],
+            pyp['START'],
+            pyp['TIME'],
+            pyp['COMMAND'],
+            '(cwd='+pyp['cwd']+')',
+        ]
+        print('\t'.join(output_vals))
+
+
+def _collect_pyprocesses():
     """
-    EXCLUDE_PYPSAUX_PATTERNS = [      # python programs that are not sushi chefs
-        'system-config', 'cinnamon-killer', 'apport-gtk',
-        'buildkite', 'gpt2-slackbot', 'jamalex/.virtualenvs'
-    ]
-    processes  = _psaux()
+    Returns the `_parse_psaux` records of the sushi chef processes on the host,
+    with the extra key `cwd`, obtained using a single remote command.
+    """
+    with hide('running', 'stdout'):
+        result = sudo(PYPSAUX_CMD)
+    psaux_str, _, cwds_str = result.partition(PYPSAUX_CWD_MARKER)
+    cwds = {}
+    for line in cwds_str.splitlines():
+        if line.strip():
+            pid, _, cwd = line.strip().partition(' ')
+            cwds[pid] = cwd
+    processes = _parse_psaux(psaux_str.strip())
     pyprocesses = []
     for process in processes:
-        if 'python' in process['COMMAND']:
+        if 'python' in process['COMMAND'] and process['PID'] in cwds:
+            if PYPSAUX_CWD_MARKER in process['COMMAND']:
+                continue   # the shell running PYPSAUX_CMD
             if not any([pat in process['COMMAND'] for pat in EXCLUDE_PYPSAUX_PATTERNS]):
                 pyprocesses.append(process)
 
@@ -244,24 +293,43 @@ def pypsaux():
         return '--token=' +match.groupdict()['car'] + '...'
     for pyp in pyprocesses:
         pyp['COMMAND'] = TOKEN_PAT.sub(_rmtoken_sub, pyp['COMMAND'])
+        pyp['cwd'] = cwds[pyp['PID']]
+    return pyprocesses
 
-    # sort and enrich with current working dir (cwd)
-    pyprocesses = sorted(pyprocesses, key=lambda pyp: pyp['COMMAND'])
-    for cmd_str, process_group in groupby(pyprocesses, lambda vl: vl['COMMAND']):
-        process_group = list(process_group)
-        with hide('running', 'stdout'):
-            cwd_str = sudo('pwdx {}'.format(process_group[0]['PID'])).split(':')[1].strip()
-        for pyp in process_group:
-            pyp['cwd'] = cwd_str
 
-    # print tab-separated output
-    for pyp in pyprocesses:
+def _watch_pyprocesses(interval, samples):
+    """
+    Sample the sushi chef processes `samples` times and print per-process trends:
+    RSS in MB at each sample, and CPU% used in each interval (computed from the
+    cumulative CPU TIME, unlike %CPU in `ps` which is averaged over the lifetime).
+    """
+    history = {}   # PID --> {'process': latest record, 'points': [(timestamp, cpu_sec, rss_kb)]}
+    for i in range(samples):
+        timestamp = time.time()
+        pyprocesses = _collect_pyprocesses()
+        for pyp in pyprocesses:
+            entry = history.setdefault(pyp['PID'], {'points': []})
+            entry['process'] = pyp
+            entry['points'].append((timestamp, _parse_cputime(pyp['TIME']), int(pyp['RSS'])))
+        total_rss = sum(int(pyp['RSS']) for pyp in pyprocesses)
+        puts(green('Sample {}/{}: {} python processes using {:.1f}MB RSS'.format(
+            i + 1, samples, len(pyprocesses), total_rss/1024.0)))
+        if i < samples - 1:
+            time.sleep(interval)
+
+    print('\t'.join(['PID', 'START', 'cwd', 'RSS MB (per sample)', 'CPU% (per interval)']))
+    for pid, entry in sorted(history.items(), key=lambda item: item[1]['process']['cwd']):
+        points = entry['points']
+        rss_trend = ','.join('{:.0f}'.format(rss_kb/1024.0) for _, _, rss_kb in points)
+        cpu_trend = []
+        for (t0, cpu0, _), (t1, cpu1, _) in zip(points, points[1:]):
+            cpu_trend.append('{:.0f}'.format(100.0*(cpu1 - cpu0)/(t1 - t0)))
         output_vals = [
-            pyp['PID'],
-            pyp['START'],
-            pyp['TIME'],
-            pyp['COMMAND'],
-            '(cwd='+pyp['cwd']+')',
+            pid,
+            entry['process']['START'],
+            entry['process']['cwd'],
+            rss_trend,
+            ','.join(cpu_trend),
         ]
         print('\t'.join(output_vals))
 
@@ -270,11 +338,57 @@ def pypsaux():
 # HELPER METHODS
 ################################################################################
 
-def _psaux():
-    with hide('running', 'stdout'):
-        result = sudo('ps aux')
-    processes = _parse_psaux(result)
-    return processes
+DISKSPACE_WARN_PERCENT = 85
+DISKSPACE_FAIL_PERCENT = 95
+
+def _diskspace_probe(role_name, host, role):
+    """
+    Fleet probe that reports the usage of the boot disk /dev/sda1 on `host`.
+    """
+    df_line = run('df -h | grep /dev/sda1')
+    _, size, used, avail, use_percent = df_line.split()[0:5]
+    percent = int(use_percent.rstrip('%'))
+    detail = '{} used of {} ({}), {} free'.format(used, size, use_percent, avail)
+    if percent >= DISKSPACE_FAIL_PERCENT:
+        return 'fail', detail
+    elif percent >= DISKSPACE_WARN_PERCENT:
+        return 'warn', detail
+    return 'ok', detail
+
+def _check_dns_record(hostname, host_ip, timeout, nameserver=None):
+    """
+    Fleet probe that checks the A records for `hostname` contain `host_ip`.
+    """
+    resolver = dns.resolver.Resolver()
+    resolver.lifetime = timeout
+    if nameserver:
+        if ':' in nameserver:
+            nameserver, port = nameserver.split(':')
+            resolver.port = int(port)
+        resolver.nameservers = [nameserver]
+    try:
+        results = resolver.query(hostname, 'A')
+    except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+        return 'fail', 'MISSING DNS for {} Expected: {}'.format(hostname, host_ip)
+    except dns.exception.Timeout:
+        return 'timeout', 'DNS query for {} timed out'.format(hostname)
+    results_text = [r.to_text().rstrip('.') for r in results]
+    if host_ip in results_text:
+        return 'ok', 'DNS for {} OK'.format(hostname)
+    return 'fail', 'WRONG DNS for {} Expected: {} Got: {}'.format(hostname, host_ip, results_text)
+
+def _parse_cputime(time_str):
+    """
+    Convert the cumulative CPU TIME column of `ps` ([DD-]HH:MM:SS or MM:SS) to seconds.
+    """
+    days = 0
+    if '-' in time_str:
+        days_str, time_str = time_str.split('-', 1)
+        days = int(days_str)
+    seconds = 0
+    for part in time_str.split(':'):
+        seconds = seconds*60 + float(part)
+    return days*24*60*60 + seconds
 
 def _parse_psaux(psaux_str):
     """
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import subprocess
+import time
+
+
+# CLONE SETTINGS
+################################################################################
+# The code reports and chef setups only need the working tree of the branches:
+#  - blobless: full commit history, but only the blobs of checked out commits
+#              are downloaded (on demand), so any branch can still be checked out
+#  - shallow:  only the latest commit of each branch
+#  - full:     regular git clone
+GIT_CLONE_MODES = {
+    'blobless': {'clone': ['--filter=blob:none'], 'fetch': []},
+    'shallow': {'clone': ['--depth', '1', '--no-single-branch'], 'fetch': ['--depth', '1']},
+    'full': {'clone': [], 'fetch': []},
+}
+GIT_CLONE_MODE = 'blobless'
+GIT_CLONE_WORKERS = 8
+
+
+
+# CLONE ENGINE
+################################################################################
+
+def clone_or_fetch(url, repo_dir, branch=None, mode=GIT_CLONE_MODE):
+    """
+    Clone the repo at `url` to `repo_dir` using the clone `mode`, or fetch origin
+    if `repo_dir` already exists. Returns a result dict with the keys `repo_dir`,
+    `action` (clone or fetch), `status` (ok or failed), `bytes` (size of the git
+    objects received), `seconds`, and `error`.
+    """
+    mode_args = GIT_CLONE_MODES[mode]
+    objects_dir = os.path.join(repo_dir, '.git', 'objects')
+    if os.path.exists(repo_dir):
+        action = 'fetch'
+        cmd = ['git', 'fetch', '--quiet'] + mode_args['fetch'] + ['origin']
+        cwd = repo_dir
+    else:
+        action = 'clone'
+        cmd = ['git', 'clone', '--quiet'] + mode_args['clone']
+        if branch:
+            cmd += ['--branch', branch]
+        cmd += [url, repo_dir]
+        cwd = None
+    size_before = _get_dir_size(objects_dir)
+    start = time.time()
+    process = subprocess.run(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    error = ''
+    if process.returncode != 0:
+        error = process.stdout.decode('utf-8', errors='replace').strip()
+        error = error or 'git {} exited with code {}'.format(action, process.returncode)
+    return {
+        'repo_dir': repo_dir,
+        'action': action,
+        'status': 'failed' if error else 'ok',
+        'bytes': max(_get_dir_size(objects_dir) - size_before, 0),
+        'seconds': time.time() - start,
+        'error': error,
+    }
+
+
+def clone_or_fetch_many(repos, workers=GIT_CLONE_WORKERS, mode=GIT_CLONE_MODE):
+    """
+    Run `clone_or_fetch` for the `(url, repo_dir)` tuples in `repos` using a pool
+    of `workers` threads. Yields the results as the clones or fetches finish.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(clone_or_fetch, url, repo_dir, mode=mode) for url, repo_dir in repos]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def format_clone_result(result):
+    """
+    Returns a tab-separated line with the repo, action, status, bytes, and time.
+    """
+    return '\t'.join([
+        os.path.basename(result['repo_dir']),
+        result['action'],
+        result['status'],
+        '{:.1f}MB'.format(result['bytes']/1024.0/1024.0),
+        '{:.1f}s'.format(result['seconds']),
+    ])
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _get_dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass  # temporary files removed by git
+    return total
@@ -2,12 +2,18 @@ from github import Github
 import json
 import os
 import re
-import subprocess
+import requests
+import time
 
 from fabric.api import task
 from fabric.colors import red, green, blue, yellow
 from fabric.utils import puts
 
+from .gitclone import GIT_CLONE_MODE, GIT_CLONE_WORKERS
+from .gitclone import clone_or_fetch_many, format_clone_result
+from .githubcache import install_github_cache, get_github_cache_stats
+from .timing import timed
+
 
 # GITHUB CREDS
 ################################################################################
@@ -15,14 +21,27 @@ GITHUB_API_TOKEN_FILE = 'credentials/github_api.json'
 GITHUB_API_TOKEN_NAME = 'cloud-chef-token'
 GITHUB_SUSHI_CHEFS_TEAM_ID = 2590528  # "Sushi Chefs" team = all sushi chef devs
 
+def get_github_token():
+    """
+    Returns the github API token from the GITHUB_API_TOKEN_FILE.
+    """
+    with open(GITHUB_API_TOKEN_FILE, 'r') as tokenf:
+        return json.load(tokenf)[GITHUB_API_TOKEN_NAME]
+
+_github_clients = {}  # token --> github client, reused for the whole fab session
+
 def get_github_client(token=None):
     """
     Returns a token-authenticated github client (to avoid code duplication).
+    The client sends conditional requests and replays unchanged responses from
+    the on-disk cache (see fabfiles/githubcache.py).
     """
     if token is None:
-        with open(GITHUB_API_TOKEN_FILE, 'r') as tokenf:
-            token = json.load(tokenf)[GITHUB_API_TOKEN_NAME]
-    return Github(token)
+        token = get_github_token()
+    if token not in _github_clients:
+        install_github_cache()
+        _github_clients[token] = Github(token)
+    return _github_clients[token]
 
 
 
@@ -30,6 +49,7 @@ def get_github_client(token=None):
 ################################################################################
 
 @task
+@timed
 def create_github_repo(nickname, source_url=None, init=True, private=False):
     """
     Create a github repo for chef given its `nickname` and `source_url`.
@@ -69,30 +89,55 @@ def create_github_repo(nickname, source_url=None, init=True, private=False):
 ################################################################################
 
 @task
+@timed
 def list_chef_repos(fast=False):
     """
     Print report about all sushi chef repos (forks, branches, PRs, issues).
     """
-    chef_repos = get_chef_repos()
-    print_report_for_github_repos(chef_repos, fast=fast)
+    chef_repo_records = get_chef_repo_records()
+    print_report_for_github_repos(chef_repo_records, fast=fast)
 
 
 @task
+@timed
 def list_pipeline_repos(fast=False):
     """
     Print report about all the github repos related to the Content Pipeline.
     """
-    pipeline_repos = get_pipeline_repos()
-    print_report_for_github_repos(pipeline_repos, fast=fast)
+    pipeline_repo_records = get_repo_records(CONTENT_PIPELINE_REPOS)
+    print_report_for_github_repos(pipeline_repo_records, fast=fast)
 
 
 @task
-def clone_chef_repos(root_dir):
+@timed
+def github_cache_stats():
+    """
+    Print the GitHub API response cache counters for the current fab session,
+    e.g. `fab clone_chef_repos:repos github_cache_stats`.
+    """
+    stats = get_github_cache_stats()
+    puts(green('GitHub API cache: {hits} hits, {misses} misses, {stored} responses stored'.format(**stats)))
+
+
+@task
+@timed
+def clone_chef_repos(root_dir, workers=GIT_CLONE_WORKERS, mode=GIT_CLONE_MODE):
+    """
+    Clone all the chef repos to `root_dir` (or fetch the ones already there) using
+    `workers` parallel git processes. `mode` is one of blobless, shallow, or full.
+    """
     assert os.path.exists(root_dir), "Directory to clone into does not exist: {}".format(root_dir)
     pipeline_repos = get_chef_repos()
-    os.chdir(root_dir)
-    for repo in pipeline_repos:
-        subprocess.call(['git', 'clone', repo.html_url])
+    repos = [(repo.html_url, os.path.join(root_dir, repo.name)) for repo in pipeline_repos]
+    total_bytes, start = 0, time.time()
+    print('\t'.join(['repo', 'action', 'status', 'received', 'time']))
+    for result in clone_or_fetch_many(repos, workers=int(workers), mode=mode):
+        print(format_clone_result(result))
+        if result['error']:
+            puts(red(result['error']))
+        total_bytes += result['bytes']
+    puts(green('Received {:.1f}MB for {} repos in {:.1f}s'.format(
+        total_bytes/1024.0/1024.0, len(repos), time.time() - start)))
 
 
 # GITHUB REPOS INFO
@@ -166,45 +211,266 @@ def get_chef_repos(organization='learningequality'):
     return chef_repos
 
 
-def print_report_for_github_repos(github_repos, fast=False):
+def print_report_for_github_repos(repo_records, fast=False):
     """
-    Report detailed info about the github repos in `github_repos`.
+    Report detailed info about the github repos in `repo_records`.
     """
     fast = (fast and fast.lower() == 'true')
-    for repo in github_repos:
-        forks = list(repo.get_forks())
-        branches = list(repo.get_branches())
-        pulls = list(repo.get_pulls())
-        issues = list(repo.get_issues(state='open'))
+    for repo in repo_records:
         if not fast:
             print()  # extra newline between repos when printing detailed report
-        print('-', blue(repo.html_url),
-            '\t', len(forks), 'forks',
-            '\t', len(branches), 'branches',
-            '\t', len(pulls), 'PRs',
-            '\t', len(issues), 'Issues')
+        print('-', blue(repo['html_url']),
+            '\t', repo['forks_count'], 'forks',
+            '\t', repo['branches_count'], 'branches',
+            '\t', repo['pulls_count'], 'PRs',
+            '\t', repo['issues_count'], 'Issues')
         if not fast:
-            for fork in forks:
-                fork_branches = list(fork.get_branches())
-                branch_names = [yellow(fb.name) for fb in fork_branches if fb.name != 'master']
+            for fork in repo['forks']:
+                branch_names = [yellow(name) for name in fork['branches'] if name != 'master']
                 fork_branches_str = 'branches: ' + ', '.join(branch_names) if branch_names else ''
-                print(blue('   - fork: ' + fork.html_url), fork_branches_str)
-            for branch in branches:
-                commit_msg_lines = branch.commit.commit.message.split('\n')
-                commit_msg_str = commit_msg_lines[0]
-                print(yellow('   - branch: ' + branch.name),
-                        '('+ branch.commit.sha[0:7]+')',
-                        'by', branch.commit.author.login if branch.commit.author else '?',
-                        commit_msg_str, '\t', branch.commit.commit.last_modified)
-            for pr in pulls:
-                print(green('   - PR' + str(pr.number) + ': ' + pr.title),
-                        pr.state,
-                        'by', pr.user.login,
-                        '\t', pr.last_modified,
-                        pr.commits, 'commits',
-                        pr.comments, 'comments',
-                        pr.labels if pr.labels else '')
-            for issue in issues:
-                print(red('   - I' + str(issue.number) + ': ' + issue.title),
-                        issue.state, issue.comments, 'comments',
-                        issue.labels if issue.labels else '')
\ No newline at end of file
+                if fork['branches_count'] > len(fork['branches']):
+                    fork_branches_str += ' ({} more not shown)'.format(fork['branches_count'] - len(fork['branches']))
+                print(blue('   - fork: ' + fork['html_url']), fork_branches_str)
+            for branch in repo['branches']:
+                print(yellow('   - branch: ' + branch['name']),
+                        '('+ branch['sha'][0:7]+')',
+                        'by', branch['author'] or '?',
+                        branch['message'], '\t', branch['committed_date'])
+            for pr in repo['pulls']:
+                print(green('   - PR' + str(pr['number']) + ': ' + pr['title']),
+                        pr['state'],
+                        'by', pr['author'] or '?',
+                        '\t', pr['updated_at'],
+                        pr['commits'], 'commits',
+                        pr['comments'], 'comments',
+                        pr['labels'] if pr['labels'] else '')
+            for issue in repo['issues']:
+                print(red('   - I' + str(issue['number']) + ': ' + issue['title']),
+                        issue['state'], issue['comments'], 'comments',
+                        issue['labels'] if issue['labels'] else '')
+
+
+
+# GITHUB GRAPHQL DATA LAYER
+################################################################################
+# The reports fetch all the repos info using a few GraphQL queries and convert
+# the results to plain dicts ("repo records"), instead of doing several REST
+# calls per repo. Set GITHUB_GRAPHQL_URL to use a stand-in server (fixtures).
+GITHUB_GRAPHQL_URL = os.environ.get('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql')
+GITHUB_GRAPHQL_TIMEOUT = 60
+GRAPHQL_REPOS_PAGE_SIZE = 100   # repo names per page when listing org repos
+GRAPHQL_REPOS_BATCH_SIZE = 10   # repos with all details fetched per query
+GRAPHQL_ITEMS_PAGE_SIZE = 50    # forks/branches/PRs/issues per page (all pages are fetched)
+GRAPHQL_FORK_BRANCHES_LIMIT = 50   # branches listed per fork
+
+REPO_NAMES_QUERY = """
+query($organization: String!, $cursor: String) {
+  organization(login: $organization) {
+    repositories(first: %d, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name nameWithOwner }
+    }
+  }
+}
+""" % GRAPHQL_REPOS_PAGE_SIZE
+
+# (connection, arguments, node fields) of the paginated lists of a repo
+REPO_CONNECTIONS = [
+    ('forks', '', """
+      url
+      refs(refPrefix: "refs/heads/", first: %d) { totalCount nodes { name } }
+    """ % GRAPHQL_FORK_BRANCHES_LIMIT),
+    ('refs', 'refPrefix: "refs/heads/", ', """
+      name
+      target { ... on Commit { oid messageHeadline committedDate author { user { login } } } }
+    """),
+    ('pullRequests', 'states: OPEN, ', """
+      number title state updatedAt
+      author { login }
+      commits { totalCount }
+      comments { totalCount }
+      labels(first: 10) { nodes { name } }
+    """),
+    ('issues', 'states: OPEN, ', """
+      number title state
+      comments { totalCount }
+      labels(first: 10) { nodes { name } }
+    """),
+]
+
+CONNECTION_TEMPLATE = """
+  %(connection)s(%(args)sfirst: %(page_size)d%(after)s) {
+    totalCount
+    pageInfo { hasNextPage endCursor }
+    nodes { %(fields)s }
+  }"""
+
+REPO_FIELDS_FRAGMENT = 'fragment RepoFields on Repository {\n  nameWithOwner\n  url' + ''.join(
+    CONNECTION_TEMPLATE % {'connection': connection, 'args': args, 'page_size': GRAPHQL_ITEMS_PAGE_SIZE,
+                           'after': '', 'fields': fields}
+    for connection, args, fields in REPO_CONNECTIONS) + '\n}\n'
+
+# next page of one of the REPO_CONNECTIONS of a repo
+CONNECTION_PAGE_QUERY = """
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {%s
+  }
+}
+"""
+
+
+def graphql_query(query, variables=None, token=None):
+    """
+    Run the GraphQL `query` against the GitHub API and return the `data`.
+    Repos that don't exist are returned as None (NOT_FOUND errors are ignored).
+    """
+    if token is None:
+        token = get_github_token()
+    response = requests.post(
+        GITHUB_GRAPHQL_URL,
+        json={'query': query, 'variables': variables or {}},
+        headers={'Authorization': 'bearer ' + token},
+        timeout=GITHUB_GRAPHQL_TIMEOUT,
+    )
+    response.raise_for_status()
+    result = response.json()
+    errors = [error for error in result.get('errors') or [] if error.get('type') != 'NOT_FOUND']
+    if errors or result.get('data') is None:
+        errors = errors or result.get('errors') or [{'message': 'no data returned'}]
+        messages = [error.get('message', str(error)) for error in errors]
+        raise ValueError('GitHub GraphQL query failed: ' + '; '.join(messages))
+    return result['data']
+
+
+def get_repo_names(organization='learningequality', token=None):
+    """
+    Return the full names of all the repos in `organization` (paginated query).
+    """
+    full_names = []
+    cursor = None
+    while True:
+        variables = {'organization': organization, 'cursor': cursor}
+        data = graphql_query(REPO_NAMES_QUERY, variables=variables, token=token)
+        repositories = data['organization']['repositories']
+        full_names.extend(node['nameWithOwner'] for node in repositories['nodes'])
+        if not repositories['pageInfo']['hasNextPage']:
+            return full_names
+        cursor = repositories['pageInfo']['endCursor']
+
+
+def get_repo_records(full_names, token=None):
+    """
+    Fetch the details (forks, branches, PRs, and issues) for the repos `full_names`
+    in batches of GRAPHQL_REPOS_BATCH_SIZE repos per query.
+    Returns a list of repo records (plain dicts) in the same order.
+    """
+    repo_records = []
+    for i in range(0, len(full_names), GRAPHQL_REPOS_BATCH_SIZE):
+        batch = full_names[i:i+GRAPHQL_REPOS_BATCH_SIZE]
+        aliased_queries = []
+        for j, full_name in enumerate(batch):
+            owner, name = full_name.split('/')
+            aliased_queries.append(
+                '  r{}: repository(owner: {}, name: {}) {{ ...RepoFields }}'.format(
+                    j, json.dumps(owner), json.dumps(name)))
+        query = 'query {\n' + '\n'.join(aliased_queries) + '\n}\n' + REPO_FIELDS_FRAGMENT
+        data = graphql_query(query, token=token)
+        for j, full_name in enumerate(batch):
+            repo_data = data.get('r{}'.format(j))
+            if repo_data is None:
+                puts(yellow('Repo ' + full_name + ' not found.'))
+                continue
+            _fetch_remaining_pages(full_name, repo_data, token=token)
+            repo_records.append(_repo_data_to_record(repo_data))
+    return repo_records
+
+
+def _fetch_remaining_pages(full_name, repo_data, token=None):
+    """
+    Add the nodes of the next pages of the REPO_CONNECTIONS of `repo_data` that
+    have more than GRAPHQL_ITEMS_PAGE_SIZE nodes (one query per page).
+    """
+    owner, name = full_name.split('/')
+    for connection, args, fields in REPO_CONNECTIONS:
+        page_info = repo_data[connection]['pageInfo']
+        query = CONNECTION_PAGE_QUERY % (CONNECTION_TEMPLATE % {
+            'connection': connection, 'args': args, 'page_size': GRAPHQL_ITEMS_PAGE_SIZE,
+            'after': ', after: $cursor', 'fields': fields})
+        while page_info['hasNextPage']:
+            variables = {'owner': owner, 'name': name, 'cursor': page_info['endCursor']}
+            page = graphql_query(query, variables=variables, token=token)['repository'][connection]
+            repo_data[connection]['nodes'].extend(page['nodes'])
+            page_info = page['pageInfo']
+
+
+def get_chef_repo_records(organization='learningequality', token=None):
+    """
+    Return the repo records of all the chef repos, equivalent to `get_chef_repos`.
+    """
+    if token is None:
+        token = get_github_token()
+    CHEF_REPO_PATTERN = re.compile('.*sushi-chef-.*')
+    chef_repo_names = []
+    for full_name in get_repo_names(organization, token=token):
+        name = full_name.split('/')[1]
+        if CHEF_REPO_PATTERN.search(name) and full_name not in DEPRECATED_REPOS:
+            chef_repo_names.append(full_name)
+    chef_repo_names.extend(EXTERNAL_CHEF_REPOS)
+    return get_repo_records(chef_repo_names, token=token)
+
+
+def _repo_data_to_record(repo_data):
+    """
+    Convert the GraphQL `RepoFields` data of a repo to a plain dict record.
+    """
+    def _labels(node):
+        return [label['name'] for label in node['labels']['nodes']]
+
+    record = {
+        'full_name': repo_data['nameWithOwner'],
+        'html_url': repo_data['url'],
+        'forks_count': repo_data['forks']['totalCount'],
+        'branches_count': repo_data['refs']['totalCount'],
+        'pulls_count': repo_data['pullRequests']['totalCount'],
+        'issues_count': repo_data['issues']['totalCount'],
+        'forks': [],
+        'branches': [],
+        'pulls': [],
+        'issues': [],
+    }
+    for fork in repo_data['forks']['nodes']:
+        record['forks'].append({
+            'html_url': fork['url'],
+            'branches': [ref['name'] for ref in fork['refs']['nodes']],
+            'branches_count': fork['refs']['totalCount'],
+        })
+    for ref in repo_data['refs']['nodes']:
+        commit = ref['target'] or {}
+        author_user = (commit.get('author') or {}).get('user') or {}
+        record['branches'].append({
+            'name': ref['name'],
+            'sha': commit.get('oid', ''),
+            'author': author_user.get('login'),
+            'message': commit.get('messageHeadline', ''),
+            'committed_date': commit.get('committedDate', ''),
+        })
+    for pr in repo_data['pullRequests']['nodes']:
+        record['pulls'].append({
+            'number': pr['number'],
+            'title': pr['title'],
+            'state': pr['state'].lower(),
+            'author': (pr['author'] or {}).get('login'),
+            'updated_at': pr['updatedAt'],
+            'commits': pr['commits']['totalCount'],
+            'comments': pr['comments']['totalCount'],
+            'labels': _labels(pr),
+        })
+    for issue in repo_data['issues']['nodes']:
+        record['issues'].append({
+            'number': issue['number'],
+            'title': issue['title'],
+            'state': issue['state'].lower(),
+            'comments': issue['comments']['totalCount'],
+            'labels': _labels(issue),
+        })
+    return record
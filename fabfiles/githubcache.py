@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+
+from github.Requester import Requester
+from github.Requester import HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass
+
+
+# GITHUB HTTP CACHE SETTINGS
+################################################################################
+# GET responses from the GitHub REST API are stored on disk along with their
+# ETag and Last-Modified headers. Subsequent requests for the same URL are sent
+# as conditional requests, and when GitHub answers `304 Not Modified` (which
+# does not count against the rate limit) the stored response is replayed.
+GITHUB_CACHE_DIR = os.path.join('cache', 'github_http')
+
+_cache_stats = {'hits': 0, 'misses': 0, 'stored': 0}
+
+
+
+# CACHING CONNECTION CLASS
+################################################################################
+
+class CachedResponse(object):
+    # mimic the httplib response object (like github.Requester.RequestsResponse)
+    def __init__(self, status, headers, text):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+class ConditionalRequestsMixin(object):
+    """
+    Mixin for PyGithub's connection classes that sends conditional GET requests
+    and replays the stored response when the server answers 304.
+    All the connections share a single `requests.Session` (connection pooling).
+    """
+    shared_session = None
+
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, **kwargs):
+        super().__init__(host, port=port, strict=strict, timeout=timeout, retry=retry, **kwargs)
+        if ConditionalRequestsMixin.shared_session is None:
+            ConditionalRequestsMixin.shared_session = self.session
+        self.session = ConditionalRequestsMixin.shared_session
+
+    def getresponse(self):
+        if self.verb != 'GET':
+            return super().getresponse()
+        headers = dict(self.headers or {})
+        cache_key = _get_cache_key(self.host, self.url, headers.get('Authorization'))
+        entry = _read_cache_entry(cache_key)
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        self.headers = headers
+        response = super().getresponse()
+
+        if response.status == 304 and entry:
+            _cache_stats['hits'] += 1
+            replayed_headers = dict(entry['headers'])
+            for header, value in response.headers.items():
+                if header.lower() != 'content-length':
+                    replayed_headers[header.lower()] = value   # e.g. fresh rate limits
+            return CachedResponse(200, replayed_headers, entry['body'])
+
+        _cache_stats['misses'] += 1
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status == 200 and (etag or last_modified):
+            entry = {
+                'url': self.url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'headers': dict((k.lower(), v) for k, v in response.headers.items()),
+                'body': response.text,
+            }
+            _write_cache_entry(cache_key, entry)
+            _cache_stats['stored'] += 1
+        return response
+
+
+class CachingHTTPSConnection(ConditionalRequestsMixin, HTTPSRequestsConnectionClass):
+    pass
+
+
+class CachingHTTPConnection(ConditionalRequestsMixin, HTTPRequestsConnectionClass):
+    pass   # used by GitHub Enterprise or local stand-in servers on http://
+
+
+
+# CACHE API
+################################################################################
+
+def install_github_cache():
+    """
+    Make all PyGithub clients created after this call use the on-disk cache.
+    """
+    Requester.injectConnectionClasses(CachingHTTPConnection, CachingHTTPSConnection)
+
+
+def get_github_cache_stats():
+    """
+    Returns a dict with the number of cache `hits` (304 replayed from disk),
+    `misses` (full responses downloaded), and responses `stored` so far.
+    """
+    return dict(_cache_stats)
+
+
+def clear_github_cache():
+    """
+    Remove all stored responses. Returns the number of responses removed.
+    """
+    if not os.path.exists(GITHUB_CACHE_DIR):
+        return 0
+    count = 0
+    for filename in os.listdir(GITHUB_CACHE_DIR):
+        os.remove(os.path.join(GITHUB_CACHE_DIR, filename))
+        count += 1
+    return count
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _get_cache_key(host, url, authorization):
+    # responses are cached per token so different users never share responses
+    key_str = '\n'.join([host, url, authorization or ''])
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+def _read_cache_entry(cache_key):
+    entry_path = os.path.join(GITHUB_CACHE_DIR, cache_key + '.json')
+    if not os.path.exists(entry_path):
+        return None
+    try:
+        with open(entry_path, 'r') as entryf:
+            return json.load(entryf)
+    except ValueError:
+        return None
+
+
+def _write_cache_entry(cache_key, entry):
+    os.makedirs(GITHUB_CACHE_DIR, exist_ok=True)
+    entry_path = os.path.join(GITHUB_CACHE_DIR, cache_key + '.json')
+    tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+    with open(tmp_path, 'w') as entryf:
+        json.dump(entry, entryf)
+    os.replace(tmp_path, entry_path)
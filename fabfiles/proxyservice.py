@@ -6,43 +6,55 @@ from fabric.colors import red, green, blue, yellow
 from fabric.context_managers import hide
 from fabric.utils import puts
 
+from .fleet import FLEET_POOL_SIZE, get_fleet_targets, probe_fleet, print_fleet_results
+from .timing import timed
+
 
 # PROXY SERVERS
 ################################################################################
 
+PROXY_PORT = 3128  # squid3 default proxy port
+
 @task
-def check_proxies():
+@timed
+def check_proxies(port=PROXY_PORT, pool_size=FLEET_POOL_SIZE, timeout=3, roledefs=None):
     """
     Check which demoservers have port 3128 open and is running a proxy service.
+    Use `roledefs` (path of a json file of roles) to check stand-in hosts.
     """
     puts(green('Checking proxy service available on all demo servers.'))
-    demo_servers = list(env.roledefs.items())
-    proxy_hosts = []
-    for role_name, role in demo_servers:
-        assert len(role['hosts'])==1, 'Multiple hosts found for role'
-        host = role['hosts'][0]
-        print('Checking role_name=', role_name, 'host=', host)
-        hostname = role.get('hostname')
-        if hostname is None:
-            continue  # skip non-demoserver hosts (e.g. vader)
-        # check if we proxy port is open on host
-        proxy_port_open = False
-        port = 3128  # squid3 default proxy port
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-
-        result = sock.connect_ex((host, port))
-        proxy_port_open = True if result == 0 else False
-        sock.close()
-        if proxy_port_open:
-            puts('    - proxy port open on {} demoserver'.format(role_name))
-            proxy_hosts.append(host)
-    PROXY_LIST_value = ';'.join(host+':3128' for host in proxy_hosts)
+    port = int(port)
+    # skip non-demoserver hosts (e.g. vader)
+    targets = get_fleet_targets(roledefs=roledefs, require='hostname')
+    results = probe_fleet(_proxy_port_probe(port), targets,
+                          pool_size=int(pool_size), timeout=float(timeout))
+    print_fleet_results(results)
+    proxy_hosts = [result['host'] for result in results if result['status'] == 'ok']
+    PROXY_LIST_value = ';'.join(host+':'+str(port) for host in proxy_hosts)
     puts(blue('Use the following command to set the PROXY_LIST env var:\n'))
     puts(blue('  export PROXY_LIST="' + PROXY_LIST_value + '"'))
     return proxy_hosts
 
+def _proxy_port_probe(port):
+    """
+    Returns a fleet probe that checks if the proxy `port` is open on the host.
+    """
+    def _probe(role_name, host, role, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            result = sock.connect_ex((host, port))
+        except socket.timeout:
+            result = None
+        finally:
+            sock.close()
+        if result == 0:
+            return 'ok', 'proxy port {} open'.format(port)
+        return 'fail', 'proxy port {} closed'.format(port)
+    return _probe
+
 @task
+@timed
 def update_proxy_servers():
     """
     Update the /etc/squid/squid.conf on all proxy hosts.
@@ -64,6 +76,7 @@ def update_proxy_servers():
 ################################################################################
 
 @task
+@timed
 def install_squid_proxy():
     """
     Install squid3 package and starts it so demoserver can be used as HTTP proxy.
@@ -85,6 +98,7 @@ def install_squid_proxy():
 
 
 @task
+@timed
 def update_squid_proxy():
     """
     Update /etc/squid/squid.conf based on file in config/etc_squid_squid.conf.
@@ -101,6 +115,7 @@ def update_squid_proxy():
 
 
 @task
+@timed
 def uninstall_squid_proxy():
     """
     Stop and uninstall squid3 proxy on the demoserver.
@@ -0,0 +1,125 @@
+import json
+import os
+import re
+import requests
+import time
+
+
+# PYPI SETTINGS
+################################################################################
+# Any server that answers `GET {PYPI_INDEX_URL}/{package}/json` like PyPI does can
+# be used as index, e.g. `python -m http.server` serving `ricecooker/json` files.
+PYPI_INDEX_URL = os.environ.get('PYPI_INDEX_URL', 'https://pypi.org/pypi')
+PYPI_CACHE_DIR = 'cache'
+PYPI_CACHE_FILE = os.path.join(PYPI_CACHE_DIR, 'pypi_versions.json')
+PYPI_CACHE_TTL = 6*60*60     # latest versions are refreshed after 6 hours
+PYPI_REQUEST_TIMEOUT = 10
+
+_versions_cache = None      # in-memory copy of PYPI_CACHE_FILE
+
+
+
+# LATEST VERSION LOOKUP
+################################################################################
+
+def get_latest_version(package_name, offline=None):
+    """
+    Return the latest version of `package_name` on PyPI. Results are cached in
+    memory and in PYPI_CACHE_FILE for PYPI_CACHE_TTL seconds. In offline mode
+    (`offline=True` or env var PYPI_OFFLINE=true) the cached version is returned
+    regardless of its age, or None if the package was never looked up.
+    """
+    if offline is None:
+        offline = is_offline()
+    cache = _load_versions_cache()
+    key = normalize_package_name(package_name)
+    entry = cache.get(key)
+    if entry:
+        if offline or time.time() - entry['fetched_at'] < PYPI_CACHE_TTL:
+            return entry['version']
+    if offline:
+        return None
+    version = _fetch_latest_version(key)
+    cache[key] = {'version': version, 'fetched_at': time.time()}
+    _save_versions_cache({key: cache[key]})
+    return version
+
+
+def prefetch_latest_versions(package_names, offline=None):
+    """
+    Make sure the versions of all `package_names` are in the cache, e.g. before
+    starting worker processes that would otherwise all do the same lookups.
+    """
+    versions = {}
+    for name in package_names:
+        try:
+            versions[name] = get_latest_version(name, offline=offline)
+        except requests.RequestException:
+            versions[name] = None   # retried later by whoever needs the version
+    return versions
+
+
+def normalize_package_name(package_name):
+    """
+    Return the PEP 503 normalized form of `package_name`, e.g. `Le_Utils` and
+    `le.utils` become `le-utils`.
+    """
+    return re.sub(r'[-_.]+', '-', package_name).lower()
+
+
+def is_offline():
+    offline = os.environ.get('PYPI_OFFLINE', '')
+    return offline.lower() in ['true', '1', 'yes']
+
+
+def clear_versions_cache():
+    """
+    Remove all cached versions (in memory and on disk).
+    """
+    global _versions_cache
+    _versions_cache = {}
+    if os.path.exists(PYPI_CACHE_FILE):
+        os.remove(PYPI_CACHE_FILE)
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _fetch_latest_version(package_name):
+    url = '{}/{}/json'.format(PYPI_INDEX_URL.rstrip('/'), package_name)
+    response = requests.get(url, timeout=PYPI_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['info']['version']
+
+
+def _read_versions_file():
+    if not os.path.exists(PYPI_CACHE_FILE):
+        return {}
+    try:
+        with open(PYPI_CACHE_FILE, 'r') as cachef:
+            return json.load(cachef)
+    except ValueError:
+        return {}   # corrupted cache file will be overwritten on next save
+
+
+def _load_versions_cache():
+    global _versions_cache
+    if _versions_cache is None:
+        _versions_cache = _read_versions_file()
+    return _versions_cache
+
+
+def _save_versions_cache(new_entries):
+    """
+    Merge `new_entries` into the cache file and write it atomically, so that
+    several processes updating the cache at the same time don't corrupt it.
+    """
+    if not os.path.exists(PYPI_CACHE_DIR):
+        os.makedirs(PYPI_CACHE_DIR, exist_ok=True)
+    data = _read_versions_file()
+    data.update(new_entries)
+    tmp_path = '{}.{}.tmp'.format(PYPI_CACHE_FILE, os.getpid())
+    with open(tmp_path, 'w') as tmpf:
+        json.dump(data, tmpf, indent=2, sort_keys=True)
+    os.replace(tmp_path, PYPI_CACHE_FILE)
@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+from urllib.parse import quote
+
+
+# REPORT STORE SETTINGS
+################################################################################
+# Stored reports are saved as one json file per key in the directory structure
+# REPORT_STORE_DIR/{repo_name}/{branch}/{sha}-v{checker_version}.json so that
+# parallel workers never write to the same file.
+REPORT_STORE_DIR = os.path.join('cache', 'code_reports')
+
+
+
+# REPORT STORE
+################################################################################
+
+def get_stored_report(repo_name, branch, sha, checker_version):
+    """
+    Return the report stored for the key (repo_name, branch, sha, checker_version)
+    or None if this commit has not been analyzed by this version of the checks.
+    """
+    report_path = _get_report_path(repo_name, branch, sha, checker_version)
+    if not os.path.exists(report_path):
+        return None
+    try:
+        with open(report_path, 'r') as reportf:
+            return json.load(reportf)
+    except ValueError:
+        return None  # partially written or corrupted file = not in the store
+
+
+def store_report(report, sha, checker_version):
+    """
+    Save the `report` under the key (repo_name, branch, sha, checker_version).
+    Older reports for the same repo and branch are replaced.
+    """
+    repo_name, branch = report['repo_name'], report['branch']
+    branch_dir = _get_branch_dir(repo_name, branch)
+    if os.path.exists(branch_dir):
+        shutil.rmtree(branch_dir)
+    os.makedirs(branch_dir, exist_ok=True)
+    report_path = _get_report_path(repo_name, branch, sha, checker_version)
+    tmp_path = report_path + '.tmp'
+    with open(tmp_path, 'w') as reportf:
+        json.dump(report, reportf, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, report_path)
+
+
+def invalidate_reports(repo_name=None, branch=None):
+    """
+    Remove the stored reports for `branch` of `repo_name`, all branches of
+    `repo_name`, or all the repos when `repo_name` is None.
+    Returns the number of stored reports removed.
+    """
+    if repo_name is None:
+        target_dir = REPORT_STORE_DIR
+    elif branch is None:
+        target_dir = os.path.join(REPORT_STORE_DIR, repo_name)
+    else:
+        target_dir = _get_branch_dir(repo_name, branch)
+    if not os.path.exists(target_dir):
+        return 0
+    count = 0
+    for _, _, filenames in os.walk(target_dir):
+        count += len([f for f in filenames if f.endswith('.json')])
+    shutil.rmtree(target_dir)
+    return count
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _get_branch_dir(repo_name, branch):
+    # branch names like `feature/x` are quoted to remain a single directory
+    return os.path.join(REPORT_STORE_DIR, repo_name, quote(branch, safe=''))
+
+
+def _get_report_path(repo_name, branch, sha, checker_version):
+    filename = '{}-v{}.json'.format(sha, checker_version)
+    return os.path.join(_get_branch_dir(repo_name, branch), filename)
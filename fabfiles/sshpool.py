@@ -0,0 +1,152 @@
+import time
+
+from fabric.api import env, task
+from fabric.network import HostConnectionCache, normalize_to_string
+import fabric.state
+
+from .timing import timed
+
+
+# SSH POOL SETTINGS
+################################################################################
+# Fabric opens one SSH connection per host and runs every run/sudo/put/get as a
+# new channel on it. The pool keeps these connections warm for the whole fab
+# session (keepalive), reconnects transparently when a connection was dropped,
+# and closes connections that were not used for SSH_IDLE_TIMEOUT seconds.
+SSH_KEEPALIVE = 30          # seconds between keepalive packets (unless --keepalive)
+SSH_IDLE_TIMEOUT = 15*60    # close connections not used for this many seconds
+
+
+
+# CONNECTION POOL
+################################################################################
+
+class PooledConnectionCache(HostConnectionCache):
+    """
+    HostConnectionCache that records connection reuse statistics per host,
+    replaces dropped connections, and evicts idle connections.
+    """
+    def init_pool(self, idle_timeout=SSH_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.last_used = {}
+        self.pool_stats = {}
+
+    def get_host_stats(self, key):
+        if key not in self.pool_stats:
+            self.pool_stats[key] = {
+                'connects': 0,
+                'reuses': 0,
+                'dropped': 0,
+                'evicted': 0,
+                'connect_seconds': 0.0,
+            }
+        return self.pool_stats[key]
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        stats = self.get_host_stats(key)
+        start = time.time()
+        HostConnectionCache.connect(self, key)
+        stats['connects'] += 1
+        stats['connect_seconds'] += time.time() - start
+
+    def checkout(self, key):
+        """
+        Returns the client for `key` to open a new channel on (a real use of the
+        connection): evicts the idle connections of other hosts, and replaces
+        the connection to `key` if it was dropped. Plain `self[key]` lookups
+        (e.g., by `disconnect_all`) have none of these side effects.
+        """
+        key = normalize_to_string(key)
+        now = time.time()
+        self.evict_idle(now, keep=key)
+        if key in self:
+            transport = dict.__getitem__(self, key).get_transport()
+            if transport is None or not transport.is_active():
+                self.get_host_stats(key)['dropped'] += 1
+                self._close(key)
+            else:
+                self.get_host_stats(key)['reuses'] += 1
+        client = HostConnectionCache.__getitem__(self, key)   # connects if needed
+        self.last_used[key] = now
+        return client
+
+    def evict_idle(self, now=None, keep=None):
+        """
+        Close the connections (other than `keep`) idle for more than idle_timeout.
+        """
+        now = now or time.time()
+        for key in list(self.keys()):
+            if key != keep and now - self.last_used.get(key, now) > self.idle_timeout:
+                self.get_host_stats(key)['evicted'] += 1
+                self._close(key)
+
+    def _close(self, key):
+        try:
+            dict.__getitem__(self, key).close()
+        finally:
+            dict.__delitem__(self, key)
+            self.last_used.pop(key, None)
+
+
+_fabric_open_session = fabric.state._open_session
+
+
+def _open_pooled_session():
+    """
+    Replaces `fabric.state._open_session`, which opens the channel of every
+    run/sudo command, to check the connection out of the pool first.
+    """
+    fabric.state.connections.checkout(env.host_string)
+    return _fabric_open_session()
+
+
+def install_ssh_pool(keepalive=SSH_KEEPALIVE, idle_timeout=SSH_IDLE_TIMEOUT):
+    """
+    Turn Fabric's global connection cache into a PooledConnectionCache (in place,
+    since fabric modules hold references to `fabric.state.connections`).
+    """
+    connections = fabric.state.connections
+    if not isinstance(connections, PooledConnectionCache):
+        connections.__class__ = PooledConnectionCache
+        connections.init_pool(idle_timeout=idle_timeout)
+        fabric.state._open_session = _open_pooled_session
+    if not env.keepalive:
+        env.keepalive = keepalive
+
+
+def get_ssh_pool_stats():
+    """
+    Returns {host_string: stats} for all the hosts connected to in this process.
+    """
+    connections = fabric.state.connections
+    if not isinstance(connections, PooledConnectionCache):
+        return {}
+    return dict((key, dict(stats)) for key, stats in connections.pool_stats.items())
+
+
+
+# SSH POOL STATS
+################################################################################
+
+@task
+@timed
+def ssh_pool_stats():
+    """
+    Print the SSH connection reuse statistics of this fab session; chain it after
+    other tasks, e.g., `fab -R vader update_chef:x ssh_pool_stats`. Stats of the
+    connections made by parallel (`-P`) subprocesses are not included.
+    """
+    all_stats = get_ssh_pool_stats()
+    connections = fabric.state.connections
+    print('\t'.join(['host', 'connects', 'reuses', 'dropped', 'evicted', 'connect time', 'open']))
+    for key, stats in sorted(all_stats.items()):
+        print('\t'.join([
+            key,
+            str(stats['connects']),
+            str(stats['reuses']),
+            str(stats['dropped']),
+            str(stats['evicted']),
+            '{:.1f}s'.format(stats['connect_seconds']),
+            'yes' if key in connections else 'no',
+        ]))
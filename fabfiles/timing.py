@@ -0,0 +1,201 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+import fabric.api
+import fabric.operations
+from fabric.api import env, task
+from fabric.colors import yellow
+from fabric.utils import puts
+
+
+# TIMING SETTINGS
+################################################################################
+# Spans are appended as json lines to TIMING_LOG_FILE with the keys:
+#   run_id, span_id, parent_id, kind (task, run, sudo, local), name, host,
+#   start, seconds, status (ok or the name of the exception raised)
+TIMING_LOG_FILE = os.path.join('cache', 'timing.jsonl')
+TIMING_COMMAND_MAXLEN = 200
+TOKEN_PAT = re.compile(r'(token[=\s]+)\S+', re.IGNORECASE)   # never log tokens
+
+RUN_ID = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]   # one per fab invocation
+
+_span_stacks = threading.local()
+_original_run_command = fabric.operations._run_command
+_original_local = fabric.operations.local
+
+
+
+# INSTRUMENTATION
+################################################################################
+
+def timed(func):
+    """
+    Decorator that records a `task` span for each call of `func`. Use it below
+    `@task` so that the fab task name and docstring are preserved.
+    """
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        with span('task', func.__name__):
+            return func(*args, **kwargs)
+    return timed_func
+
+
+@contextmanager
+def span(kind, name):
+    """
+    Record the wall time of the `with` block as a span of `kind` named `name`.
+    Spans started inside the block (in the same thread) are its children.
+    """
+    stack = _get_span_stack()
+    span_id = uuid.uuid4().hex[:12]
+    record = {
+        'run_id': RUN_ID,
+        'span_id': span_id,
+        'parent_id': stack[-1] if stack else None,
+        'kind': kind,
+        'name': name,
+        'host': env.host_string or 'localhost',
+        'start': time.time(),
+        'status': 'ok',
+    }
+    stack.append(span_id)
+    try:
+        yield
+    except BaseException as e:
+        record['status'] = e.__class__.__name__
+        raise
+    finally:
+        stack.pop()
+        record['seconds'] = time.time() - record['start']
+        _write_span(record)
+
+
+def install_timing():
+    """
+    Record a span for every `run`, `sudo`, and `local` command. The `local` of
+    modules that already imported it from fabric.api is rebound as well.
+    """
+    if fabric.operations._run_command is not _original_run_command:
+        return
+    fabric.operations._run_command = _timed_run_command
+    fabric.operations.local = _timed_local
+    fabric.api.local = _timed_local
+    for module_name, module in list(sys.modules.items()):
+        if module_name.startswith('fabfiles') and getattr(module, 'local', None) is _original_local:
+            module.local = _timed_local
+
+
+def _timed_run_command(command, *args, **kwargs):
+    kind = 'sudo' if kwargs.get('sudo') else 'run'
+    with span(kind, _format_command(command)):
+        return _original_run_command(command, *args, **kwargs)
+
+
+def _timed_local(command, *args, **kwargs):
+    with span('local', _format_command(command)):
+        return _original_local(command, *args, **kwargs)
+
+
+
+# TIMING REPORT
+################################################################################
+
+@task
+def timing_report(run=None, kind='task', by_host=False, last=None):
+    """
+    Print the count, total, and p50/p90/p99/max wall time of the spans of `kind`
+    (task, run, sudo, or local) across all recorded runs (or the `last` N runs).
+    Use `by_host=true` for per-host statistics, or `run=last` (or a run id) to
+    print the tree of all the spans of a single run.
+    """
+    by_host = (by_host and str(by_host).lower() == 'true')
+    records = _read_spans()
+    if not records:
+        puts(yellow('No timing data in ' + TIMING_LOG_FILE))
+        return
+    run_ids = sorted(set(record['run_id'] for record in records))
+    if run:
+        run_id = run_ids[-1] if run == 'last' else run
+        _print_span_tree([record for record in records if record['run_id'] == run_id])
+        return
+    if last:
+        selected_run_ids = set(run_ids[-int(last):])
+        records = [record for record in records if record['run_id'] in selected_run_ids]
+
+    seconds_by_key = defaultdict(list)
+    for record in records:
+        if record['kind'] == kind:
+            key = (record['name'], record['host'] if by_host else '')
+            seconds_by_key[key].append(record['seconds'])
+    print('\t'.join(['name', 'host', 'count', 'total', 'p50', 'p90', 'p99', 'max']))
+    for (name, host), seconds in sorted(seconds_by_key.items(), key=lambda item: -sum(item[1])):
+        seconds = sorted(seconds)
+        print('\t'.join([name, host, str(len(seconds)), '{:.1f}s'.format(sum(seconds))] +
+                        ['{:.1f}s'.format(_percentile(seconds, p)) for p in [50, 90, 99, 100]]))
+
+
+
+# HELPER METHODS
+################################################################################
+
+def _get_span_stack():
+    if not hasattr(_span_stacks, 'stack'):
+        _span_stacks.stack = []
+    return _span_stacks.stack
+
+
+def _format_command(command):
+    command = TOKEN_PAT.sub(r'\1...', ' '.join(command.split()))
+    if len(command) > TIMING_COMMAND_MAXLEN:
+        command = command[0:TIMING_COMMAND_MAXLEN] + '...'
+    return command
+
+
+def _write_span(record):
+    # a single short append per span so parallel fab processes can share the file
+    os.makedirs(os.path.dirname(TIMING_LOG_FILE), exist_ok=True)
+    with open(TIMING_LOG_FILE, 'a') as logf:
+        logf.write(json.dumps(record) + '\n')
+
+
+def _read_spans():
+    if not os.path.exists(TIMING_LOG_FILE):
+        return []
+    records = []
+    with open(TIMING_LOG_FILE) as logf:
+        for line in logf:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass   # line being written
+    return records
+
+
+def _percentile(sorted_values, percent):
+    # nearest-rank percentile
+    index = max(int(round(percent / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def _print_span_tree(records):
+    children = defaultdict(list)
+    span_ids = set(record['span_id'] for record in records)
+    for record in sorted(records, key=lambda record: record['start']):
+        parent_id = record['parent_id'] if record['parent_id'] in span_ids else None
+        children[parent_id].append(record)
+
+    def print_subtree(parent_id, depth):
+        for record in children[parent_id]:
+            status = '' if record['status'] == 'ok' else '  [' + record['status'] + ']'
+            print('{:>8.1f}s  {}{} {} ({}){}'.format(
+                record['seconds'], '    ' * depth, record['kind'], record['name'], record['host'], status))
+            print_subtree(record['span_id'], depth + 1)
+    print_subtree(None, 0)
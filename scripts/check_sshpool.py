@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Checks fabfiles/sshpool.py against a local stand-in sshd (paramiko server on
+127.0.0.1 that accepts any password and runs exec requests with bash): runs
+Fabric `run` commands through the pool and checks connection reuse, keepalive
+packets, reconnection after a dropped connection, idle eviction, and that
+`disconnect_all` does not reconnect.
+
+Usage (from the repo root, with the requirements installed):
+
+    python scripts/check_sshpool.py
+
+Exits with status 1 if any check fails.
+"""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric.api import env, hide, run                   # noqa: E402
+from fabric.network import disconnect_all               # noqa: E402
+import fabric.state                                     # noqa: E402
+
+from fabfiles.sshpool import get_ssh_pool_stats, install_ssh_pool   # noqa: E402
+
+
+KEEPALIVE = 1        # sec between keepalive packets in the checks
+IDLE_TIMEOUT = 3     # sec before an unused connection is evicted in the checks
+
+
+
+# STAND-IN SSHD
+################################################################################
+
+class StubServer(paramiko.ServerInterface):
+    """
+    Accepts any password, session channels, ptys, and exec requests, and counts
+    the keepalive global requests of the connection.
+    """
+    def __init__(self):
+        self.keepalives = 0
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_REQUEST
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_global_request(self, kind, msg):
+        if kind == 'keepalive@lag.net':
+            self.keepalives += 1
+        return False
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.exec_command, args=(channel, command), daemon=True).start()
+        return True
+
+    def exec_command(self, channel, command):
+        process = subprocess.Popen(command.decode('utf-8'), shell=True, executable='/bin/bash',
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        channel.sendall(process.communicate()[0])
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+class StubSSHD(object):
+    """
+    Serves StubServer on a free port of 127.0.0.1 in a background thread.
+    `connections` lists the (transport, server) of every connection.
+    """
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(10)
+        self.port = self.sock.getsockname()[1]
+        self.connections = []
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            client_sock, _ = self.sock.accept()
+            transport = paramiko.Transport(client_sock)
+            transport.add_server_key(self.host_key)
+            server = StubServer()
+            transport.start_server(server=server)
+            self.connections.append((transport, server))
+
+    def active(self, username):
+        return [(transport, server) for transport, server in self.connections
+                if transport.is_active() and transport.get_username() == username]
+
+    def drop(self, username):
+        for transport, _ in self.active(username):
+            transport.close()
+
+
+
+# CHECKS
+################################################################################
+
+failures = []
+
+
+def check(name, ok, details=''):
+    print('{}\t{}\t{}'.format('OK' if ok else 'FAIL', name, details))
+    if not ok:
+        failures.append(name)
+
+
+def run_as(host_string, command):
+    env.host_string = host_string
+    with hide('everything'):
+        return run(command)
+
+
+def main():
+    sshd = StubSSHD()
+    host_a = 'pool-a@127.0.0.1:{}'.format(sshd.port)
+    host_b = 'pool-b@127.0.0.1:{}'.format(sshd.port)
+    env.password = 'stand-in'
+    env.no_agent = True
+    env.no_keys = True
+    env.disable_known_hosts = True
+    env.abort_on_prompts = True
+    env.shell = '/bin/bash -c'   # no login shell: its profile output would be in the outputs
+    env.keepalive = 0
+    install_ssh_pool(keepalive=KEEPALIVE, idle_timeout=IDLE_TIMEOUT)
+    connections = fabric.state.connections
+
+    # checkout: the second command reuses the connection of the first
+    outputs = [run_as(host_a, 'echo one'), run_as(host_a, 'echo two')]
+    stats = get_ssh_pool_stats()[host_a]
+    check('commands run', outputs == ['one', 'two'], repr(outputs))
+    check('connection reused', stats['connects'] == 1 and stats['reuses'] == 1, stats)
+    check('one connection on the server', len(sshd.active('pool-a')) == 1)
+
+    # keepalive: packets are sent while the connection is not used
+    time.sleep(2.5 * KEEPALIVE)
+    keepalives = sum(server.keepalives for _, server in sshd.active('pool-a'))
+    check('keepalive packets sent', keepalives >= 2, '{} in {}s'.format(keepalives, 2.5 * KEEPALIVE))
+
+    # dropped connection: replaced transparently on the next command
+    sshd.drop('pool-a')
+    time.sleep(0.5)
+    output = run_as(host_a, 'echo three')
+    stats = get_ssh_pool_stats()[host_a]
+    check('command run after drop', output == 'three', repr(output))
+    check('dropped connection replaced', stats['dropped'] == 1 and stats['connects'] == 2, stats)
+
+    # idle eviction: host_b is closed when host_a is used after IDLE_TIMEOUT
+    run_as(host_b, 'true')
+    time.sleep(IDLE_TIMEOUT + 1)
+    run_as(host_a, 'true')
+    time.sleep(0.5)
+    stats_b = get_ssh_pool_stats()[host_b]
+    check('idle connection evicted', stats_b['evicted'] == 1 and host_b not in connections, stats_b)
+    check('evicted connection closed on the server', not sshd.active('pool-b'))
+    check('used connection kept', host_a in connections and len(sshd.active('pool-a')) == 1)
+
+    # disconnect_all closes the connections without reconnecting them
+    connects = get_ssh_pool_stats()[host_a]['connects']
+    with hide('everything'):
+        disconnect_all()
+    time.sleep(0.5)
+    check('disconnect_all closes', not connections and not sshd.active('pool-a'))
+    check('disconnect_all does not reconnect', get_ssh_pool_stats()[host_a]['connects'] == connects)
+
+    if failures:
+        print('{} checks failed: {}'.format(len(failures), ', '.join(failures)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()